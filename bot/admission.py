@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+
+
+# CPU seconds per minute used by a game of each speed before it's measured (60 is a full core):
+# the engine searches on about half of the game time, faster games with more threads per move
+DEFAULT_CPU_PER_MINUTE = {
+    'ultraBullet': 60,
+    'bullet': 50,
+    'blitz': 40,
+    'rapid': 30,
+    'classical': 25,
+    'correspondence': 2,
+}
+# Minutes of a game before its measured usage replaces the estimate
+MIN_MEASURED_MINUTES = 1
+# Weight of a finished game in the learned usage of its speed
+LEARN_RATE = 0.2
+# Seconds an accepted challenge holds its capacity while waiting for its gameStart
+RESERVATION_SECONDS = 30
+
+
+def speed_of(limit, increment):
+    """
+    Lichess speed of a time control (estimated game time = limit + 40 increments)
+    :param limit: initial clock (s), None for correspondence
+    :param increment: increment (s)
+    """
+    if limit is None:
+        return 'correspondence'
+    estimate = limit + 40 * increment
+    if estimate < 30:
+        return 'ultraBullet'
+    if estimate < 180:
+        return 'bullet'
+    if estimate < 480:
+        return 'blitz'
+    if estimate < 1500:
+        return 'rapid'
+    return 'classical'
+
+
+class AdmissionController:
+    """
+    Accept new games only while the engines have capacity for them: the CPU needed by the games in progress
+    (measured from their searches, estimated by speed at the start) plus the new one must stay within
+    utilization of the cores. Max games per speed and per variant are checked too.
+    An accepted challenge reserves the capacity of its game until the game starts, so challenges accepted
+    together can't overbook the engines
+    """
+    def __init__(self, cores=None, utilization=0.8, speed_limits=None, variant_limits=None):
+        """
+        :param cores: CPU cores of the engines (None for all the cores of the machine)
+        :param utilization: max share of the cores used by the games (0-1)
+        :param speed_limits: dict of speed: max games at the same time
+        :param variant_limits: dict of variant: max games at the same time
+        """
+        self.cores = cores or os.cpu_count() or 1
+        self.utilization = utilization
+        self.speed_limits = speed_limits or {}
+        self.variant_limits = variant_limits or {}
+        self.cpu_per_minute = dict(DEFAULT_CPU_PER_MINUTE)
+        # game id: {'speed', 'variant', 'start', 'cpu'}
+        self._games = {}
+        # challenge id: {'speed', 'variant', 'expires'}
+        self._reserved = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, challenge_id, speed, variant):
+        """
+        Hold the capacity of an accepted challenge until game_started (the game has the id of the challenge),
+        release or RESERVATION_SECONDS
+        """
+        with self._lock:
+            self._reserved[challenge_id] = {'speed': speed, 'variant': variant,
+                                            'expires': time.monotonic() + RESERVATION_SECONDS}
+
+    def release(self, challenge_id):
+        """
+        Free the capacity of a challenge declined, canceled or not accepted
+        """
+        with self._lock:
+            self._reserved.pop(challenge_id, None)
+
+    def _pending(self):
+        # Reservations not expired (called with the lock)
+        now = time.monotonic()
+        for challenge_id in [challenge_id for challenge_id, reservation in self._reserved.items()
+                             if reservation['expires'] <= now]:
+            del self._reserved[challenge_id]
+        return list(self._reserved.values())
+
+    def game_started(self, game_id, speed, variant):
+        with self._lock:
+            self._reserved.pop(game_id, None)
+            self._games.setdefault(game_id, {'speed': speed, 'variant': variant, 'start': time.monotonic(),
+                                             'cpu': 0.0})
+
+    def record_search(self, game_id, cpu_seconds):
+        """
+        Add the CPU used by a search (seconds x threads)
+        """
+        with self._lock:
+            if game_id in self._games:
+                self._games[game_id]['cpu'] += cpu_seconds
+
+    def usage(self):
+        """
+        :return: dict of game id: CPU seconds used
+        """
+        with self._lock:
+            return {game_id: game['cpu'] for game_id, game in self._games.items()}
+
+    def update_usage(self, usage):
+        """
+        Save the CPU used by games searched in another process (the workers of the supervisor mode)
+        """
+        with self._lock:
+            for game_id, cpu in usage.items():
+                if game_id in self._games:
+                    self._games[game_id]['cpu'] = cpu
+
+    def _game_rate(self, game):
+        minutes = (time.monotonic() - game['start']) / 60
+        if minutes < MIN_MEASURED_MINUTES:
+            return self.cpu_per_minute.get(game['speed'], DEFAULT_CPU_PER_MINUTE['blitz'])
+        return game['cpu'] / minutes
+
+    def game_over(self, game_id):
+        """
+        Forget the game, its measured usage updates the estimate of its speed
+        """
+        with self._lock:
+            game = self._games.pop(game_id, None)
+            if game is None or (time.monotonic() - game['start']) / 60 < MIN_MEASURED_MINUTES:
+                return
+            speed = game['speed']
+            old = self.cpu_per_minute.get(speed, DEFAULT_CPU_PER_MINUTE['blitz'])
+            self.cpu_per_minute[speed] = old * (1 - LEARN_RATE) + self._game_rate(game) * LEARN_RATE
+
+    def demand(self):
+        """
+        :return: CPU seconds per minute needed by the games in progress and the accepted challenges
+        """
+        with self._lock:
+            return (sum(self._game_rate(game) for game in self._games.values())
+                    + sum(self.cpu_per_minute.get(reservation['speed'], DEFAULT_CPU_PER_MINUTE['blitz'])
+                          for reservation in self._pending()))
+
+    def capacity(self):
+        return self.cores * 60 * self.utilization
+
+    def can_accept(self, speed, variant):
+        """
+        :return: (True, '') if a new game fits, else (False, reason)
+        """
+        with self._lock:
+            games = list(self._games.values()) + self._pending()
+            speeds = sum(game['speed'] == speed for game in games)
+            variants = sum(game['variant'] == variant for game in games)
+        if speed in self.speed_limits and speeds >= self.speed_limits[speed]:
+            return False, f"{speeds} {speed} games in progress"
+        if variant in self.variant_limits and variants >= self.variant_limits[variant]:
+            return False, f"{variants} {variant} games in progress"
+        demand = self.demand()
+        needed = self.cpu_per_minute.get(speed, DEFAULT_CPU_PER_MINUTE['blitz'])
+        if demand + needed > self.capacity():
+            return False, f"engines busy ({demand:.0f}+{needed:.0f} of {self.capacity():.0f} CPU s/min)"
+        return True, ''
+
+
+# Controller configured at startup by configure()
+controller = AdmissionController()
+
+
+def configure(cores=None, utilization=0.8, speed_limits=None, variant_limits=None):
+    global controller
+    controller = AdmissionController(cores, utilization, speed_limits, variant_limits)
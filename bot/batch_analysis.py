@@ -0,0 +1,217 @@
+import argparse
+import io
+import json
+import os
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import chess
+import chess.engine
+import chess.pgn
+import yaml
+
+import engine_pool
+import game_archive
+from engine_search import cp_from_score
+from game_session import new_board
+
+
+THIS_FOLDER = Path(__file__).parent.resolve()
+# Hash (MB) of every analysis engine, each one has a single thread
+ANALYSIS_HASH = 64
+# Positions queued per engine beyond the one whose result is waited for
+READ_AHEAD = 4
+# Depth when neither depth nor nodes are given
+DEFAULT_DEPTH = 18
+# Variant of the boards read from PGN files (uci_variant): Lichess variant key
+LICHESS_VARIANTS = {'chess': 'standard', 'crazyhouse': 'crazyhouse', 'antichess': 'antichess', 'atomic': 'atomic',
+                    'horde': 'horde', 'kingofthehill': 'kingOfTheHill', 'racingkings': 'racingKings',
+                    '3check': 'threeCheck'}
+
+AnalysisResult = namedtuple('AnalysisResult', 'index variant fen cp best_move pv depth nodes error')
+
+
+def position_board(position, variant):
+    """
+    :param position: FEN ('startpos' for the starting position) or list of moves (uci) from the starting position
+    :param variant: type of chess variant
+    :return: board of the position
+    """
+    if isinstance(position, str):
+        return new_board(variant, position)
+    board = new_board(variant)
+    for move in position:
+        board.push_uci(move)
+    return board
+
+
+class BatchAnalyzer:
+    """
+    Analyse many positions at the same time on pools of single thread engines (as many as the CPU cores).
+    Results come back in the order of the positions, while the next ones are being analysed
+    """
+    def __init__(self, stockfish_path, fairy_path, workers=None, depth=None, nodes=None):
+        """
+        :param stockfish_path: path of Stockfish (standard and chess960 positions)
+        :param fairy_path: path of Fairy-Stockfish (the other variants)
+        :param workers: engines analysing at the same time (default: CPU count)
+        :param depth: depth of every analysis
+        :param nodes: nodes of every analysis (with depth, the first reached stops it)
+        """
+        self.workers = workers or os.cpu_count() or 1
+        if depth is None and nodes is None:
+            depth = DEFAULT_DEPTH
+        self.limit = chess.engine.Limit(depth=depth, nodes=nodes)
+        options = {"Threads": 1, "Hash": ANALYSIS_HASH}
+        self.stockfish_pool = engine_pool.EnginePool(stockfish_path, self.workers, options, max_ponder=0)
+        self.fairy_pool = engine_pool.EnginePool(fairy_path, self.workers, options, max_ponder=0)
+
+    def analyse(self, index, position, variant):
+        """
+        :return: AnalysisResult of one position (with the error if it can't be analysed)
+        """
+        fen = None
+        try:
+            board = position_board(position, variant)
+            fen = board.fen()
+            pool = self.stockfish_pool if variant in engine_pool.STANDARD_VARIANTS else self.fairy_pool
+            with pool.checkout() as pooled:
+                info = pooled.engine.analyse(board, self.limit)
+        except Exception as e:
+            return AnalysisResult(index, variant, fen, None, None, [], 0, 0, f"{type(e).__name__}: {e}")
+        pv = [move.uci() for move in info.get('pv', [])]
+        cp = cp_from_score(info['score']) if 'score' in info else None
+        return AnalysisResult(index, variant, fen, cp, pv[0] if pv else None, pv, info.get('depth', 0),
+                              info.get('nodes', 0), None)
+
+    def run(self, positions, start=0):
+        """
+        Analyse the positions, read from the iterable only as fast as the engines go
+        :param positions: iterable of (FEN or list of uci moves, variant)
+        :param start: number of positions already analysed, skipped (to resume a batch)
+        :return: generator of AnalysisResult, in the order of the positions
+        """
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='analysis') as executor:
+            pending = deque()
+            for index, (position, variant) in enumerate(positions):
+                if index < start:
+                    continue
+                pending.append(executor.submit(self.analyse, index, position, variant))
+                if len(pending) >= self.workers * READ_AHEAD:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def close(self):
+        self.stockfish_pool.close()
+        self.fairy_pool.close()
+
+
+def completed_results(output_path):
+    """
+    Count the results already written to an output file, dropping a last line cut by a crash
+    :return: number of complete results
+    """
+    if not os.path.exists(output_path):
+        return 0
+    with open(output_path, 'rb+') as output:
+        data = output.read()
+        complete = data.rfind(b'\n') + 1
+        if complete < len(data):
+            output.truncate(complete)
+    return data[:complete].count(b'\n')
+
+
+def analyse_to_file(analyzer, positions, output_path):
+    """
+    Analyse the positions and append the results (json lines) to output_path. If the file has results of a previous
+    run of the same batch, those positions are skipped
+    :return: generator of the new AnalysisResult
+    """
+    start = completed_results(output_path)
+    if start:
+        print(f"Resuming after {start} positions")
+    with open(output_path, 'a') as output:
+        for result in analyzer.run(positions, start):
+            output.write(json.dumps(result._asdict()) + '\n')
+            output.flush()
+            yield result
+
+
+def pgn_positions(pgn):
+    """
+    Yield (FEN, variant) of every position of every game of a PGN, before each move
+    :param pgn: text file of the PGN
+    """
+    while True:
+        game = chess.pgn.read_game(pgn)
+        if game is None:
+            return
+        board = game.board()
+        variant = 'chess960' if board.chess960 else LICHESS_VARIANTS.get(board.uci_variant, 'standard')
+        for move in game.mainline_moves():
+            yield board.fen(), variant
+            board.push(move)
+
+
+def read_positions(path):
+    """
+    Yield the (FEN, variant) of a PGN file, of the games of a game archive (file or folder), or of a text file with
+    one position per line (FEN, or variant and FEN separated by a tab)
+    """
+    path = Path(path)
+    if path.is_dir() or path.suffix == game_archive.SUFFIX:
+        for record in game_archive.read_records(path, types=(game_archive.GAME_END,)):
+            yield from pgn_positions(io.StringIO(record.pgn))
+    elif path.suffix == '.pgn':
+        with open(path, encoding='utf-8', errors='replace') as pgn:
+            yield from pgn_positions(pgn)
+    else:
+        with open(path) as lines:
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                variant, _, fen = line.rpartition('\t')
+                yield fen, variant or 'standard'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse many positions on all the CPU cores, the results are "
+                                                 "written as json lines and a stopped batch resumes where it was")
+    parser.add_argument('input', help="PGN, game archive (file or folder) or text file of FEN (variant<TAB>FEN)")
+    parser.add_argument('--output', help="results file (default: input.analysis.jsonl)")
+    parser.add_argument('--depth', type=int, help=f"depth of every position (default {DEFAULT_DEPTH} without --nodes)")
+    parser.add_argument('--nodes', type=int, help="nodes of every position")
+    parser.add_argument('--workers', type=int, help="engines at the same time (default: CPU count)")
+    parser.add_argument('--config', default=str(THIS_FOLDER / "config.yml"), help="bot config with the engine paths")
+    args = parser.parse_args()
+
+    config = {}
+    if os.path.exists(args.config):
+        with open(args.config) as config_file:
+            config = yaml.safe_load(config_file) or {}
+    analyzer = BatchAnalyzer(config.get('stockfish_path', engine_pool.DEFAULT_STOCKFISH_PATH),
+                             config.get('fairy_stockfish_path', engine_pool.DEFAULT_FAIRY_PATH),
+                             args.workers, args.depth, args.nodes)
+    output_path = args.output or f"{args.input.rstrip('/')}.analysis.jsonl"
+    start = time.monotonic()
+    analysed = 0
+    try:
+        for result in analyse_to_file(analyzer, read_positions(args.input), output_path):
+            analysed += 1
+            if result.error:
+                print(f"Position {result.index}: {result.error}")
+            if analysed % 1000 == 0:
+                print(f"{analysed} positions, {analysed / (time.monotonic() - start):.1f}/s")
+    finally:
+        analyzer.close()
+    elapsed = time.monotonic() - start
+    print(f"{analysed} positions analysed in {elapsed:.1f}s ({analysed / elapsed if elapsed else 0:.1f}/s) "
+          f"to {output_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import chess.pgn
+import yaml
+
+from fake_lichess import FakeGame, FakeLichess
+
+
+THIS_FOLDER = Path(__file__).parent.resolve()
+
+
+def percentile(values, share):
+    """
+    :param values: list of numbers
+    :param share: 0-1 (0.5 for the median)
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def load_games(pgn_path, limit):
+    """
+    :return: list of the moves (uci) of the main line of every game of the pgn
+    """
+    games = []
+    with open(pgn_path, encoding='utf-8', errors='replace') as pgn:
+        while len(games) < limit:
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            games.append([move.uci() for move in game.mainline_moves()])
+    return games
+
+
+def run_level(concurrency, args, recorded):
+    """
+    Play concurrency games at the same time against the fake server, with the real bot in its own process
+    :return: dict of results
+    """
+    games = [FakeGame(f"bench{concurrency:03d}{n:03d}", 'white' if n % 2 == 0 else 'black', args.clock,
+                      args.increment, args.plies, recorded[n % len(recorded)] if recorded else None, seed=n,
+                      opponent_time=args.opponent_time, opponent_elo=args.opponent_elo)
+             for n in range(concurrency)]
+    lichess = FakeLichess(games)
+    lichess.start()
+
+    # Same config of the bot, on the fake server and without Telegram
+    config = {}
+    if args.config and os.path.exists(args.config):
+        with open(args.config) as config_file:
+            config = yaml.safe_load(config_file) or {}
+    config.update({'token': 'bench', 'tg_token': '', 'tg_myid': 0, 'lichess_url': lichess.url})
+    config.pop('metrics_port', None)
+    # Files of the bot in a folder of this run: the live bot archive, cache, settings and ready file aren't touched
+    run_folder = Path(tempfile.mkdtemp(prefix=f"zoe-bench-{concurrency}-"))
+    config.update({'archive_dir': str(run_folder / "archive"), 'ready_file': str(run_folder / "ready"),
+                   'settings_csv': str(run_folder / "Settings.csv")})
+    if config.get('eval_cache_db'):
+        config['eval_cache_db'] = str(run_folder / "eval_cache.db")
+    # The measured strength table is played with, as a copy
+    strength_path = Path(config.get('strength_table', THIS_FOLDER / "../database/strength_table.json"))
+    if strength_path.exists():
+        shutil.copy(strength_path, run_folder / "strength_table.json")
+    config['strength_table'] = str(run_folder / "strength_table.json")
+    if args.elo_mode:
+        config['elo_mode'] = True
+    with tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False) as config_file:
+        yaml.safe_dump(config, config_file)
+    log_path = Path(args.log_dir) / f"bench_{concurrency}.log"
+
+    start = time.monotonic()
+    # CPU of the bot and of its engines (children of the bot, counted when it waits for them)
+    cpu_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open(log_path, 'w') as log:
+        bot = subprocess.Popen([sys.executable, str(THIS_FOLDER / "newrunzoe.py")], cwd=THIS_FOLDER,
+                               env=dict(os.environ, ZOE_CONFIG=config_file.name, PYTHONUNBUFFERED='1'),
+                               stdout=log, stderr=subprocess.STDOUT)
+        try:
+            while not lichess.all_finished() and time.monotonic() - start < args.timeout:
+                if bot.poll() is not None:
+                    print(f"Bot exited with {bot.returncode}, see {log_path}")
+                    break
+                time.sleep(0.2)
+        finally:
+            bot.terminate()
+            try:
+                bot.wait(10)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+            lichess.stop()
+            os.remove(config_file.name)
+            shutil.rmtree(run_folder, ignore_errors=True)
+    cpu_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = cpu_end.ru_utime + cpu_end.ru_stime - cpu_start.ru_utime - cpu_start.ru_stime
+
+    latencies = [latency for game in games for latency in game.latencies]
+    moves = len(latencies)
+    started = [game.start_time for game in games if game.start_time is not None]
+    ended = [game.end_time or time.monotonic() for game in games if game.start_time is not None]
+    play_time = max(ended) - min(started) if started else 0
+    api_calls = sum(calls for name, calls in lichess.calls.items())
+    return {
+        'games': concurrency,
+        'finished': sum(game.status != 'started' for game in games),
+        'moves': moves,
+        'moves_per_sec': moves / play_time if play_time else 0,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'api_per_move': api_calls / moves if moves else 0,
+        'flag_rate': sum(game.is_flagged() for game in games) / concurrency,
+        'cpu_per_move': cpu_time / moves if moves else 0,
+        'calls': dict(lichess.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure throughput and move latency of the bot against a local "
+                                                 "fake Lichess server")
+    parser.add_argument('--games', type=int, nargs='+', default=[1, 10, 50], help="games at the same time")
+    parser.add_argument('--clock', type=float, default=60, help="initial clock (s)")
+    parser.add_argument('--increment', type=float, default=0, help="increment (s)")
+    parser.add_argument('--plies', type=int, default=60, help="a game is a draw after these plies")
+    parser.add_argument('--opponent-time', type=float, default=0.5, help="seconds used by the opponent per move")
+    parser.add_argument('--opponent-elo', type=int, default=1500, help="rating of the opponent")
+    parser.add_argument('--elo-mode', action='store_true', help="play in the UCI_Elo strength mode")
+    parser.add_argument('--pgn', help="recorded games replayed by the opponent (random moves if not given)")
+    parser.add_argument('--config', default=str(THIS_FOLDER / "config.yml"),
+                        help="bot config to use (tokens and Telegram are replaced)")
+    parser.add_argument('--timeout', type=float, default=900, help="max seconds of every level")
+    parser.add_argument('--log-dir', default=tempfile.gettempdir(), help="folder of the bot logs")
+    args = parser.parse_args()
+
+    recorded = load_games(args.pgn, max(args.games)) if args.pgn else []
+    results = []
+    for concurrency in args.games:
+        print(f"Playing {concurrency} games...")
+        result = run_level(concurrency, args, recorded)
+        print(f"  {result['calls']}")
+        results.append(result)
+
+    print(f"{'games':>6} {'finished':>8} {'moves':>6} {'moves/s':>8} {'p50 s':>7} {'p99 s':>7} {'api/move':>8} "
+          f"{'flags':>6} {'cpu/move':>8}")
+    for result in results:
+        print(f"{result['games']:>6} {result['finished']:>8} {result['moves']:>6} {result['moves_per_sec']:>8.2f} "
+              f"{result['p50']:>7.3f} {result['p99']:>7.3f} {result['api_per_move']:>8.2f} "
+              f"{result['flag_rate']:>6.0%} {result['cpu_per_move']:>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
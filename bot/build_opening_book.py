@@ -0,0 +1,250 @@
+import argparse
+import csv
+import heapq
+import io
+import struct
+import tempfile
+from pathlib import Path
+
+import chess
+import chess.pgn
+import chess.polyglot
+
+import opening_book
+
+
+THIS_FOLDER = Path(__file__).parent.resolve()
+# Record of a chunk file: zobrist key, encoded move, games, sum of the Elo of the players
+CHUNK_ENTRY = struct.Struct('<QHIQ')
+# Moves counted in memory before they are written to a sorted chunk file (about 200 bytes each)
+CHUNK_MOVES = 5_000_000
+
+
+class OpeningVisitor(chess.pgn.BaseVisitor):
+    """
+    Read only headers and the first moves of the main line of a game
+    """
+    def __init__(self, max_plies):
+        self.max_plies = max_plies
+
+    def begin_game(self):
+        self.headers = {}
+        self.moves = []
+        self.broken = False
+
+    def visit_header(self, tagname, tagvalue):
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def begin_parse_san(self, board, san):
+        # The moves after max_plies (and after an error) are not parsed
+        if self.broken or len(self.moves) >= self.max_plies:
+            return chess.pgn.SKIP
+
+    def visit_move(self, board, move):
+        self.moves.append(move)
+
+    def handle_error(self, error):
+        # Broken games are skipped
+        self.moves = []
+        self.broken = True
+
+    def result(self):
+        return self.headers, self.moves
+
+
+def open_pgn(path):
+    """
+    :param path: .pgn or .pgn.zst file (zst needs the zstandard package)
+    :return: text handle streaming the games
+    """
+    if str(path).endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise SystemExit("Reading .zst files needs zstandard: pip install zstandard")
+        stream = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+        return io.TextIOWrapper(stream, encoding='utf-8', errors='replace')
+    return open(path, encoding='utf-8', errors='replace')
+
+
+def load_openings(paths):
+    """
+    Read the Lichess openings tsv files (columns eco, name, pgn)
+    :return: dict of zobrist key of the last position of the line: opening name
+    """
+    openings = {}
+    for path in paths:
+        with open(path, newline='', encoding='utf-8') as tsv_file:
+            for row in csv.DictReader(tsv_file, delimiter='\t'):
+                game = chess.pgn.read_game(io.StringIO(row['pgn']))
+                if game is None:
+                    continue
+                board = game.end().board()
+                openings[chess.polyglot.zobrist_hash(board)] = f"{row['eco']} {row['name']}"
+    return openings
+
+
+def write_chunk(path, positions):
+    """
+    Write the counted moves sorted by (key, move)
+    """
+    with open(path, 'wb') as chunk_file:
+        for key in sorted(positions):
+            moves = positions[key]
+            for move in sorted(moves):
+                count, elo_sum = moves[move]
+                chunk_file.write(CHUNK_ENTRY.pack(key, move, count, elo_sum))
+
+
+def read_chunk(path):
+    """
+    :return: generator of the (key, move, games, elo sum) records of a chunk file
+    """
+    with open(path, 'rb') as chunk_file:
+        while True:
+            data = chunk_file.read(CHUNK_ENTRY.size * 4096)
+            if not data:
+                break
+            yield from CHUNK_ENTRY.iter_unpack(data)
+
+
+def merge_chunks(paths, min_games):
+    """
+    Merge the sorted chunk files, adding up the counts of a move found in several chunks
+    :return: dict of zobrist key: {encoded move: [games, elo sum]} of the moves played at least min_games times
+    """
+    positions = {}
+    last = None
+    for key, move, count, elo_sum in heapq.merge(*(read_chunk(path) for path in paths)):
+        if last is not None and last[0] == key and last[1] == move:
+            last[2] += count
+            last[3] += elo_sum
+            continue
+        if last is not None and last[2] >= min_games:
+            positions.setdefault(last[0], {})[last[1]] = last[2:]
+        last = [key, move, count, elo_sum]
+    if last is not None and last[2] >= min_games:
+        positions.setdefault(last[0], {})[last[1]] = last[2:]
+    return positions
+
+
+def import_games(pgn_path, max_plies, min_elo, min_games=1, chunk_moves=CHUNK_MOVES):
+    """
+    Count the moves played in every position of the first plies of the games.
+    The counts are written to sorted chunk files every chunk_moves moves and merged at the end, so the memory
+    stays bounded by the chunk and the moves kept
+    :return: dict of zobrist key: {encoded move: [games, sum of the Elo of the players]} of the moves played at
+    least min_games times, number of games read
+    """
+    positions = {}
+    counted = 0
+    games = 0
+    chunk_folder = tempfile.TemporaryDirectory(prefix='zoe-book-')
+    chunks = []
+
+    def flush():
+        nonlocal positions, counted
+        chunks.append(Path(chunk_folder.name) / f"chunk{len(chunks)}.bin")
+        write_chunk(chunks[-1], positions)
+        positions = {}
+        counted = 0
+
+    with chunk_folder, open_pgn(pgn_path) as pgn:
+        while True:
+            result = chess.pgn.read_game(pgn, Visitor=lambda: OpeningVisitor(max_plies))
+            if result is None:
+                break
+            headers, moves = result
+            if headers.get('Variant', 'Standard') != 'Standard' or 'FEN' in headers:
+                continue
+            try:
+                elos = {chess.WHITE: int(headers['WhiteElo']), chess.BLACK: int(headers['BlackElo'])}
+            except (KeyError, ValueError):
+                continue
+            if min(elos.values()) < min_elo:
+                continue
+            games += 1
+            board = chess.Board()
+            for move in moves:
+                counts = positions.setdefault(chess.polyglot.zobrist_hash(board), {})
+                encoded = opening_book.encode_move(move)
+                if encoded not in counts:
+                    counts[encoded] = [0, 0]
+                    counted += 1
+                counts[encoded][0] += 1
+                counts[encoded][1] += elos[board.turn]
+                board.push(move)
+            if counted >= chunk_moves:
+                flush()
+            if games % 100000 == 0:
+                print(f"{games} games, {len(chunks)} chunks, {len(positions)} positions in memory")
+        flush()
+        return merge_chunks(chunks, min_games), games
+
+
+def build_book(positions, openings, min_games):
+    """
+    Keep the moves played at least min_games times, with the opening name of the position they lead to
+    :return: positions for opening_book.write_book, list of names
+    """
+    names = []
+    name_index = {}
+    book = {}
+    for key, moves in positions.items():
+        board_moves = {}
+        for move, (count, elo_sum) in moves.items():
+            if count < min_games:
+                continue
+            board_moves[move] = (count, round(elo_sum / count), opening_book.NO_NAME)
+        if board_moves:
+            book[key] = board_moves
+    if openings:
+        # The names need the position after the move: replay the book from the start position.
+        # A position not in the openings keeps the name of the line it comes from
+        stack = [(chess.Board(), None)]
+        seen = set()
+        while stack:
+            board, parent_name = stack.pop()
+            key = chess.polyglot.zobrist_hash(board)
+            if key in seen or key not in book:
+                continue
+            seen.add(key)
+            for move, (count, elo, _) in book[key].items():
+                child = board.copy(stack=False)
+                child.push(opening_book.decode_move(move))
+                name = openings.get(chess.polyglot.zobrist_hash(child), parent_name)
+                if name is not None:
+                    if name not in name_index and len(names) < opening_book.NO_NAME:
+                        name_index[name] = len(names)
+                        names.append(name)
+                    book[key][move] = (count, elo, name_index.get(name, opening_book.NO_NAME))
+                stack.append((child, name))
+    return book, names
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the opening book of the bot from a Lichess games database")
+    parser.add_argument('pgn', help=".pgn or .pgn.zst file (database.lichess.org)")
+    parser.add_argument('-o', '--output', default=THIS_FOLDER / "../database/OpeningBook.bin",
+                        help="book file to write")
+    parser.add_argument('--plies', type=int, default=16, help="plies of every game to read")
+    parser.add_argument('--min-elo', type=int, default=1800, help="min Elo of both players")
+    parser.add_argument('--min-games', type=int, default=5, help="min games of a move to keep it")
+    parser.add_argument('--chunk-moves', type=int, default=CHUNK_MOVES,
+                        help="moves counted in memory before they are written to a temporary file")
+    parser.add_argument('--openings', nargs='*', default=[],
+                        help="Lichess chess-openings tsv files (a.tsv ... e.tsv) for the opening names")
+    args = parser.parse_args()
+
+    openings = load_openings(args.openings)
+    positions, games = import_games(args.pgn, args.plies, args.min_elo, args.min_games, args.chunk_moves)
+    book, names = build_book(positions, openings, args.min_games)
+    opening_book.write_book(args.output, book, names)
+    print(f"{games} games: {sum(len(moves) for moves in book.values())} moves written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
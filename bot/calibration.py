@@ -0,0 +1,491 @@
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import util
+from pathlib import Path
+
+import chess
+import chess.engine
+import yaml
+
+import engine_pool
+import strength_table
+from strength_table import EloLevel, Level
+
+
+THIS_FOLDER = Path(__file__).parent.resolve()
+# Balanced openings of the matches (SAN moves from the starting position), every one is played twice with the
+# colors swapped
+OPENINGS = (
+    "e4 e5 Nf3 Nc6 Bb5 a6",
+    "e4 e5 Nf3 Nc6 Bc4 Bc5",
+    "e4 c5 Nf3 d6 d4 cxd4 Nxd4 Nf6 Nc3 a6",
+    "e4 e6 d4 d5 Nc3 Nf6",
+    "e4 c6 d4 d5 e5 Bf5",
+    "e4 d5 exd5 Qxd5 Nc3 Qa5",
+    "d4 d5 c4 e6 Nc3 Nf6",
+    "d4 d5 c4 c6 Nf3 Nf6",
+    "d4 Nf6 c4 g6 Nc3 Bg7 e4 d6",
+    "d4 Nf6 c4 e6 Nc3 Bb4",
+    "c4 e5 Nc3 Nf6 Nf3 Nc6",
+    "Nf3 d5 g3 Nf6 Bg2 e6",
+)
+# Strength modes of the bot and the settings of each one: Skill Level, depth and threads, or UCI_Elo with a node
+# budget
+MODES = {'skill': Level, 'uci_elo': EloLevel}
+# Think time of the anchor (s)
+ANCHOR_TIME = 0.5
+# Target Elo of the strongest level (the one without max Elo)
+TOP_TARGET = 2800
+# A game is a draw after MAX_PLIES, and won when both engines see one side ahead by ADJUDICATE_CP for
+# ADJUDICATE_PLIES plies in a row
+MAX_PLIES = 300
+ADJUDICATE_CP = 1000
+ADJUDICATE_PLIES = 8
+# SPRT of every setting: Elo difference to its target of H0 and H1, false positive and false negative rates
+SPRT_ELO0, SPRT_ELO1 = -50, 50
+SPRT_ALPHA = SPRT_BETA = 0.05
+# Max games of a setting when the SPRT doesn't decide, and games before it can decide (its normal approximation
+# is wrong on a few games)
+MAX_GAMES = 200
+MIN_GAMES = 16
+# Measured settings whose Elo is this close to the target of a level can be picked for it
+LEVEL_TOLERANCE = 100
+
+
+def expected_score(elo_difference):
+    return 1 / (1 + 10 ** (-elo_difference / 400))
+
+
+def elo_from_score(score):
+    """
+    :param score: mean score (0-1)
+    :return: Elo difference (capped when the score is 0 or 1)
+    """
+    score = min(max(score, 0.001), 0.999)
+    return -400 * math.log10(1 / score - 1)
+
+
+def score_stats(wins, draws, losses):
+    """
+    :return: mean and variance of the score of one game. The variance counts one more game of each result, else a
+    few games with the same result have no variance (and a certain Elo)
+    """
+    games = wins + draws + losses
+    mean = (wins + draws / 2) / games
+    prior_mean = (wins + 1 + (draws + 1) / 2) / (games + 3)
+    return mean, (wins + 1 + (draws + 1) / 4) / (games + 3) - prior_mean ** 2
+
+
+def elo_interval(wins, draws, losses):
+    """
+    :return: Elo difference and its 95% error
+    """
+    games = wins + draws + losses
+    mean, variance = score_stats(wins, draws, losses)
+    error = 1.96 * math.sqrt(variance / games)
+    return elo_from_score(mean), (elo_from_score(mean + error) - elo_from_score(mean - error)) / 2
+
+
+def sprt_llr(wins, draws, losses, elo0, elo1):
+    """
+    Log likelihood ratio of H1 (Elo difference elo1) against H0 (elo0), normal approximation of the game scores
+    (GSPRT)
+    """
+    games = wins + draws + losses
+    if not games:
+        return 0.0
+    mean, variance = score_stats(wins, draws, losses)
+    score0, score1 = expected_score(elo0), expected_score(elo1)
+    return (score1 - score0) * (2 * mean - score0 - score1) * games / (2 * variance)
+
+
+# Engines of a worker process (candidate and anchor) and the settings of the calibration
+_engines = {}
+_settings = {}
+
+
+def _init_worker(settings):
+    _settings.update(settings)
+    util.Finalize(None, _close_engines, exitpriority=10)
+
+
+def _close_engines():
+    for engine in _engines.values():
+        try:
+            engine.quit()
+        except Exception:
+            engine.close()
+    _engines.clear()
+
+
+def _engine(role):
+    if role not in _engines:
+        _engines[role] = chess.engine.SimpleEngine.popen_uci(_settings['stockfish_path'])
+    return _engines[role]
+
+
+def opening_board(opening):
+    """
+    :param opening: FEN or SAN moves from the starting position
+    """
+    if '/' in opening:
+        return chess.Board(opening)
+    board = chess.Board()
+    for san in opening.split():
+        board.push_san(san)
+    return board
+
+
+def mode_of(level):
+    return 'uci_elo' if isinstance(level, EloLevel) else 'skill'
+
+
+def play_game(level, anchor_elo, opening, candidate_color):
+    """
+    Play a game of the candidate settings against Stockfish limited to anchor_elo
+    :param level: Level or EloLevel (UCI_Elo mode at the Elo of the anchor) of the candidate
+    :return: score of the candidate (1, 0.5, 0), its moves and its CPU seconds (search time * threads)
+    """
+    candidate = _engine('candidate')
+    anchor = _engine('anchor')
+    if mode_of(level) == 'uci_elo':
+        candidate.configure({"Skill Level": 20, "UCI_LimitStrength": True, "UCI_Elo": anchor_elo,
+                             "Threads": level.threads_m, "Hash": level.hash_m})
+        candidate_limit = chess.engine.Limit(nodes=level.nodes)
+    else:
+        candidate.configure({"Skill Level": level.skill_level, "UCI_LimitStrength": False,
+                             "Threads": level.threads_m, "Hash": level.hash_m})
+        candidate_limit = chess.engine.Limit(time=level.deep_time, depth=level.depth)
+    anchor.configure({"UCI_LimitStrength": True, "UCI_Elo": anchor_elo, "Threads": 1, "Hash": 16})
+    anchor_limit = chess.engine.Limit(time=_settings.get('anchor_time', ANCHOR_TIME))
+    board = opening_board(opening)
+    # New game for the engines (ucinewgame)
+    game = object()
+    moves = 0
+    cpu_time = 0.0
+    # Evaluations (white side) of the last plies
+    evaluations = []
+    while not board.is_game_over(claim_draw=True) and board.ply() < MAX_PLIES:
+        is_candidate = board.turn == candidate_color
+        search_start = time.perf_counter()
+        result = (candidate if is_candidate else anchor).play(
+            board, candidate_limit if is_candidate else anchor_limit, game=game, info=chess.engine.INFO_SCORE)
+        if is_candidate:
+            moves += 1
+            cpu_time += (time.perf_counter() - search_start) * level.threads_m
+        if result.move is None:
+            # No move: the engine resigned
+            return (0.0 if is_candidate else 1.0), moves, cpu_time
+        board.push(result.move)
+        score = result.info.get('score')
+        evaluations.append(None if score is None else score.white().score(mate_score=100000))
+        last = evaluations[-ADJUDICATE_PLIES:]
+        if len(last) == ADJUDICATE_PLIES and None not in last:
+            if min(last) >= ADJUDICATE_CP or max(last) <= -ADJUDICATE_CP:
+                white_wins = min(last) >= ADJUDICATE_CP
+                return float(white_wins == (candidate_color == chess.WHITE)), moves, cpu_time
+    outcome = board.outcome(claim_draw=True)
+    if outcome is None or outcome.winner is None:
+        return 0.5, moves, cpu_time
+    return float(outcome.winner == candidate_color), moves, cpu_time
+
+
+def play_pair(level, anchor_elo, opening):
+    """
+    Play an opening with both colors (task of a worker process)
+    :return: list of the 2 scores of the candidate, its moves and CPU seconds
+    """
+    scores = []
+    moves = 0
+    cpu_time = 0.0
+    for color in (chess.WHITE, chess.BLACK):
+        score, game_moves, game_cpu_time = play_game(level, anchor_elo, opening, color)
+        scores.append(score)
+        moves += game_moves
+        cpu_time += game_cpu_time
+    return scores, moves, cpu_time
+
+
+class Match:
+    """
+    Games of one candidate setting against the anchor of its target Elo, and its SPRT
+    """
+    def __init__(self, level, target, max_games, elo0, elo1, alpha, beta):
+        """
+        :param level: Level or EloLevel of the candidate
+        :param target: Elo the setting should play at
+        """
+        self.level = level
+        self.target = target
+        # Stockfish plays at a given Elo only in the UCI_Elo range, the anchors of the lower levels are the weakest
+        self.anchor_elo = min(strength_table.UCI_MAX_ELO, max(strength_table.UCI_MIN_ELO, target))
+        self.max_games = max_games
+        # Hypotheses on the difference to the anchor (the target can be out of the range of the anchors)
+        self.elo0 = target - self.anchor_elo + elo0
+        self.elo1 = target - self.anchor_elo + elo1
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+        self.wins = self.draws = self.losses = 0
+        self.moves = 0
+        self.cpu_time = 0.0
+        self.llr = 0.0
+        self.pending = 0
+        self.pairs = 0
+        self.error = None
+
+    @property
+    def games(self):
+        return self.wins + self.draws + self.losses
+
+    def add(self, scores, moves, cpu_time):
+        for score in scores:
+            if score == 1:
+                self.wins += 1
+            elif score == 0:
+                self.losses += 1
+            else:
+                self.draws += 1
+        self.moves += moves
+        self.cpu_time += cpu_time
+        self.llr = sprt_llr(self.wins, self.draws, self.losses, self.elo0, self.elo1)
+
+    def verdict(self):
+        """
+        :return: 'stronger' or 'weaker' than the target if the SPRT decided, None if not yet
+        """
+        if self.games < min(MIN_GAMES, self.max_games):
+            return None
+        if self.llr >= self.upper:
+            return 'stronger'
+        if self.llr <= self.lower:
+            return 'weaker'
+        return None
+
+    def wants_games(self):
+        return self.error is None and self.verdict() is None and self.games + 2 * self.pending < self.max_games
+
+    def done(self):
+        return not self.pending and not self.wants_games()
+
+    def result(self):
+        """
+        :return: dict of the setting, its measured Elo and CPU seconds per move
+        """
+        elo = elo_error = None
+        if self.games:
+            difference, elo_error = elo_interval(self.wins, self.draws, self.losses)
+            elo = round(self.anchor_elo + difference)
+            elo_error = round(elo_error)
+        return {'mode': mode_of(self.level), **self.level._asdict(), 'target': self.target,
+                'anchor_elo': self.anchor_elo, 'games': self.games,
+                'wins': self.wins, 'draws': self.draws, 'losses': self.losses, 'elo': elo, 'elo_error': elo_error,
+                'llr': round(self.llr, 2), 'verdict': self.error or self.verdict() or 'inconclusive',
+                'cpu_per_move': self.cpu_time / self.moves if self.moves else None}
+
+
+def calibrate(candidates, stockfish_path, workers=None, openings=OPENINGS, anchor_time=ANCHOR_TIME,
+              max_games=MAX_GAMES, elo0=SPRT_ELO0, elo1=SPRT_ELO1, alpha=SPRT_ALPHA, beta=SPRT_BETA):
+    """
+    Play every candidate against Stockfish limited to its target Elo, game pairs of fixed openings on a pool of
+    processes, until its SPRT decides or max_games are played
+    :param candidates: list of (Level or EloLevel, target Elo)
+    :param workers: games at the same time (default: CPU count)
+    :return: generator of the result dict of every candidate, when it's done
+    """
+    workers = workers or os.cpu_count() or 1
+    matches = [Match(level, target, max_games, elo0, elo1, alpha, beta) for level, target in candidates]
+    settings = {'stockfish_path': str(stockfish_path), 'anchor_time': anchor_time}
+    running = {}
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker,
+                             initargs=(settings,)) as executor:
+        while True:
+            # Keep every worker busy, the candidates with less games first
+            while len(running) < workers * 2:
+                waiting = [match for match in matches if match.wants_games()]
+                if not waiting:
+                    break
+                match = min(waiting, key=lambda candidate: candidate.games + 2 * candidate.pending)
+                opening = openings[match.pairs % len(openings)]
+                match.pairs += 1
+                match.pending += 1
+                running[executor.submit(play_pair, match.level, match.anchor_elo, opening)] = match
+            if not running:
+                return
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                match = running.pop(future)
+                match.pending -= 1
+                try:
+                    match.add(*future.result())
+                except Exception as e:
+                    print(f"Games of {match.level} failed: {type(e).__name__}: {e}")
+                    match.error = 'error'
+                if match.done():
+                    yield match.result()
+
+
+def default_candidates(max_threads, modes=tuple(MODES)):
+    """
+    Settings of the built-in levels, and the same ones with 1 thread, less hash or half the think time (cheaper,
+    if they are as strong). In the UCI_Elo mode, the node budget of every level, half and twice it
+    :param max_threads: threads of the machine, no candidate uses more
+    :param modes: strength modes to calibrate
+    :return: list of (Level or EloLevel, target Elo)
+    """
+    candidates = []
+    for max_elo, level in strength_table.DEFAULT_LEVELS:
+        target = max_elo or TOP_TARGET
+        variants = ()
+        if 'skill' in modes:
+            level = level._replace(threads_m=min(level.threads_m, max_threads))
+            variants += (level, level._replace(threads_m=1),
+                         level._replace(threads_m=1, hash_m=min(level.hash_m, 64)),
+                         level._replace(threads_m=1, deep_time=level.deep_time / 2))
+        if 'uci_elo' in modes:
+            elo_level = strength_table.elo_level_for(target)
+            elo_level = elo_level._replace(threads_m=min(elo_level.threads_m, max_threads))
+            variants += (elo_level, elo_level._replace(nodes=elo_level.nodes // 2),
+                         elo_level._replace(nodes=elo_level.nodes * 2))
+        candidates += [(variant, target) for variant in dict.fromkeys(variants)]
+    return candidates
+
+
+def select_levels(results, mode):
+    """
+    Settings of a strength mode for every level of DEFAULT_LEVELS: the cheapest (CPU seconds per move) of the
+    measured settings within LEVEL_TOLERANCE of the highest Elo of the level, the closest one if none is
+    :param results: result dicts of calibrate()
+    :param mode: 'skill' or 'uci_elo'
+    :return: list of level dicts, empty if no setting of the mode was measured
+    """
+    measured = [result for result in results if result['mode'] == mode and result['elo'] is not None
+                and result['cpu_per_move'] is not None]
+    if not measured:
+        return []
+    levels = []
+    for max_elo, _ in strength_table.DEFAULT_LEVELS:
+        target = max_elo or TOP_TARGET
+        close = [result for result in measured if abs(result['elo'] - target) <= LEVEL_TOLERANCE]
+        if close:
+            best = min(close, key=lambda result: result['cpu_per_move'])
+        else:
+            best = min(measured, key=lambda result: abs(result['elo'] - target))
+        levels.append({'max_elo': max_elo, **{field: best[field] for field in MODES[mode]._fields},
+                       'elo': best['elo'], 'cpu_per_move': best['cpu_per_move']})
+    return levels
+
+
+def compare_modes(results):
+    """
+    :return: lines of the measured Elo and CPU seconds per move of both modes at every level
+    """
+    skill_levels = select_levels(results, 'skill')
+    elo_levels = select_levels(results, 'uci_elo')
+    lines = []
+    for skill, elo in zip(skill_levels, elo_levels):
+        ratio = (f"{elo['cpu_per_move'] / skill['cpu_per_move']:.0%} of the CPU" if skill['cpu_per_move']
+                 else "")
+        lines.append(f"Level up to {skill['max_elo'] or TOP_TARGET} Elo: Skill Level {skill['elo']} Elo "
+                     f"{skill['cpu_per_move']:.3f} CPU s/move, UCI_Elo {elo['elo']} Elo "
+                     f"{elo['cpu_per_move']:.3f} CPU s/move {ratio}")
+    return lines
+
+
+def write_table(path, results, anchor_time):
+    """
+    Write the strength table loaded by the bot (strength_table.configure)
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    table = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'anchor_time': anchor_time,
+             'levels': select_levels(results, 'skill'), 'elo_levels': select_levels(results, 'uci_elo'),
+             'results': results}
+    temp_path = path.with_suffix('.tmp')
+    with open(temp_path, 'w') as table_file:
+        json.dump(table, table_file, indent=2)
+    os.replace(temp_path, path)
+
+
+def _values(text, kind):
+    return [kind(value) for value in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the strength of engine settings by self-play against "
+                                                 "Stockfish at a given Elo and write the table of the bot levels")
+    parser.add_argument('--output', help="strength table (default: strength_table of config.yml)")
+    parser.add_argument('--workers', type=int, help="games at the same time (default: CPU count)")
+    parser.add_argument('--games', type=int, default=MAX_GAMES, help="max games of a setting")
+    parser.add_argument('--anchor-time', type=float, default=ANCHOR_TIME, help="think time of the anchor (s)")
+    parser.add_argument('--openings', help="file of openings, one per line (SAN moves or FEN)")
+    parser.add_argument('--elo0', type=float, default=SPRT_ELO0, help="SPRT H0: Elo difference to the target")
+    parser.add_argument('--elo1', type=float, default=SPRT_ELO1, help="SPRT H1: Elo difference to the target")
+    parser.add_argument('--alpha', type=float, default=SPRT_ALPHA)
+    parser.add_argument('--beta', type=float, default=SPRT_BETA)
+    parser.add_argument('--mode', choices=('skill', 'uci_elo', 'both'), default='both',
+                        help="strength modes of the built-in levels to calibrate")
+    # Grid of settings instead of the built-in levels (every combination is played)
+    parser.add_argument('--time', help="think times (s), comma separated")
+    parser.add_argument('--skill', help="skill levels")
+    parser.add_argument('--depth', help="depths")
+    parser.add_argument('--threads', help="threads")
+    parser.add_argument('--hash', help="hash sizes (MB)")
+    parser.add_argument('--nodes', help="node budgets of the UCI_Elo mode (played with --threads and --hash)")
+    parser.add_argument('--target', type=int, default=2000, help="target Elo of the grid settings")
+    parser.add_argument('--config', default=str(THIS_FOLDER / "config.yml"), help="bot config with the engine path")
+    args = parser.parse_args()
+
+    config = {}
+    if os.path.exists(args.config):
+        with open(args.config) as config_file:
+            config = yaml.safe_load(config_file) or {}
+    output = args.output or config.get('strength_table', THIS_FOLDER / "../database/strength_table.json")
+    max_threads = os.cpu_count() or 1
+    threads = [min(value, max_threads) for value in _values(args.threads, int)] if args.threads else [1]
+    if any((args.time, args.skill, args.depth, args.threads, args.hash, args.nodes)):
+        candidates = []
+        if args.nodes:
+            grid = itertools.product(_values(args.nodes, int), threads,
+                                     _values(args.hash, int) if args.hash else [16])
+            candidates += [(level, args.target) for level in dict.fromkeys(EloLevel(*values) for values in grid)]
+        if args.time or args.skill or args.depth or not args.nodes:
+            # Missing parameters take the values of the strongest built-in level
+            top = strength_table.DEFAULT_LEVELS[-1][1]
+            grid = itertools.product(_values(args.time, float) if args.time else [top.deep_time],
+                                     _values(args.skill, int) if args.skill else [top.skill_level],
+                                     _values(args.hash, int) if args.hash else [top.hash_m],
+                                     _values(args.depth, int) if args.depth else [top.depth], threads)
+            candidates += [(level, args.target) for level in dict.fromkeys(Level(*values) for values in grid)]
+    else:
+        candidates = default_candidates(max_threads, tuple(MODES) if args.mode == 'both' else (args.mode,))
+    openings = OPENINGS
+    if args.openings:
+        with open(args.openings) as openings_file:
+            openings = [line.strip() for line in openings_file if line.strip()]
+
+    print(f"Calibrating {len(candidates)} settings, up to {args.games} games each")
+    start = time.monotonic()
+    results = []
+    for result in calibrate(candidates, config.get('stockfish_path', engine_pool.DEFAULT_STOCKFISH_PATH),
+                            args.workers, openings, args.anchor_time, args.games, args.elo0, args.elo1,
+                            args.alpha, args.beta):
+        results.append(result)
+        level = MODES[result['mode']](*(result[field] for field in MODES[result['mode']]._fields))
+        print(f"{level}: {result['elo']} +- {result['elo_error']} Elo "
+              f"(target {result['target']}, {result['verdict']}) in {result['games']} games, "
+              f"{result['cpu_per_move'] or 0:.2f} CPU s/move")
+        # The table so far, a stopped calibration keeps what it measured
+        write_table(output, results, args.anchor_time)
+    for line in compare_modes(results):
+        print(line)
+    print(f"Calibration done in {time.monotonic() - start:.0f}s, strength table written to {output}")
+
+
+if __name__ == '__main__':
+    main()
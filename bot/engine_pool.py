@@ -0,0 +1,344 @@
+import platform
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import chess.engine
+
+
+# Path of the engine binaries in the stockfish folder (try both Windows and Linux Paths)
+ENGINES_FOLDER = Path(__file__).parent.resolve() / "../stockfish"
+if platform.system() == 'Windows':
+    DEFAULT_STOCKFISH_PATH = ENGINES_FOLDER / "stockfish-windows-x86-64-avx2.exe"
+    DEFAULT_FAIRY_PATH = ENGINES_FOLDER / "Fairy/Windows/fairy-stockfish-largeboard_x86-64-bmi2.exe"
+else:
+    DEFAULT_STOCKFISH_PATH = ENGINES_FOLDER / "stockfish-ubuntu-x86-64-avx2"
+    DEFAULT_FAIRY_PATH = ENGINES_FOLDER / "Fairy/Linux/fairy-stockfish-largeboard_x86-64-bmi2"
+
+# Variants played by Stockfish, every other variant is played by Fairy-Stockfish
+STANDARD_VARIANTS = ('standard', 'chess960', 'fromPosition')
+
+# Depth of the search run by a new engine at startup
+WARM_UP_DEPTH = 4
+
+# Pools configured at startup by configure_pools()
+stockfish_pool = None
+fairy_pool = None
+
+
+class PooledEngine:
+    """
+    A long-lived UCI engine process owned by an EnginePool.
+    It remembers the options already sent, so Hash/Threads/Skill Level are changed only when they differ
+    """
+    def __init__(self, path, options=None):
+        self.path = path
+        self.engine = chess.engine.SimpleEngine.popen_uci(str(path))
+        self.options = {}
+        # Last game that used this engine (to reuse its hash table on the next move)
+        self.last_game = None
+        # Search running on the opponent's clock (StreamingSearch) and the board it expects after his reply
+        self.ponder = None
+        self.ponder_board = None
+        if options:
+            self.configure(options)
+
+    def configure(self, options):
+        """
+        Send only the options that differ from the current engine state
+        :param options: dict of UCI options (name: value)
+        """
+        changed = {name: value for name, value in options.items() if self.options.get(name) != value}
+        if changed:
+            self.engine.configure(changed)
+            self.options.update(changed)
+
+    def warm_up(self):
+        """
+        Wait until the engine is ready (isready) and run a tiny search, so the network is loaded and evaluated
+        before the first move
+        """
+        self.engine.ping()
+        self.engine.analyse(chess.Board(), chess.engine.Limit(depth=WARM_UP_DEPTH))
+
+    def stop_ponder(self):
+        """
+        Stop and discard the ponder search, if any
+        """
+        if self.ponder is not None:
+            ponder, self.ponder, self.ponder_board = self.ponder, None, None
+            ponder.stop()
+            try:
+                ponder.best_move()
+            except Exception:
+                pass
+
+    def close(self, wait=True):
+        """
+        :param wait: ask the engine to quit, else kill it (a stuck engine doesn't answer quit)
+        """
+        try:
+            if not wait:
+                raise chess.engine.EngineError("killed")
+            self.engine.quit()
+        except Exception:
+            # Engine already dead, make sure the process is gone
+            try:
+                self.engine.close()
+            except Exception:
+                pass
+
+
+class EnginePool:
+    """
+    Pool of long-lived engines of the same binary.
+    Games check out an engine for a search and give it back when done, engines are spawned up to size
+    """
+    def __init__(self, path, size, options=None, max_ponder=1):
+        """
+        :param path: path of the engine binary
+        :param size: max number of engine processes
+        :param options: UCI options to set on every new engine
+        :param max_ponder: max number of engines pondering at the same time
+        """
+        self.path = path
+        self.size = max(1, int(size))
+        self.options = dict(options or {})
+        self.max_ponder = max_ponder
+        self._engines = []
+        self._idle = []
+        self._waiting = 0
+        self._condition = threading.Condition()
+
+    def start(self, count=None, warm_up=False):
+        """
+        Spawn the engines in advance (at the same time), so the first move doesn't pay the startup cost
+        :param count: how many engines to spawn (default: all the pool)
+        :param warm_up: wait until every engine is ready and has searched once (NNUE loaded)
+        """
+        count = self.size if count is None else min(count, self.size)
+        with self._condition:
+            spawn = max(0, count - len(self._engines))
+            # Reserve the slots before spawning outside the lock
+            self._engines.extend([None] * spawn)
+
+        errors = []
+
+        def spawn_one():
+            try:
+                pooled = self._spawn_reserved()
+            except Exception as e:
+                errors.append(e)
+                return
+            try:
+                if warm_up:
+                    pooled.warm_up()
+            except Exception as e:
+                errors.append(e)
+                self._discard(pooled)
+                return
+            with self._condition:
+                self._idle.append(pooled)
+                self._condition.notify()
+
+        threads = [threading.Thread(target=spawn_one, name='engine-spawn', daemon=True) for _ in range(spawn)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _spawn_reserved(self):
+        """
+        Spawn an engine for a slot already reserved in self._engines (a None placeholder)
+        """
+        try:
+            pooled = PooledEngine(self.path, self.options)
+        except Exception:
+            with self._condition:
+                self._engines.remove(None)
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._engines[self._engines.index(None)] = pooled
+        return pooled
+
+    def _acquire(self, game=None, timeout=None, spawn=True):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                # Prefer the engine that searched this game last time (its hash table is still warm),
+                # then a free engine, then a new one
+                pooled = next((pooled for pooled in self._idle if game is not None and pooled.last_game == game),
+                              None)
+                if pooled is None:
+                    pooled = next((pooled for pooled in reversed(self._idle) if pooled.ponder is None), None)
+                if pooled is None and spawn and len(self._engines) < self.size:
+                    self._engines.append(None)
+                    break
+                if pooled is None and self._idle:
+                    # Pondering never starves a game that has to move: take the engine from the ponder
+                    pooled = self._idle[0]
+                if pooled is not None:
+                    self._idle.remove(pooled)
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TimeoutError("no free engine")
+                self._waiting += 1
+                self._condition.wait(None if deadline is None else deadline - time.monotonic())
+                self._waiting -= 1
+        if pooled is None:
+            return self._spawn_reserved()
+        if pooled.last_game != game:
+            pooled.stop_ponder()
+        return pooled
+
+    def can_ponder(self):
+        """
+        :return: True if one more engine can ponder (under max_ponder and no game waiting for an engine)
+        """
+        with self._condition:
+            pondering = sum(1 for pooled in self._engines if pooled is not None and pooled.ponder is not None)
+            return self._waiting == 0 and pondering < self.max_ponder
+
+    def stop_ponder(self, game):
+        """
+        Stop the ponder search of a game (when the game is over or its move is played without the engine)
+        :param game: id of the game
+        """
+        # Taken out of the idle engines while they stop, so a checkout can't use them meanwhile
+        with self._condition:
+            engines = [pooled for pooled in self._idle if pooled.last_game == game and pooled.ponder is not None]
+            for pooled in engines:
+                self._idle.remove(pooled)
+        try:
+            for pooled in engines:
+                pooled.stop_ponder()
+        finally:
+            with self._condition:
+                self._idle.extend(engines)
+                self._condition.notify_all()
+
+    def _release(self, pooled):
+        with self._condition:
+            self._idle.append(pooled)
+            self._condition.notify()
+
+    def _discard(self, pooled):
+        """
+        Drop a crashed (or stuck) engine, a new one will be spawned on the next checkout
+        """
+        pooled.ponder = pooled.ponder_board = None
+        pooled.close(wait=False)
+        with self._condition:
+            if pooled in self._engines:
+                self._engines.remove(pooled)
+            self._condition.notify()
+
+    @contextmanager
+    def checkout(self, game=None, timeout=None, spawn=True):
+        """
+        Borrow an engine from the pool and give it back at the end of the with block
+        :param game: id of the game that needs the engine (engines that played it are preferred)
+        :param timeout: max seconds waiting for a free engine (TimeoutError after them), None to wait
+        :param spawn: start a new engine if the pool isn't full (False: only engines already running, their startup
+        time isn't bounded by the timeout)
+        :return: PooledEngine
+        """
+        pooled = self._acquire(game, timeout, spawn)
+        try:
+            yield pooled
+        except (chess.engine.EngineTerminatedError, chess.engine.EngineError, TimeoutError):
+            self._discard(pooled)
+            raise
+        except BaseException:
+            self._release(pooled)
+            raise
+        else:
+            pooled.last_game = game
+            self._release(pooled)
+
+    def engine_states(self):
+        """
+        :return: list of (PooledEngine, busy), an engine is busy when it's searching or pondering
+        """
+        with self._condition:
+            return [(pooled, pooled not in self._idle or pooled.ponder is not None)
+                    for pooled in self._engines if pooled is not None]
+
+    def shrink_idle(self, options, keep_games=()):
+        """
+        Configure the idle engines (not pondering) with smaller options, to free memory/threads for the others
+        :param options: dict of UCI options (name: value)
+        :param keep_games: ids of the games whose last engine is kept as it is (its hash table is still warm)
+        """
+        with self._condition:
+            engines = [pooled for pooled in self._idle if pooled.ponder is None and pooled.last_game not in keep_games]
+            for pooled in engines:
+                self._idle.remove(pooled)
+        try:
+            for pooled in engines:
+                pooled.configure(options)
+        finally:
+            with self._condition:
+                self._idle.extend(engines)
+                self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            engines = [pooled for pooled in self._engines if pooled is not None]
+            self._engines = []
+            self._idle = []
+        for pooled in engines:
+            pooled.close()
+
+
+def configure_pools(stockfish_path, fairy_path, stockfish_size=2, fairy_size=1, stockfish_options=None,
+                    fairy_options=None, max_ponder=1, prespawn=True):
+    """
+    Create the Stockfish and Fairy-Stockfish pools, to be called once at startup.
+    Stockfish engines are spawned now (if prespawn), Fairy-Stockfish ones only when the first variant game needs them
+    """
+    global stockfish_pool, fairy_pool
+    stockfish_pool = EnginePool(stockfish_path, stockfish_size, stockfish_options, max_ponder)
+    fairy_pool = EnginePool(fairy_path, fairy_size, fairy_options, max_ponder)
+    if prespawn:
+        stockfish_pool.start()
+
+
+def warm_up_pools(fairy=False):
+    """
+    Spawn and warm up every engine of the Stockfish pool (and of the Fairy-Stockfish one if fairy)
+    """
+    stockfish_pool.start(warm_up=True)
+    if fairy:
+        fairy_pool.start(warm_up=True)
+
+
+def get_pool(variant):
+    """
+    :param variant: type of chess variant (normal is "standard")
+    :return: the pool of the engine that can play that variant
+    """
+    if variant in STANDARD_VARIANTS:
+        return stockfish_pool
+    return fairy_pool
+
+
+def engine_states():
+    """
+    :return: list of (PooledEngine, busy) of every pool
+    """
+    states = []
+    for pool in (stockfish_pool, fairy_pool):
+        if pool is not None:
+            states.extend(pool.engine_states())
+    return states
+
+
+def close_pools():
+    for pool in (stockfish_pool, fairy_pool):
+        if pool is not None:
+            pool.close()
@@ -0,0 +1,136 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import chess.engine
+
+
+def cp_from_score(score):
+    """
+    Convert an engine score to the CP value (int) used by the bot, mates count 1000 per move
+    :param score: chess.engine.PovScore
+    :return: CP value (int)
+    """
+    cp = str(score.relative)
+    if "#" in cp:
+        cp = cp[1:]
+        return int(cp) * 1000
+    return int(cp)
+
+
+class SearchTimeout(TimeoutError):
+    """
+    The engine didn't answer before the deadline of the search (it's stuck or the machine is overloaded)
+    """
+
+
+class StreamingSearch:
+    """
+    One iterative deepening search that streams its info lines while it runs.
+    The caller reads the scores as they arrive and can change the thinking time or stop it at any moment,
+    then gets the move from the same search.
+    It's an anytime search: the first move of the last main line is kept as the best move so far, and after the
+    deadline the caller stops waiting for the engine (SearchTimeout) and can still play it
+    """
+    def __init__(self, engine, board, depth=None, think_time=None, game=None, clock=None, deadline=None,
+                 nodes=None):
+        """
+        :param engine: chess.engine.SimpleEngine
+        :param board: board (with its move stack) to search
+        :param depth: max depth of the search
+        :param think_time: seconds before the search is stopped (None for no time limit)
+        :param game: game object passed to the engine (ucinewgame is sent only when it changes)
+        :param clock: (wtime, btime, winc, binc) in seconds, to let the engine manage its time too
+        :param deadline: seconds from the start after which the engine is no longer awaited (None to always wait)
+        :param nodes: max nodes of the search (None for no limit)
+        """
+        if clock is not None:
+            wtime, btime, winc, binc = clock
+            limit = chess.engine.Limit(depth=depth, nodes=nodes, white_clock=wtime, black_clock=btime,
+                                       white_inc=winc, black_inc=binc)
+        else:
+            limit = chess.engine.Limit(depth=depth, nodes=nodes)
+        self.analysis = engine.analysis(board, limit, game=game)
+        self.start_time = time.monotonic()
+        self.info = {}
+        # First move of the last main line (and the expected reply)
+        self.best = None
+        self.best_ponder = None
+        self.deadline = deadline
+        self._timer = None
+        self._lock = threading.Lock()
+        self.set_think_time(think_time)
+
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    def set_think_time(self, think_time):
+        """
+        Change how long the search can run, counting from its start
+        :param think_time: seconds (None for no time limit)
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if think_time is None:
+                return
+            remaining = think_time - self.elapsed()
+            if remaining <= 0:
+                self.analysis.stop()
+                return
+            self._timer = threading.Timer(remaining, self.analysis.stop)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def set_deadline(self, deadline):
+        """
+        :param deadline: seconds from the start after which the engine is no longer awaited (None to always wait)
+        """
+        self.deadline = deadline
+
+    def stop(self):
+        self.analysis.stop()
+
+    def _result(self, coroutine):
+        """
+        Run a coroutine of the analysis in the engine event loop, waiting for it until the deadline
+        """
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.analysis.simple_engine.protocol.loop)
+        timeout = None if self.deadline is None else max(0.0, self.deadline - self.elapsed())
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise SearchTimeout(f"no answer from the engine after {self.elapsed():.2f}s")
+
+    def __iter__(self):
+        """
+        Yield every info line (as dict) of the main line until the search is over
+        """
+        while True:
+            try:
+                info = self._result(self.analysis.inner.__anext__())
+            except StopAsyncIteration:
+                return
+            if info.get('multipv', 1) != 1:
+                continue
+            self.info.update(info)
+            if info.get('pv'):
+                self.best = info['pv'][0]
+                self.best_ponder = info['pv'][1] if len(info['pv']) > 1 else None
+            yield info
+
+    def best_move(self):
+        """
+        Wait for the end of the search
+        :return: chess.engine.BestMove (move and ponder move)
+        """
+        try:
+            return self._result(self.analysis.inner.wait())
+        finally:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
@@ -0,0 +1,157 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+import chess
+import chess.polyglot
+
+
+# Variants whose position is fully described by the zobrist hash (the others use the epd, with pockets and checks)
+ZOBRIST_VARIANTS = ('standard', 'chess960', 'fromPosition')
+# Positions with more halfmoves without captures/pawn moves depend on their history (50 moves rule)
+MAX_HALFMOVE_CLOCK = 80
+# Entries that wake the writer of the database, else it writes every FLUSH_SECONDS
+FLUSH_EVERY = 100
+FLUSH_SECONDS = 30
+
+CacheEntry = namedtuple('CacheEntry', ['cp', 'move', 'depth', 'pv'])
+
+
+def position_key(board, variant):
+    if variant in ZOBRIST_VARIANTS:
+        return str(chess.polyglot.zobrist_hash(board))
+    return board.epd()
+
+
+def is_cacheable(board):
+    """
+    The same position can have another result when it's a repetition or near the 50 moves rule
+    """
+    return board.halfmove_clock <= MAX_HALFMOVE_CLOCK and not board.is_repetition(2)
+
+
+class EvalCache:
+    """
+    LRU cache of the search results: key is position + variant + skill level (the move depends on it).
+    An entry is used only if its search was deep enough for the current one.
+    With a database path, the entries are saved to SQLite so they survive a restart: a background writer saves
+    them, a search never waits for the disk
+    """
+    def __init__(self, max_entries=100000, path=None):
+        """
+        :param max_entries: entries kept in memory, the least recently used are evicted
+        :param path: SQLite file (None to keep the cache only in memory)
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        # key: CacheEntry not written yet, the most recently used last
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        self._db = None
+        self._thread = None
+        if path:
+            # Imported only with a database
+            import sqlite3
+            self._db = sqlite3.connect(str(path), check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS evals (key TEXT PRIMARY KEY, cp INTEGER, move TEXT, "
+                             "depth INTEGER, pv TEXT, used INTEGER)")
+            # Warm start with the most recently used entries
+            rows = self._db.execute("SELECT key, cp, move, depth, pv FROM evals ORDER BY used DESC LIMIT ?",
+                                    (max_entries,)).fetchall()
+            for key, cp, move, depth, pv in reversed(rows):
+                self._entries[key] = CacheEntry(cp, move, depth, pv.split())
+            self._wake = threading.Event()
+            self._closing = False
+            self._thread = threading.Thread(target=self._run, name='eval-cache', daemon=True)
+            self._thread.start()
+
+    def get(self, board, variant, skill_level, depth):
+        """
+        :param board: board of the position
+        :param variant: type of chess variant
+        :param skill_level: Skill Level of the search
+        :param depth: min depth of the search wanted
+        :return: CacheEntry (move and pv in uci) or None
+        """
+        if not is_cacheable(board):
+            return None
+        key = f"{variant}:{skill_level}:{position_key(board, variant)}"
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.depth < depth:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, board, variant, skill_level, cp, move, depth, pv=()):
+        """
+        Save a search result, a deeper one already saved is kept
+        :param cp: CP value from the side to move
+        :param move: best move (chess.Move)
+        :param depth: depth reached by the search
+        :param pv: main line (list of chess.Move)
+        """
+        if not is_cacheable(board) or move is None:
+            return
+        key = f"{variant}:{skill_level}:{position_key(board, variant)}"
+        entry = CacheEntry(cp, move.uci(), depth, [pv_move.uci() for pv_move in pv])
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None and old.depth > depth:
+                return
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if self._thread is not None:
+                self._pending.pop(key, None)
+                self._pending[key] = entry
+                if len(self._pending) >= FLUSH_EVERY:
+                    self._wake.set()
+
+    def _run(self):
+        import sqlite3
+        closing = False
+        while not closing:
+            self._wake.wait(FLUSH_SECONDS)
+            self._wake.clear()
+            closing = self._closing
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if pending:
+                try:
+                    self._write(pending)
+                except sqlite3.Error as e:
+                    print(f"Eval cache not saved: {e}")
+        self._db.close()
+
+    def _write(self, pending):
+        # Recently used entries have a bigger "used" value
+        offset = self._db.execute("SELECT COALESCE(MAX(used), 0) + 1 FROM evals").fetchone()[0]
+        self._db.executemany("INSERT OR REPLACE INTO evals VALUES (?, ?, ?, ?, ?, ?)",
+                             [(key, entry.cp, entry.move, entry.depth, ' '.join(entry.pv), offset + used)
+                              for used, (key, entry) in enumerate(pending.items())])
+        self._db.commit()
+
+    def close(self):
+        """
+        Write the pending entries and close the database
+        """
+        if self._thread is None:
+            return
+        thread, self._thread = self._thread, None
+        self._closing = True
+        self._wake.set()
+        thread.join(30)
+        self._db = None
+
+
+# Cache configured at startup by configure()
+cache = EvalCache()
+
+
+def configure(max_entries=100000, path=None):
+    global cache
+    cache = EvalCache(max_entries, path)
@@ -0,0 +1,306 @@
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import chess
+
+
+# Seconds between empty lines on the open streams (as Lichess does)
+HEARTBEAT = 1.0
+# Seconds between the checks of the clocks
+FLAG_CHECK = 0.05
+BOT_ID = 'zoe'
+
+
+class FakeGame:
+    """
+    A game played by the bot against a scripted opponent: the moves of a recorded game while the bot follows it,
+    then random moves. Clocks run with real time, the bot loses when its clock reaches 0
+    """
+    def __init__(self, game_id, bot_color, clock=60, increment=0, max_plies=80, moves=None, seed=None,
+                 opponent_time=0.0, opponent_elo=1500):
+        """
+        :param game_id: id of the game
+        :param bot_color: 'white' or 'black'
+        :param clock: initial clock (s)
+        :param increment: increment (s)
+        :param max_plies: the game is a draw after these plies
+        :param moves: moves (uci) of a recorded game, the opponent plays them while the bot plays the same
+        :param seed: seed of the random moves of the opponent
+        :param opponent_time: seconds the opponent takes for every move
+        :param opponent_elo: rating of the opponent
+        """
+        self.id = game_id
+        self.bot_color = bot_color
+        self.bot_turn_color = chess.WHITE if bot_color == 'white' else chess.BLACK
+        self.clocks = {chess.WHITE: clock, chess.BLACK: clock}
+        self.increment = increment
+        self.max_plies = max_plies
+        self.recorded = list(moves or [])
+        self.random = random.Random(seed)
+        self.opponent_time = opponent_time
+        self.opponent_elo = opponent_elo
+        self.board = chess.Board()
+        self.status = 'started'
+        # Clocks start when the bot opens the game stream
+        self.turn_start = None
+        self.start_time = self.end_time = None
+        # Seconds from the state sent to the bot to its move
+        self.latencies = []
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def game_start(self):
+        return {'type': 'gameStart', 'game': {
+            'gameId': self.id, 'fullId': self.id, 'color': self.bot_color, 'fen': chess.STARTING_FEN,
+            'hasMoved': False, 'isMyTurn': self.bot_color == 'white', 'variant': {'key': 'standard'},
+            'speed': 'blitz',
+            'opponent': {'id': 'opponent', 'username': 'Opponent', 'rating': self.opponent_elo}}}
+
+    def state(self):
+        return {'type': 'gameState', 'moves': ' '.join(move.uci() for move in self.board.move_stack),
+                'wtime': round(self.clocks[chess.WHITE] * 1000), 'btime': round(self.clocks[chess.BLACK] * 1000),
+                'winc': self.increment * 1000, 'binc': self.increment * 1000, 'status': self.status}
+
+    def game_full(self):
+        bot = {'id': BOT_ID, 'name': 'Zoe', 'rating': 2000}
+        opponent = {'id': 'opponent', 'name': 'Opponent', 'rating': self.opponent_elo}
+        return {'type': 'gameFull', 'id': self.id, 'variant': {'key': 'standard'}, 'speed': 'blitz',
+                'initialFen': 'startpos', 'white': bot if self.bot_color == 'white' else opponent,
+                'black': opponent if self.bot_color == 'white' else bot, 'state': self.state()}
+
+    def begin(self):
+        """
+        Start the clocks (called with the lock held)
+        """
+        if self.turn_start is None:
+            self.start_time = self.turn_start = time.monotonic()
+            if self.board.turn != self.bot_turn_color:
+                self._opponent_move()
+
+    def _broadcast(self):
+        state = self.state()
+        for listener in self.listeners:
+            listener.append(state)
+        if self.status != 'started':
+            self.end_time = time.monotonic()
+            self.finished.set()
+
+    def _run_clock(self, now):
+        elapsed = now - self.turn_start
+        self.clocks[self.board.turn] -= elapsed
+        self.turn_start = now
+
+    def _check_end(self):
+        outcome = self.board.outcome(claim_draw=True)
+        if outcome is not None:
+            self.status = 'mate' if outcome.termination == chess.Termination.CHECKMATE else 'draw'
+        elif len(self.board.move_stack) >= self.max_plies:
+            self.status = 'draw'
+
+    def _opponent_move(self):
+        ply = len(self.board.move_stack)
+        moves = [move.uci() for move in self.board.move_stack]
+        if ply < len(self.recorded) and moves == self.recorded[:ply]:
+            move = chess.Move.from_uci(self.recorded[ply])
+        else:
+            move = self.random.choice(list(self.board.legal_moves))
+        self.clocks[self.board.turn] -= self.opponent_time
+        self.board.push(move)
+        self.turn_start = time.monotonic()
+        self._check_end()
+
+    def bot_move(self, uci):
+        """
+        Move of the bot, then the opponent replies
+        :return: error message or None
+        """
+        with self.lock:
+            if self.status != 'started':
+                return 'game is over'
+            if self.board.turn != self.bot_turn_color:
+                return 'not your turn'
+            try:
+                move = chess.Move.from_uci(uci)
+            except ValueError:
+                return 'invalid move'
+            if move not in self.board.legal_moves:
+                return 'illegal move'
+            now = time.monotonic()
+            self.latencies.append(now - self.turn_start)
+            self._run_clock(now)
+            if self.clocks[self.board.turn] <= 0:
+                self.status = 'outoftime'
+                self._broadcast()
+                return None
+            self.clocks[self.board.turn] += self.increment
+            self.board.push(move)
+            self._check_end()
+            if self.status == 'started':
+                self._opponent_move()
+            self._broadcast()
+        return None
+
+    def check_flag(self):
+        with self.lock:
+            if self.status == 'started' and self.turn_start is not None and self.board.turn == self.bot_turn_color:
+                if self.clocks[self.board.turn] - (time.monotonic() - self.turn_start) <= 0:
+                    self.clocks[self.board.turn] = 0
+                    self.status = 'outoftime'
+                    self._broadcast()
+
+    def is_flagged(self):
+        return self.status == 'outoftime'
+
+
+class FakeLichess:
+    """
+    Local HTTP server with the part of the Lichess bot API used by the bot
+    """
+    def __init__(self, games, port=0):
+        """
+        :param games: list of FakeGame
+        :param port: local port (0 for a free one)
+        """
+        self.games = {game.id: game for game in games}
+        self.calls = Counter()
+        self.stopping = threading.Event()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+        self.server.handle_error = self._handle_error
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def _handler(self):
+        lichess = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Streams are chunked as on Lichess, so every line reaches the bot as soon as it's sent
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _chunk(self, data):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+            def _json(self, data, status=200):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self, lines, keep_open):
+                """
+                Send ndjson lines (appended to the list by other threads) until keep_open() is False
+                """
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                sent = 0
+                last_write = time.monotonic()
+                try:
+                    while True:
+                        while sent < len(lines):
+                            self._chunk(json.dumps(lines[sent]).encode() + b'\n')
+                            sent += 1
+                            last_write = time.monotonic()
+                        if not keep_open() or lichess.stopping.is_set():
+                            self.wfile.write(b"0\r\n\r\n")
+                            return
+                        if time.monotonic() - last_write > HEARTBEAT:
+                            self._chunk(b'\n')
+                            last_write = time.monotonic()
+                        time.sleep(0.005)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/api/account':
+                    lichess.calls['account'] += 1
+                    self._json({'id': BOT_ID, 'username': 'Zoe', 'title': 'BOT'})
+                elif path == '/api/stream/event':
+                    lichess.calls['stream_event'] += 1
+                    lines = [game.game_start() for game in lichess.games.values() if game.status == 'started']
+                    self._stream(lines, lambda: not lichess.all_finished())
+                elif path.startswith('/api/bot/game/stream/'):
+                    lichess.calls['stream_game'] += 1
+                    game = lichess.games.get(path.rsplit('/', 1)[1])
+                    if game is None:
+                        self._json({'error': 'Not found'}, 404)
+                        return
+                    with game.lock:
+                        game.begin()
+                        lines = [game.game_full()]
+                        game.listeners.append(lines)
+                    self._stream(lines, lambda: game.status == 'started')
+                elif path == '/api/account/playing':
+                    lichess.calls['ongoing'] += 1
+                    self._json({'nowPlaying': [game.game_start()['game'] for game in lichess.games.values()
+                                               if game.status == 'started']})
+                elif path == '/api/bot/online':
+                    lichess.calls['bots_online'] += 1
+                    self._stream([{'id': 'otherbot', 'username': 'OtherBot', 'perfs': {}}], lambda: False)
+                elif path == '/api/challenge':
+                    lichess.calls['challenges'] += 1
+                    self._json({'in': [], 'out': []})
+                else:
+                    self._json({'error': 'Not found'}, 404)
+
+            def do_POST(self):
+                path = self.path.split('?')[0]
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                move = re.fullmatch(r'/api/bot/game/(\w+)/move/(\w+)', path)
+                if move:
+                    lichess.calls['move'] += 1
+                    game = lichess.games.get(move.group(1))
+                    error = 'Not found' if game is None else game.bot_move(move.group(2))
+                    if error:
+                        self._json({'error': error}, 400)
+                    else:
+                        self._json({'ok': True})
+                elif re.fullmatch(r'/api/bot/game/\w+/chat', path):
+                    lichess.calls['chat'] += 1
+                    self._json({'ok': True})
+                elif path.startswith('/api/challenge/'):
+                    lichess.calls['challenge'] += 1
+                    self._json({'ok': True})
+                else:
+                    self._json({'error': 'Not found'}, 404)
+
+        return Handler
+
+    def _handle_error(self, request, client_address):
+        # The bot closes its connections when it's stopped
+        error = sys.exc_info()[1]
+        if not isinstance(error, (ConnectionError, TimeoutError)):
+            print(f"Fake Lichess error: {error!r}")
+
+    def all_finished(self):
+        return all(game.status != 'started' for game in self.games.values())
+
+    def _flag_loop(self):
+        while not self.stopping.is_set():
+            for game in self.games.values():
+                game.check_flag()
+            time.sleep(FLAG_CHECK)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-lichess', daemon=True).start()
+        threading.Thread(target=self._flag_loop, name='fake-lichess-clocks', daemon=True).start()
+
+    def stop(self):
+        self.stopping.set()
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,243 @@
+import json
+import os
+import queue
+import struct
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+
+
+# File format: MAGIC, then records of RECORD_HEADER (type, payload length) + payload, so a reader can skip
+# the records it doesn't need without decoding them
+MAGIC = b'ZOEARCH1'
+RECORD_HEADER = struct.Struct('<BI')
+GAME_START, MOVE, GAME_END = 1, 2, 3
+# Move payload: game id, ply, move (uci), cp (bot side), depth, seldepth, skill level (0 in the UCI_Elo mode),
+# threads, hash (MB), estimated elo, nodes, nps, think time, search time, API latency (s), clock before the move (s),
+# source, then the fallback reason (utf-8) if the move is a fallback
+MOVE_STRUCT = struct.Struct('<12sH5siBBBBHHQIffffB')
+# Bytes of the game id in the move records (Lichess ids have 8)
+GAME_ID_LENGTH = 12
+# Move sources (index saved in the move record)
+SOURCES = ('engine', 'book', 'tablebase', 'cache', 'best_so_far', 'shallow_search', 'random')
+# cp of the moves without an evaluation (book)
+NO_SCORE = -2 ** 31
+SUFFIX = '.zga'
+
+GameStart = namedtuple('GameStart', 'game_id info')
+MoveRecord = namedtuple('MoveRecord', 'game_id ply move cp depth seldepth skill_level threads hash_m elo nodes nps '
+                                      'think_time search_time api_latency clock source reason')
+GameEnd = namedtuple('GameEnd', 'game_id status pgn')
+
+
+def _game_key(game_id):
+    return game_id.encode()[:GAME_ID_LENGTH].ljust(GAME_ID_LENGTH, b'\0')
+
+
+def encode_move(record):
+    """
+    :param record: MoveRecord
+    :return: payload bytes
+    """
+    payload = MOVE_STRUCT.pack(_game_key(record.game_id), record.ply, record.move.encode()[:5].ljust(5, b'\0'),
+                               NO_SCORE if record.cp is None else max(NO_SCORE + 1, min(2 ** 31 - 1, record.cp)),
+                               min(255, record.depth), min(255, record.seldepth), record.skill_level,
+                               min(255, record.threads), min(65535, record.hash_m), min(65535, record.elo),
+                               record.nodes, min(2 ** 32 - 1, record.nps), record.think_time, record.search_time,
+                               record.api_latency, record.clock, SOURCES.index(record.source))
+    return payload + (record.reason or '').encode()
+
+
+def decode_move(payload):
+    """
+    :param payload: bytes of a move record
+    :return: MoveRecord
+    """
+    (game_id, ply, move, cp, depth, seldepth, skill_level, threads, hash_m, elo, nodes, nps, think_time, search_time,
+     api_latency, clock, source) = MOVE_STRUCT.unpack_from(payload)
+    reason = payload[MOVE_STRUCT.size:].decode() or None
+    return MoveRecord(game_id.rstrip(b'\0').decode(), ply, move.rstrip(b'\0').decode(),
+                      None if cp == NO_SCORE else cp, depth, seldepth, skill_level, threads, hash_m, elo, nodes, nps,
+                      think_time, search_time, api_latency, clock, SOURCES[source], reason)
+
+
+def _pgn(board, headers):
+    # Only the writer thread builds the PGN
+    import chess.pgn
+    game = chess.pgn.Game.from_board(board)
+    for name, value in headers.items():
+        game.headers[name] = str(value)
+    return str(game)
+
+
+class GameArchive:
+    """
+    Append-only archive of the games: start info, one compact record per bot move (evaluation, depth, nodes,
+    time spent, fallback reason...) and the PGN at the end.
+    The players only queue the records, a background writer encodes and writes them and starts a new file
+    every max_bytes. When the queue is full the records are dropped (and counted), games never wait for the disk
+    """
+    def __init__(self, folder, max_bytes=64 * 1024 * 1024, max_files=0, max_queue=10000):
+        """
+        :param folder: folder of the archive files
+        :param max_bytes: size of a file before starting a new one
+        :param max_files: max number of files kept, the oldest are deleted (0 to keep them all)
+        :param max_queue: max number of records waiting for the writer
+        """
+        self.folder = Path(folder)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self._file = None
+        self._thread = threading.Thread(target=self._run, name='game-archive', daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def game_started(self, game_id, info):
+        """
+        :param info: dict of the game (players, ratings, variant, speed...), saved as json
+        """
+        self._put((GAME_START, game_id, info))
+
+    def record_move(self, record):
+        """
+        :param record: MoveRecord of a bot move
+        """
+        self._put((MOVE, record))
+
+    def game_over(self, game_id, status, board, headers):
+        """
+        :param status: status of the game stream (mate, resign, outoftime...)
+        :param board: board with the moves of the game (copied by the caller)
+        :param headers: dict of PGN headers
+        """
+        self._put((GAME_END, game_id, status, board, headers))
+
+    def _encode(self, item):
+        if item[0] == GAME_START:
+            _, game_id, info = item
+            return GAME_START, json.dumps({'game_id': game_id, **info}).encode()
+        if item[0] == MOVE:
+            return MOVE, encode_move(item[1])
+        _, game_id, status, board, headers = item
+        return GAME_END, json.dumps({'game_id': game_id, 'status': status, 'pgn': _pgn(board, headers)}).encode()
+
+    def _open(self):
+        """
+        Start a new file (name by time and process, so the workers of the supervisor mode don't share files)
+        """
+        if self._file is not None:
+            self._file.close()
+        self.folder.mkdir(parents=True, exist_ok=True)
+        path = self.folder / f"games-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}{SUFFIX}"
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        if self.max_files:
+            for old in sorted(self.folder.glob(f'*{SUFFIX}'), key=os.path.getmtime)[:-self.max_files]:
+                old.unlink()
+
+    def _write(self, item):
+        try:
+            record_type, payload = self._encode(item)
+        except Exception as e:
+            print(f"Archive record not written: {e}")
+            return
+        if self._file is None or self._file.tell() >= self.max_bytes:
+            self._open()
+        self._file.write(RECORD_HEADER.pack(record_type, len(payload)) + payload)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self._write(item)
+            # Write what's queued, then flush once
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._close()
+                    return
+                self._write(item)
+            if self._file is not None:
+                self._file.flush()
+        self._close()
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        """
+        Write the queued records and close the file
+        """
+        self.queue.put(None)
+        self._thread.join(10)
+
+
+def read_records(path, types=None):
+    """
+    Yield the records of an archive file, or of all the files of a folder (oldest first), without loading them
+    :param path: archive file or folder
+    :param types: record types to read (GAME_START, MOVE, GAME_END), None for all; the others are skipped unread
+    :return: generator of GameStart, MoveRecord and GameEnd
+    """
+    path = Path(path)
+    paths = sorted(path.glob(f'*{SUFFIX}'), key=os.path.getmtime) if path.is_dir() else [path]
+    for file_path in paths:
+        with open(file_path, 'rb') as archive_file:
+            if archive_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{file_path} is not a game archive")
+            while True:
+                header = archive_file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    # End of the file (or a record cut by a crash)
+                    break
+                record_type, length = RECORD_HEADER.unpack(header)
+                if types is not None and record_type not in types:
+                    archive_file.seek(length, os.SEEK_CUR)
+                    continue
+                payload = archive_file.read(length)
+                if len(payload) < length:
+                    break
+                if record_type == MOVE:
+                    yield decode_move(payload)
+                elif record_type == GAME_START:
+                    info = json.loads(payload)
+                    yield GameStart(info.pop('game_id'), info)
+                elif record_type == GAME_END:
+                    info = json.loads(payload)
+                    yield GameEnd(info['game_id'], info['status'], info['pgn'])
+
+
+def read_moves(path):
+    """
+    :return: generator of the MoveRecord of an archive file or folder
+    """
+    return read_records(path, types=(MOVE,))
+
+
+# Archive opened at startup by configure() (None: nothing is archived)
+archive = None
+
+
+def configure(folder, max_bytes=64 * 1024 * 1024, max_files=0):
+    global archive
+    archive = GameArchive(folder, max_bytes, max_files) if folder else None
+
+
+def close():
+    if archive is not None:
+        archive.close()
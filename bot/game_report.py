@@ -0,0 +1,248 @@
+import argparse
+import json
+import re
+from collections import defaultdict, namedtuple
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+import game_archive
+
+
+THIS_FOLDER = Path(__file__).parent.resolve()
+# Evaluations are clipped to this CP (mates count 1000 per move, a mate is as good as a won position)
+MAX_CP = 1000
+# Drop of win percent (0-100) of a move to call it inaccuracy, mistake and blunder (as Lichess does)
+INACCURACY, MISTAKE, BLUNDER = 5, 10, 15
+# Percentiles of the think time shown in the reports
+TIME_PERCENTILES = (10, 50, 90, 99)
+RESULT_HEADER = re.compile(r'\[Result "([^"]*)"\]')
+
+# Bot moves of many games, as columns: game index, CP before and after the move (from the bot side), think time,
+# clock before the move, estimated Elo of the move
+GameMoves = namedtuple('GameMoves', 'game cp_before cp_after think_time clock elo')
+# One row per game: id, opponent Elo, score of the bot (1, 0.5, 0, nan if unknown)
+Games = namedtuple('Games', 'ids opponent_elo score')
+
+
+def win_percent(cp):
+    """
+    Chance to win (0-100) of a CP evaluation, the Lichess model
+    :param cp: numpy array of CP from the side to move
+    """
+    return 50 + 50 * (2 / (1 + np.exp(-0.00368208 * cp)) - 1)
+
+
+def move_metrics(cp_before, cp_after):
+    """
+    :param cp_before: numpy array of CP (from the side that moved) before every move
+    :param cp_after: numpy array of CP (same side) after every move
+    :return: centipawn loss, win percent drop and accuracy (0-100) of every move
+    """
+    cp_before = np.clip(cp_before, -MAX_CP, MAX_CP)
+    cp_after = np.clip(cp_after, -MAX_CP, MAX_CP)
+    cp_loss = np.maximum(0, cp_before - cp_after)
+    win_drop = np.maximum(0, win_percent(cp_before) - win_percent(cp_after))
+    accuracy = np.clip(103.1668 * np.exp(-0.04354 * win_drop) - 3.1669, 0, 100)
+    return cp_loss, win_drop, accuracy
+
+
+def game_score(result, color):
+    if result == '1/2-1/2':
+        return 0.5
+    if result in ('1-0', '0-1'):
+        return float((result == '1-0') == (color == 'white'))
+    return np.nan
+
+
+def load_archive(path, game_ids=None):
+    """
+    Read the bot moves of the archived games.
+    The archive has the evaluation of the bot searches only, so a move is judged by the evaluation of the next bot
+    search (the opponent reply is in between); moves without evaluation (book, tablebase) are left out
+    :param path: archive file or folder
+    :param game_ids: ids of the games to read (None for all)
+    :return: Games, GameMoves
+    """
+    starts = {}
+    moves = defaultdict(list)
+    results = {}
+    if game_ids is not None:
+        game_ids = {game_id[:game_archive.GAME_ID_LENGTH] for game_id in game_ids}
+    for record in game_archive.read_records(path):
+        # Move records have the first GAME_ID_LENGTH characters of the id
+        game_id = record.game_id[:game_archive.GAME_ID_LENGTH]
+        if game_ids is not None and game_id not in game_ids:
+            continue
+        if isinstance(record, game_archive.MoveRecord):
+            moves[game_id].append((record.ply, np.nan if record.cp is None else record.cp, record.think_time,
+                                   record.clock, record.elo or np.nan))
+        elif isinstance(record, game_archive.GameStart):
+            starts[game_id] = record.info
+        else:
+            result = RESULT_HEADER.search(record.pgn)
+            results[game_id] = result.group(1) if result else '*'
+
+    ids = [game_id for game_id in starts if moves.get(game_id)]
+    columns = []
+    for index, game_id in enumerate(ids):
+        game_moves = np.array(sorted(moves[game_id]), dtype=float)
+        # Each row: this move and the evaluation of the next bot search
+        columns.append(np.column_stack([np.full(len(game_moves) - 1, index), game_moves[:-1, 1], game_moves[1:, 1],
+                                        game_moves[:-1, 2], game_moves[:-1, 3], game_moves[:-1, 4]]))
+    table = np.concatenate(columns) if columns else np.empty((0, 6))
+    table = table[~np.isnan(table[:, 1]) & ~np.isnan(table[:, 2])]
+    game_moves = GameMoves(table[:, 0].astype(int), table[:, 1], table[:, 2], table[:, 3], table[:, 4], table[:, 5])
+    games = Games(ids, np.array([starts[game_id].get('opponent_elo', np.nan) for game_id in ids], dtype=float),
+                  np.array([game_score(results.get(game_id, '*'), starts[game_id].get('color')) for game_id in ids]))
+    return games, game_moves
+
+
+def compute_report(games, game_moves):
+    """
+    Statistics of every game and of all of them, as array operations
+    :param games: Games
+    :param game_moves: GameMoves
+    :return: dict of per game arrays ('games') and totals ('total')
+    """
+    count = len(games.ids)
+    index = game_moves.game
+    cp_loss, win_drop, accuracy = move_metrics(game_moves.cp_before, game_moves.cp_after)
+    moves = np.bincount(index, minlength=count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        acpl = np.bincount(index, cp_loss, count) / moves
+        game_accuracy = np.bincount(index, accuracy, count) / moves
+        elo = np.bincount(index, np.nan_to_num(game_moves.elo), count) / np.bincount(
+            index, ~np.isnan(game_moves.elo), count)
+    blunders = np.bincount(index, win_drop >= BLUNDER, count).astype(int)
+    mistakes = np.bincount(index, (win_drop >= MISTAKE) & (win_drop < BLUNDER), count).astype(int)
+    inaccuracies = np.bincount(index, (win_drop >= INACCURACY) & (win_drop < MISTAKE), count).astype(int)
+    # Estimated strength of the bot against the rating of the opponent
+    elo_error = elo - games.opponent_elo
+    valid_error = elo_error[~np.isnan(elo_error)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        clock_share = game_moves.think_time / game_moves.clock
+
+    def mean(values):
+        values = values[~np.isnan(values)]
+        return float(values.mean()) if len(values) else None
+
+    total = {
+        'games': count,
+        'moves': int(moves.sum()),
+        'acpl': mean(cp_loss),
+        'accuracy': mean(accuracy),
+        'blunders_per_game': float(blunders.sum() / count) if count else None,
+        'mistakes_per_game': float(mistakes.sum() / count) if count else None,
+        'inaccuracies_per_game': float(inaccuracies.sum() / count) if count else None,
+        'think_time_percentiles': (dict(zip(TIME_PERCENTILES, np.percentile(game_moves.think_time,
+                                                                              TIME_PERCENTILES).tolist()))
+                                   if len(game_moves.think_time) else {}),
+        'clock_share': mean(clock_share[np.isfinite(clock_share)]),
+        'elo_bias': float(valid_error.mean()) if len(valid_error) else None,
+        'elo_mae': float(np.abs(valid_error).mean()) if len(valid_error) else None,
+        'score': mean(games.score),
+    }
+    per_game = {'ids': games.ids, 'moves': moves, 'acpl': acpl, 'accuracy': game_accuracy, 'blunders': blunders,
+                'mistakes': mistakes, 'inaccuracies': inaccuracies, 'elo': elo, 'opponent_elo': games.opponent_elo,
+                'elo_error': elo_error, 'score': games.score}
+    return {'games': per_game, 'total': total}
+
+
+def _number(value, digits=1):
+    return '-' if value is None or value != value else f"{value:.{digits}f}"
+
+
+def format_game(report, game_id):
+    """
+    :return: text report of one game (for Telegram), None if the game is not in the report
+    """
+    per_game = report['games']
+    if game_id not in per_game['ids']:
+        return None
+    n = per_game['ids'].index(game_id)
+    total = report['total']
+    times = ', '.join(f"p{p} {_number(t, 2)}s" for p, t in total['think_time_percentiles'].items())
+    return (f"Game {game_id}: {per_game['moves'][n]} moves judged\n"
+            f"ACPL: {_number(per_game['acpl'][n])}\n"
+            f"Accuracy: {_number(per_game['accuracy'][n])}%\n"
+            f"Blunders: {per_game['blunders'][n]}, mistakes: {per_game['mistakes'][n]}, "
+            f"inaccuracies: {per_game['inaccuracies'][n]}\n"
+            f"Think time: {times}\n"
+            f"Playing at {_number(per_game['elo'][n], 0)} Elo against {_number(per_game['opponent_elo'][n], 0)} "
+            f"({_number(per_game['elo_error'][n], 0)})")
+
+
+def format_total(report):
+    """
+    :return: text report of all the games
+    """
+    total = report['total']
+    times = ', '.join(f"p{p} {_number(t, 2)}s" for p, t in total['think_time_percentiles'].items())
+    return (f"{total['games']} games, {total['moves']} moves judged\n"
+            f"ACPL: {_number(total['acpl'])}\n"
+            f"Accuracy: {_number(total['accuracy'])}%\n"
+            f"Per game: {_number(total['blunders_per_game'], 2)} blunders, "
+            f"{_number(total['mistakes_per_game'], 2)} mistakes, "
+            f"{_number(total['inaccuracies_per_game'], 2)} inaccuracies\n"
+            f"Think time: {times}, {_number(100 * total['clock_share'] if total['clock_share'] else None)}% "
+            f"of the clock per move\n"
+            f"Estimated Elo - opponent Elo: bias {_number(total['elo_bias'], 0)}, "
+            f"mean error {_number(total['elo_mae'], 0)}\n"
+            f"Score: {_number(100 * total['score'] if total['score'] is not None else None)}%")
+
+
+def game_report(path, game_id):
+    """
+    :param path: archive file or folder
+    :return: text report of one game, None if it's not archived
+    """
+    report = compute_report(*load_archive(path, {game_id}))
+    return format_game(report, game_id[:game_archive.GAME_ID_LENGTH])
+
+
+def archive_report(path):
+    """
+    :param path: archive file or folder
+    :return: text report of all the archived games
+    """
+    return format_total(compute_report(*load_archive(path)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Statistics of the archived games: centipawn loss, accuracy, "
+                                                 "blunders, think time and Elo calibration")
+    parser.add_argument('archive', nargs='?', help="archive file or folder (default: archive_dir of config.yml)")
+    parser.add_argument('--game', help="report of this game only")
+    parser.add_argument('--games', action='store_true', help="one line per game too")
+    parser.add_argument('--json', action='store_true', help="totals as json")
+    args = parser.parse_args()
+
+    archive = args.archive
+    if archive is None:
+        config = {}
+        config_path = THIS_FOLDER / "config.yml"
+        if config_path.exists():
+            with open(config_path) as config_file:
+                config = yaml.safe_load(config_file) or {}
+        archive = config.get('archive_dir') or THIS_FOLDER / "../database/archive"
+    if args.game:
+        print(game_report(archive, args.game) or f"Game {args.game} not archived")
+        return
+    report = compute_report(*load_archive(archive))
+    if args.json:
+        print(json.dumps(report['total'], indent=2))
+    else:
+        print(format_total(report))
+    if args.games:
+        per_game = report['games']
+        for n, game_id in enumerate(per_game['ids']):
+            print(f"{game_id} moves {per_game['moves'][n]:>3} acpl {_number(per_game['acpl'][n]):>6} "
+                  f"accuracy {_number(per_game['accuracy'][n]):>5} blunders {per_game['blunders'][n]} "
+                  f"elo {_number(per_game['elo'][n], 0)} vs {_number(per_game['opponent_elo'][n], 0)} "
+                  f"score {_number(per_game['score'][n])}")
+
+
+if __name__ == '__main__':
+    main()
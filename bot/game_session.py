@@ -0,0 +1,159 @@
+import importlib
+import time
+
+import chess
+
+
+def new_board(variant, fen=None):
+    """
+    Create the board of the variant (normal is "standard")
+    :param variant: type of chess variant
+    :param fen: fen position (None for the starting position of the variant)
+    :return: chess.Board or variant board
+    """
+    if variant not in ('standard', 'chess960', 'fromPosition'):
+        # Imported by the first variant game only (chess.variant is then an attribute of chess)
+        importlib.import_module('chess.variant')
+    if variant == 'crazyhouse':
+        board_class = chess.variant.CrazyhouseBoard
+    elif variant == 'antichess':
+        board_class = chess.variant.AntichessBoard
+    elif variant == 'atomic':
+        board_class = chess.variant.AtomicBoard
+    elif variant == 'horde':
+        board_class = chess.variant.HordeBoard
+    elif variant == 'kingOfTheHill':
+        board_class = chess.variant.KingOfTheHillBoard
+    elif variant == 'racingKings':
+        board_class = chess.variant.RacingKingsBoard
+    elif variant == 'threeCheck':
+        board_class = chess.variant.ThreeCheckBoard
+    else:
+        board_class = chess.Board
+    if fen is None or fen == 'startpos':
+        return board_class(chess960=variant == 'chess960')
+    return board_class(fen, chess960=variant == 'chess960')
+
+
+def clock_seconds(value):
+    """
+    Clocks of the game stream are milliseconds in gameFull and timedelta in gameState events
+    :return: seconds (float)
+    """
+    if hasattr(value, 'total_seconds'):
+        return value.total_seconds()
+    return value / 1000
+
+
+class GameSession:
+    """
+    Everything the bot knows about one game, kept for the whole game stream.
+    The board is live: moves of the stream are pushed one by one, so the engine gets the full move history
+    """
+    def __init__(self, game):
+        """
+        :param game: game dict of the gameStart event
+        """
+        self.game_id = game['gameId']
+        self.variant = game['variant']['key']
+        self.color = game['color']
+        self.opponent_elo = game['opponent'].get('rating', 1500)
+        self.opponent_name = game['opponent']['username']
+        self.has_moved = game.get('hasMoved', True)
+        self.board = None
+        # Moves (uci) received from the stream, the board has the same move stack
+        self.moves = []
+        # Number of moves when the last bot turn was handled (states without a new move aren't a new turn)
+        self.handled_ply = None
+        self.status = 'created'
+        self.wtime = self.btime = self.winc = self.binc = None
+        # When the last clocks were received (time.monotonic)
+        self.clock_time = time.monotonic()
+        # Measured network/API lag of a move (s)
+        self.lag = 0.3
+        # Last CP evaluation of the game, from the bot side
+        self.last_eval = 0
+        # StreamingSearch running for the bot move (None between moves)
+        self.search = None
+        # Skill Level of the last search (key of its cached results)
+        self.skill_level = 20
+        # What the bot move being played is made of (search stats, latency), saved in the game archive
+        self.telemetry = {}
+        self.winner = None
+
+    def update(self, event):
+        """
+        Apply a gameFull or gameState event of the game stream
+        :param event: event dict
+        """
+        if event['type'] == 'gameFull':
+            self.board = new_board(self.variant, event.get('initialFen'))
+            self.moves = []
+            state = event['state']
+        else:
+            state = event
+        self.status = state['status']
+        self.winner = state.get('winner')
+        self.clock_time = time.monotonic()
+        self.wtime = clock_seconds(state['wtime'])
+        self.btime = clock_seconds(state['btime'])
+        self.winc = clock_seconds(state['winc'])
+        self.binc = clock_seconds(state['binc'])
+
+        moves = state['moves'].split()
+        if len(moves) < len(self.moves) or (self.moves and moves[len(self.moves) - 1] != self.moves[-1]):
+            # Takeback: start again from the initial position, the turn after it is a new one
+            self.board = new_board(self.variant, self.board.root().fen())
+            self.moves = []
+            self.handled_ply = None
+        for move in moves[len(self.moves):]:
+            self.board.push_uci(move)
+            self.moves.append(move)
+
+    def is_over(self):
+        return self.status not in ('created', 'started')
+
+    def is_bot_turn(self):
+        return (self.board.turn == chess.WHITE) == (self.color == 'white')
+
+    def is_new_turn(self):
+        """
+        :return: True if it's Bot turn and this position wasn't handled yet (draw offers, takeback offers and clock
+        updates send the same moves again)
+        """
+        return self.is_bot_turn() and self.handled_ply != len(self.moves)
+
+    def bot_clock(self):
+        """
+        :return: seconds left on the bot clock (now, if it's running)
+        """
+        clock = self.wtime if self.color == 'white' else self.btime
+        if self.is_bot_turn():
+            clock -= time.monotonic() - self.clock_time
+        return max(0.0, clock)
+
+    def opponent_clock(self):
+        """
+        :return: seconds left on the opponent clock (now, if it's running)
+        """
+        clock = self.btime if self.color == 'white' else self.wtime
+        if not self.is_bot_turn():
+            clock -= time.monotonic() - self.clock_time
+        return max(0.0, clock)
+
+    def bot_increment(self):
+        return self.winc if self.color == 'white' else self.binc
+
+    def engine_clock(self):
+        """
+        :return: (wtime, btime, winc, binc) for the engine, the bot clock already reduced by the lag
+        """
+        if self.color == 'white':
+            return max(0.0, self.bot_clock() - self.lag), self.btime, self.winc, self.binc
+        return self.wtime, max(0.0, self.bot_clock() - self.lag), self.winc, self.binc
+
+    def update_lag(self, seconds):
+        """
+        Save a measured lag (time of the move API call) as moving average
+        """
+        self.lag = self.lag * 0.7 + seconds * 0.3
@@ -0,0 +1,208 @@
+import random
+import threading
+import time
+from collections import deque
+
+import berserk
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+
+# Requests per second and burst of each endpoint class (Lichess asks to wait a full minute after a 429)
+RATES = {
+    'move': (20, 20),
+    'chat': (1, 3),
+    'challenge': (0.5, 2),
+    'stream': (1, 10),
+    'other': (2, 5),
+}
+RATE_LIMIT_WAIT = 60
+# Endpoint classes whose calls are dropped when their bucket is empty instead of waiting (chat is optional,
+# waiting for it would hold the move of the game)
+DROPPED_WHEN_LIMITED = ('chat',)
+# Retries of a request (429, server errors, connection errors) and max backoff (s)
+MAX_RETRIES = 5
+MAX_BACKOFF = 300
+
+
+class RateLimitDropped(Exception):
+    """
+    Call not sent: its endpoint class is in DROPPED_WHEN_LIMITED and has no token now
+    """
+
+
+def endpoint_class(url):
+    """
+    :param url: url of the API call
+    :return: endpoint class of RATES
+    """
+    if '/move/' in url:
+        return 'move'
+    if '/chat' in url:
+        return 'chat'
+    if '/stream/' in url:
+        return 'stream'
+    if '/challenge' in url:
+        return 'challenge'
+    return 'other'
+
+
+def backoff(attempt, base=1.0):
+    """
+    Exponential backoff with full jitter
+    :param attempt: number of the retry (from 1)
+    :param base: wait of the first retry (s)
+    :return: seconds to wait
+    """
+    return random.uniform(0, min(MAX_BACKOFF, base * 2 ** (attempt - 1)))
+
+
+class TokenBucket:
+    """
+    Allow rate calls per second, with bursts up to burst calls
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        """
+        No calls for these seconds (the server said so)
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def try_acquire(self):
+        """
+        Take a token without waiting
+        :return: True if the call is allowed now
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return False
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def acquire(self):
+        """
+        Wait until a call is allowed
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.updated = self.paused_until
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+
+class RequestCounter:
+    """
+    Count the API calls of the last minute, by endpoint class
+    """
+    def __init__(self):
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def add(self, endpoint):
+        with self._lock:
+            self._calls.append((time.monotonic(), endpoint))
+
+    def per_minute(self):
+        """
+        :return: dict of endpoint class: calls in the last 60 seconds
+        """
+        counts = {}
+        with self._lock:
+            limit = time.monotonic() - 60
+            while self._calls and self._calls[0][0] < limit:
+                self._calls.popleft()
+            for _, endpoint in self._calls:
+                counts[endpoint] = counts.get(endpoint, 0) + 1
+        return counts
+
+
+# Calls of every client of the bot
+counter = RequestCounter()
+
+
+class RateLimitedSession(berserk.TokenSession):
+    """
+    Lichess session of one token: every call waits for its endpoint class bucket (or is dropped, for the classes
+    of DROPPED_WHEN_LIMITED), a 429 pauses the whole token
+    for Retry-After seconds, server and connection errors are retried with exponential backoff.
+    Connections are pooled and kept alive between calls
+    """
+    def __init__(self, token, pool_size=10):
+        super().__init__(token)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.buckets = {endpoint: TokenBucket(rate, burst) for endpoint, (rate, burst) in RATES.items()}
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = endpoint_class(url)
+        attempt = 0
+        while True:
+            attempt += 1
+            if endpoint in DROPPED_WHEN_LIMITED:
+                if not self.buckets[endpoint].try_acquire():
+                    raise RateLimitDropped(f"{endpoint} rate limit")
+            else:
+                self.buckets[endpoint].acquire()
+            counter.add(endpoint)
+            metrics.inc('zoe_api_calls_total', endpoint)
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt > MAX_RETRIES:
+                    raise
+                wait = backoff(attempt)
+                print(f"Lichess {endpoint} call failed ({e}), retrying in {wait:.1f}s")
+                time.sleep(wait)
+                continue
+            if attempt > MAX_RETRIES or (response.status_code != 429 and response.status_code < 500):
+                return response
+            if response.status_code == 429:
+                try:
+                    wait = float(response.headers.get('Retry-After', RATE_LIMIT_WAIT))
+                except ValueError:
+                    wait = RATE_LIMIT_WAIT
+                print(f"Lichess rate limit on {endpoint}, waiting {wait:.0f}s")
+                metrics.inc('zoe_rate_limit_hits_total')
+                for bucket in self.buckets.values():
+                    bucket.pause(wait)
+            else:
+                wait = backoff(attempt)
+                print(f"Lichess error {response.status_code} on {endpoint}, retrying in {wait:.1f}s")
+                time.sleep(wait)
+            response.close()
+
+
+def make_client(token, pool_size=10, base_url=None):
+    """
+    :param token: Lichess API token
+    :param pool_size: HTTP connections kept alive
+    :param base_url: Lichess url (None for lichess.org)
+    :return: berserk.Client using a RateLimitedSession
+    """
+    return berserk.Client(session=RateLimitedSession(token, pool_size), base_url=base_url)
@@ -0,0 +1,186 @@
+import contextlib
+import os
+import tempfile
+import threading
+import time
+
+
+# Upper bounds (s) of the latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Nothing is recorded until start() is called
+enabled = False
+_lock = threading.Lock()
+# name: (type, help)
+_metrics = {}
+# name: {label value: value}, histograms: {label value: [bucket counts..., count, sum]}
+_values = {}
+# Gauges read when the metrics are rendered: name: (label name, function)
+_gauges = {}
+_NULL_TIMER = contextlib.nullcontext()
+
+
+def _register(name, metric_type, help_text, labeled=False):
+    _metrics[name] = (metric_type, help_text)
+    # Counters without labels are shown (as 0) before the first increase
+    _values[name] = {} if labeled or metric_type == 'histogram' else {'': 0}
+
+
+_register('zoe_stage_seconds', 'histogram', 'Latency of the stages of a bot move')
+_register('zoe_api_calls_total', 'counter', 'Lichess API calls by endpoint class', labeled=True)
+_register('zoe_rate_limit_hits_total', 'counter', 'Lichess 429 responses')
+_register('zoe_chat_dropped_total', 'counter', 'Chat messages dropped by the chat rate limit')
+_register('zoe_random_moves_total', 'counter', 'Random moves played after an error')
+_register('zoe_preempted_searches_total', 'counter', 'Searches stopped for a more urgent game')
+_register('zoe_moves_total', 'counter', 'Moves played by source (engine, book, tablebase, cache)', labeled=True)
+_register('zoe_search_failures_total', 'counter', 'Failed searches by error', labeled=True)
+_register('zoe_fallback_moves_total', 'counter', 'Moves played after a failed search by source', labeled=True)
+
+
+def inc(name, label='', value=1):
+    """
+    Increase a counter
+    :param name: counter name
+    :param label: label value (endpoint, source...)
+    """
+    if not enabled:
+        return
+    with _lock:
+        values = _values[name]
+        values[label] = values.get(label, 0) + value
+
+
+def observe(stage, seconds):
+    """
+    Save a latency in the stage histogram
+    """
+    if not enabled:
+        return
+    with _lock:
+        counts = _values['zoe_stage_seconds'].setdefault(stage, [0] * (len(BUCKETS) + 2))
+        for n, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                counts[n] += 1
+        counts[-2] += 1
+        counts[-1] += seconds
+
+
+class _Timer:
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self.start)
+
+
+def timer(stage):
+    """
+    Context manager that measures a stage (does nothing if the metrics are disabled)
+    """
+    if not enabled:
+        return _NULL_TIMER
+    return _Timer(stage)
+
+
+def gauge(name, help_text, read, label_name=None):
+    """
+    Add a gauge read only when the metrics are rendered
+    :param read: function returning the value, or a dict of label value: value if label_name is given
+    :param label_name: name of the label
+    """
+    _metrics[name] = ('gauge', help_text)
+    _gauges[name] = (label_name, read)
+
+
+def _labels(label_name, label):
+    return f'{{{label_name}="{label}"}}' if label != '' else ''
+
+
+def render():
+    """
+    :return: every metric in the Prometheus text format
+    """
+    lines = []
+    label_names = {'zoe_api_calls_total': 'endpoint', 'zoe_moves_total': 'source', 'zoe_search_failures_total': 'error',
+                   'zoe_fallback_moves_total': 'source'}
+    with _lock:
+        values = {name: {label: (list(value) if isinstance(value, list) else value)
+                         for label, value in metric_values.items()} for name, metric_values in _values.items()}
+    for name, (metric_type, help_text) in _metrics.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        if metric_type == 'histogram':
+            for stage, counts in values[name].items():
+                for bound, count in zip(BUCKETS, counts):
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {counts[-2]}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {counts[-2]}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {counts[-1]}')
+        elif metric_type == 'gauge':
+            label_name, read = _gauges[name]
+            try:
+                gauge_values = read() if label_name else {'': read()}
+            except Exception as e:
+                print(f"Metric {name} not read: {e}")
+                continue
+            for label, value in gauge_values.items():
+                lines.append(f"{name}{_labels(label_name, label)} {value}")
+        else:
+            for label, value in values[name].items():
+                lines.append(f"{name}{_labels(label_names.get(name, 'label'), label)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def _serve(port):
+    """
+    Serve /metrics on a local port in a background thread
+    """
+    # Imported only when the endpoint is enabled
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+
+
+def _dump_loop(path, seconds):
+    while True:
+        time.sleep(seconds)
+        # Replace the file atomically, so a reader never sees half of it
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as dump_file:
+            dump_file.write(render())
+        os.replace(tmp_path, path)
+
+
+def start(port=None, dump_path=None, dump_seconds=60):
+    """
+    Enable the metrics
+    :param port: local port of the /metrics HTTP endpoint (None for no endpoint)
+    :param dump_path: file where the metrics are written every dump_seconds (None for no file)
+    """
+    global enabled
+    enabled = True
+    if port:
+        _serve(port)
+        print(f"Metrics on http://127.0.0.1:{port}/metrics")
+    if dump_path:
+        threading.Thread(target=_dump_loop, args=(dump_path, dump_seconds), name='metrics-dump', daemon=True).start()
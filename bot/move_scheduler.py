@@ -0,0 +1,107 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+
+
+# A running search is stopped for a new turn when its game flags at least these seconds later
+PREEMPT_MARGIN = 30
+# Never stop a search before it ran these seconds (it has no move yet)
+MIN_SEARCH_TIME = 0.5
+
+
+class MoveScheduler:
+    """
+    Pending bot turns of all the games in a priority queue, the game that flags first is served first.
+    A fixed number of workers run the turns, so the searches at the same time are bounded.
+    When every worker is busy, a turn much more urgent stops the least urgent search (it plays its best move so far)
+    """
+    def __init__(self, workers=2):
+        """
+        :param workers: number of turns run at the same time
+        """
+        self.workers = workers
+        self._queue = []
+        # Same time to flag: first submitted, first served
+        self._counter = itertools.count()
+        # worker name: (flag time, session) of the running turns
+        self._running = {}
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        with self._condition:
+            if self._threads:
+                return
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f'move-worker-{n}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, session, func):
+        """
+        Queue a bot turn
+        :param session: GameSession of the game
+        :param func: function called with the session by a worker
+        :return: Future with the result of func
+        """
+        self.start()
+        future = Future()
+        flag_time = time.monotonic() + session.bot_clock()
+        with self._condition:
+            heapq.heappush(self._queue, (flag_time, next(self._counter), session, func, future))
+            if len(self._running) >= self.workers:
+                self._preempt(flag_time)
+            self._condition.notify()
+        return future
+
+    def _preempt(self, flag_time):
+        """
+        Stop the least urgent running search if the new turn flags much before it
+        """
+        if not self._running:
+            return
+        running_flag, session = max(self._running.values(), key=lambda item: item[0])
+        search = session.search
+        if search is None or running_flag - flag_time < PREEMPT_MARGIN or search.elapsed() < MIN_SEARCH_TIME:
+            return
+        print(f"Search of {session.game_id} stopped for a more urgent game")
+        search.stop()
+        metrics.inc('zoe_preempted_searches_total')
+
+    def pending(self):
+        """
+        :return: number of turns waiting for a worker
+        """
+        with self._condition:
+            return len(self._queue)
+
+    def _worker(self):
+        name = threading.current_thread().name
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                flag_time, _, session, func, future = heapq.heappop(self._queue)
+                self._running[name] = (flag_time, session)
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(func(session))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._condition:
+                    self._running.pop(name, None)
+
+
+# Scheduler configured at startup by configure()
+scheduler = MoveScheduler()
+
+
+def configure(workers=2):
+    global scheduler
+    scheduler = MoveScheduler(workers)
@@ -1,35 +1,42 @@
+# First: the startup times count from its import
+import startup
 import berserk
-import asyncio
 import yaml
 import chess
-import chess.engine
-import chess.pgn
-import chess.variant
+import csv
 import random
-import pandas as pd
+import signal
+import sys
 import threading
+import multiprocessing
+import os
 import time
 from pathlib import Path
-import sys
-import platform
-
-import run_telegram_bot
 
+import telegram_notifier
+import engine_pool
+import resource_scheduler
+import move_scheduler
+import opening_book
+import eval_cache
+import tablebase
+import lichess_api
+import metrics
+import supervisor
+import admission
+import game_archive
+import engine_search
+import time_manager
+import settings_store
+import strength_table
+from game_session import GameSession, new_board
+startup.mark('imports')
 
-# Avoid max recursion limit
-sys.setrecursionlimit(100000)
 THIS_FOLDER = Path(__file__).parent.resolve()
-# Path of Stockfish binary (try both Windows and Linux Paths)
-if platform.system() == 'Windows':
-    STOCKFISH_PATH = THIS_FOLDER / "../stockfish/stockfish-windows-x86-64-avx2.exe"
-    FAIRY_STOCKFISH_PATH = THIS_FOLDER / "../stockfish/Fairy/Windows/fairy-stockfish-largeboard_x86-64-bmi2.exe"
-else:
-    STOCKFISH_PATH = THIS_FOLDER / "../stockfish/stockfish-ubuntu-x86-64-avx2"
-    FAIRY_STOCKFISH_PATH = THIS_FOLDER / "../stockfish/Fairy/Linux/fairy-stockfish-largeboard_x86-64-bmi2"
-
-config_path = THIS_FOLDER / "config.yml"
-# Ollama chat
-df_chat = pd.read_csv(THIS_FOLDER / "../database/AIChat.csv")
+# ZOE_CONFIG can point to another config (as the one of benchmark.py)
+config_path = Path(os.environ.get('ZOE_CONFIG', THIS_FOLDER / "config.yml"))
+# Ollama chat messages, loaded by load_chat_lines()
+chat_lines = None
 
 # global variable to send challenges (input starts from Telegram)
 challenge_mode = 0
@@ -39,100 +46,158 @@ try_challenge = 0
 # List of active games id:
 list_playing_id = []
 
-# List of active games with less than 2':
-hurry_list = []
+# Lichess id of the bot account (set when the event stream starts)
+bot_id = None
+
+# Depth of the search at which the score is used to set thinking time and depth
+EARLY_SCORE_DEPTH = 8
+# Depth of the shallow search of a fallback move
+EMERGENCY_DEPTH = 6
+# Max depth of a search (the depth of the UCI_Elo mode, stopped by its node budget)
+MAX_DEPTH = 50
+# Elo of a Skill Level step, to follow the level changes of the CP evaluation in the UCI_Elo mode
+ELO_PER_SKILL_LEVEL = 100
+# Reconnections of a game stream in a row (with backoff) before the game is left
+MAX_STREAM_RECONNECTS = 10
 
 
 # Load configuration from file config.yml
 with open(config_path, 'r') as config_file:
     config = yaml.safe_load(config_file)
+# Written when the bot is ready to play at full speed
+READY_FILE = config.get('ready_file')
+startup.mark('config')
+
+# Supervisor mode: this process follows the events and sends the games to worker_processes processes
+WORKER_PROCESSES = config.get('worker_processes', 0)
+# Only with worker_processes: a child process of another kind (a process pool importing this module) is no worker
+IS_WORKER = WORKER_PROCESSES > 0 and multiprocessing.parent_process() is not None
+IS_SUPERVISOR = WORKER_PROCESSES > 0 and not IS_WORKER
+# Workers of the supervisor mode (Supervisor), None when the games are played by this process
+game_supervisor = None
 
-# Configure Lichess client with token
-session = berserk.TokenSession(config['token'])
-client = berserk.Client(session=session)
-# Configure Challenges Lichess client to read challenges only
-challenges_session = berserk.TokenSession(config['challenges_token'])
-client_challenges = berserk.Client(session=challenges_session)
-# Configure Telegram bot with token
+# Configure Lichess client with token: rate limited by endpoint, retries with backoff, pooled connections
+client = lichess_api.make_client(config['token'], config.get('http_pool_size', 10), config.get('lichess_url'))
+# Engines in other folders
+STOCKFISH_PATH = config.get('stockfish_path', engine_pool.DEFAULT_STOCKFISH_PATH)
+FAIRY_STOCKFISH_PATH = config.get('fairy_stockfish_path', engine_pool.DEFAULT_FAIRY_PATH)
+# Configure Telegram bot with token, messages are sent in background as a digest every tg_digest_seconds
 telegram_token = config['tg_token']
+telegram_notifier.configure(telegram_token, config.get('tg_myid'),
+                            digest_seconds=config.get('tg_digest_seconds', 5),
+                            max_queue=config.get('tg_queue_size', 100))
+
+# Syzygy endgame tables, probed before the search and used by Stockfish in its search
+syzygy_path = config.get('syzygy_path')
+if tablebase.configure(syzygy_path, config.get('syzygy_max_pieces', 6)):
+    stockfish_options = {"SyzygyPath": str(syzygy_path)}
+else:
+    stockfish_options = None
+# Long-lived Stockfish and Fairy-Stockfish engines, shared by every game, spawned by warm_up()
+# (the supervisor doesn't play)
+engine_pool.configure_pools(STOCKFISH_PATH, FAIRY_STOCKFISH_PATH,
+                            stockfish_size=config.get('engine_pool_size', 2),
+                            fairy_size=config.get('fairy_pool_size', 1),
+                            stockfish_options=stockfish_options,
+                            max_ponder=config.get('ponder_max_games', 1),
+                            prespawn=False)
+# CPU cores and hash memory shared by the engines of all the games (of all the workers)
+if IS_WORKER:
+    cores = max(1, (config.get('engine_cores') or os.cpu_count() or 1) // WORKER_PROCESSES)
+    resource_scheduler.configure(cores=cores, hash_budget=config.get('hash_budget', 1024) // WORKER_PROCESSES)
+else:
+    resource_scheduler.configure(cores=config.get('engine_cores'), hash_budget=config.get('hash_budget', 1024))
+# Bot turns of all the games are run by a fixed number of workers
+move_scheduler.configure(workers=config.get('move_workers', config.get('engine_pool_size', 2)))
+# Human moves of the Lichess database (built by build_opening_book.py), memory mapped
+opening_book.configure(config.get('opening_book', THIS_FOLDER / "../database/OpeningBook.bin"))
+# Latency of the stages of a move, API calls, active games: on a local /metrics endpoint and/or dumped to a file.
+# Workers use the next ports and files (see worker_main)
+if (config.get('metrics_port') or config.get('metrics_file')) and not IS_WORKER:
+    metrics.start(config.get('metrics_port'), config.get('metrics_file'), config.get('metrics_dump_seconds', 60))
+    metrics.gauge('zoe_active_games', 'Games in progress',
+                  lambda: len(game_supervisor.playing()) if game_supervisor else len(list_playing_id))
+    metrics.gauge('zoe_pending_turns', 'Bot turns waiting for a worker', lambda: move_scheduler.scheduler.pending())
+    metrics.gauge('zoe_engines_busy', 'Engines searching or pondering',
+                  lambda: sum(busy for _, busy in engine_pool.engine_states()))
+    metrics.gauge('zoe_engines', 'Engines alive', lambda: len(engine_pool.engine_states()))
+    metrics.gauge('zoe_ready', 'Startup finished, the bot plays at full speed', lambda: int(startup.ready))
+    metrics.gauge('zoe_startup_seconds', 'Seconds of every stage of the startup', lambda: dict(startup.stages),
+                  label_name='stage')
+# New games are accepted only while the engines have capacity for them
+admission.configure(cores=config.get('engine_cores'), utilization=config.get('admission_utilization', 0.8),
+                    speed_limits=config.get('max_games_per_speed'), variant_limits=config.get('max_games_per_variant'))
+# Search results of the positions already seen, saved to disk if eval_cache_db is setted. The supervisor doesn't
+# search, every worker opens its own file in worker_main (concurrent writers would wait for the SQLite lock)
+if WORKER_PROCESSES == 0:
+    eval_cache.configure(config.get('eval_cache_size', 100000), config.get('eval_cache_db'))
+# Every game with the stats of every bot move, written in background to archive_dir
+game_archive.configure(config.get('archive_dir', THIS_FOLDER / "../database/archive"),
+                       config.get('archive_file_mb', 64) * 1024 * 1024, config.get('archive_max_files', 0))
+# Params setted from Telegram, shared with run_telegram_bot.py
+settings_store.configure(config.get('settings_csv', settings_store.SETTINGS_CSV))
+# Engine settings by opponent Elo measured by calibration.py (the built-in levels if there is no table)
+strength_table.configure(config.get('strength_table', THIS_FOLDER / "../database/strength_table.json"))
+startup.mark('setup')
+
+
+def ponder_enabled(settings):
+    """
+    Check if the bot should think on the opponent's clock: Ponder setting from Telegram (1 on, -1 off)
+    or ponder in config.yml when not setted
+    :param settings: settings_store.Settings of the game
+    """
+    set_ponder = settings.ponder
+    if set_ponder > 0:
+        return True
+    elif set_ponder < 0:
+        return False
+    return config.get('ponder', True)
+
+
+def elo_mode_enabled(settings):
+    """
+    Check if the bot should weaken Stockfish with UCI_LimitStrength/UCI_Elo and a node budget instead of Skill Level,
+    depth and threads: Elo_Mode setting from Telegram (1 on, -1 off) or elo_mode in config.yml when not setted
+    :param settings: settings_store.Settings of the game
+    """
+    set_elo_mode = settings.elo_mode
+    if set_elo_mode > 0:
+        return True
+    elif set_elo_mode < 0:
+        return False
+    return config.get('elo_mode', False)
 
 
-# Global shared (between Lichess and Telegram Bots) functions
-def load_global_db(search_for='', game_for='', action='', add_value=0):
-    """
-    This csv file will be shared between Lichess and Telegram Bots to set params
-    Load the param(s) you are setting
-    :param search_for: str to tell what column to access (Level, Think or Wait_Api)
-    :param game_for: value to access if a particular opponent or game to set params
-    :param action: set or get
-    :param add_value: value to be set
-    :return: DataFrame to access modified params
-    """
-    # Set level from Telegram db
-    global_csv = THIS_FOLDER / "../database/Settings.csv"
-    df_global = pd.read_csv(global_csv)
-    if action == 'get':
-        if game_for == 'global':
-            df_global = df_global[df_global['Game'] == game_for]
-            if search_for == 'level' and len(df_global) == 1:
-                return df_global['Level'][0]
-            elif search_for == 'think' and len(df_global) == 1:
-                return df_global['Think'][0]
-            elif search_for == 'hash' and len(df_global) == 1:
-                return df_global['Hash'][0]
-            elif search_for == 'depth' and len(df_global) == 1:
-                return df_global['Depth'][0]
-            elif search_for == 'thread' and len(df_global) == 1:
-                return df_global['Thread'][0]
-            elif search_for == 'wait_api' and len(df_global) == 1:
-                return df_global['Wait_Api'][0]
-            elif search_for == 'challenge_loops' and len(df_global) == 1:
-                return df_global['Challenge_Loops'][0]
-            elif search_for == 'challenge_time' and len(df_global) == 1:
-                return df_global['Challenge_Time'][0]
-            elif search_for == 'challenge_increment' and len(df_global) == 1:
-                return df_global['Challenge_Increment'][0]
-            elif search_for == 'challenge_opp_elo' and len(df_global) == 1:
-                return df_global['Challenge_Opponent_Elo'][0]
-            elif search_for == 'challenge_variant' and len(df_global) == 1:
-                return df_global['Challenge_Variant'][0]
-    elif action == 'set':
-        if game_for == 'global':
-            if search_for == 'level':
-                df_global.loc[df_global['Game'] == game_for, 'Level'] = add_value
-            elif search_for == 'think':
-                df_global.loc[df_global['Game'] == game_for, 'Think'] = add_value
-            elif search_for == 'hash':
-                df_global.loc[df_global['Game'] == game_for, 'Hash'] = add_value
-            elif search_for == 'depth':
-                df_global.loc[df_global['Game'] == game_for, 'Depth'] = add_value
-            elif search_for == 'thread':
-                df_global.loc[df_global['Game'] == game_for, 'Thread'] = add_value
-            elif search_for == 'wait_api':
-                df_global.loc[df_global['Game'] == game_for, 'Wait_Api'] = add_value
-            elif search_for == 'challenge_loops':
-                df_global.loc[df_global['Game'] == game_for, 'Challenge_Loops'] = add_value
-            elif search_for == 'challenge_time':
-                df_global.loc[df_global['Game'] == game_for, 'Challenge_Time'] = add_value
-            elif search_for == 'challenge_increment':
-                df_global.loc[df_global['Game'] == game_for, 'Challenge_Increment'] = add_value
-            elif search_for == 'challenge_opp_elo':
-                df_global.loc[df_global['Game'] == game_for, 'Challenge_Opponent_Elo'] = add_value
-            elif search_for == 'challenge_variant':
-                df_global.loc[df_global['Game'] == game_for, 'Challenge_Variant'] = add_value
-            # Save csv
-            df_global.to_csv(global_csv)
+def load_chat_lines():
+    """
+    Read the chat messages (those are generated by AI messages) of AIChat.csv
+    """
+    global chat_lines
+    with open(THIS_FOLDER / "../database/AIChat.csv", newline='', encoding='utf-8') as chat_file:
+        chat_lines = [row['Intro_message'] for row in csv.DictReader(chat_file)]
 
 
 def random_chat():
     """
-    Pick a random message of the df_chat (those are generated by AI messages) to send in Lichess chat
+    Pick a random chat message to send in Lichess chat
     :return: random message
     """
-    global df_chat
-    chat = df_chat['Intro_message'].to_list()
-    send_random_chat = chat[random.randint(0, len(chat))]
-    return send_random_chat
+    if chat_lines is None:
+        load_chat_lines()
+    return random.choice(chat_lines)
+
+
+def warm_up():
+    """
+    Get ready what the first move needs, so it doesn't pay the cold start: engines spawned (at the same time),
+    ready and with their network loaded, opening book pages read, chat messages loaded
+    """
+    engine_pool.warm_up_pools(fairy=config.get('warm_up_fairy', False))
+    startup.mark('engines')
+    opening_book.prefetch()
+    load_chat_lines()
+    startup.mark('book and chat')
 
 
 def create_challenge(username, ch_time, ch_incr):
@@ -146,7 +211,7 @@ def create_challenge(username, ch_time, ch_incr):
                              clock_increment=ch_incr)
     message = f'Challenging USER: {username}'
     print(message)
-    run_telegram_bot.send_message_to_telegram(telegram_token, message)
+    telegram_notifier.notify(message)
     try_challenge = 0
 
 
@@ -157,10 +222,11 @@ def send_challenge():
     global challenge_mode, try_challenge
     if try_challenge <= 3:
         try:
-            set_challenge_time = int(load_global_db('challenge_time', 'global', 'get', 0))
-            set_challenge_increment = int(load_global_db('challenge_increment', 'global', 'get', 0))
-            set_challenge_oppelo = int(load_global_db('challenge_opp_elo', 'global', 'get', 0))
-            set_challenge_variant = load_global_db('challenge_variant', 'global', 'get', 0)
+            settings = settings_store.get_settings()
+            set_challenge_time = settings.challenge_time
+            set_challenge_increment = settings.challenge_increment
+            set_challenge_oppelo = settings.challenge_opp_elo
+            set_challenge_variant = settings.challenge_variant
             if set_challenge_time < 180:
                 challenge_time = 900
             else:
@@ -173,6 +239,12 @@ def send_challenge():
                 challenge_elo = 3000
             else:
                 challenge_elo = set_challenge_oppelo
+            # No new games while the engines are saturated
+            accept, reason = admission.controller.can_accept(
+                admission.speed_of(challenge_time, challenge_increment), set_challenge_variant)
+            if not accept:
+                print(f'Challenges paused: {reason}')
+                return
 
             print(f'Searching for bots with Elo >= {challenge_elo}')
             active_bots = client.bots.get_online_bots()
@@ -191,7 +263,7 @@ def send_challenge():
                                          variant=set_challenge_variant)
                 message = f'Challenging: {rand_bot}'
                 print(message)
-                run_telegram_bot.send_message_to_telegram(telegram_token, message)
+                telegram_notifier.notify(message)
                 try_challenge = 0
             else:
                 print(f"No bots with rating >= {challenge_elo} found.")
@@ -201,489 +273,771 @@ def send_challenge():
 
 
 # STOCKFISH FUNCTIONS
-def evaluate_position_cp(fen, variant):
-    """
-    Analyze the position and returns CP value (int)
-    :param fen: fen position
-    :param variant: type of chess variant (normal is "standard")
-    :return: CP value (int)
-    """
-    global STOCKFISH_PATH, FAIRY_STOCKFISH_PATH
-
-    # Use Stockfish for standard games and Fairy Stockfish for variants, set boards for each
-    if variant == 'standard' or variant == 'chess960' or variant == 'fromPosition':
-        path = STOCKFISH_PATH
-        board = chess.Board(fen)
-    elif variant == 'crazyhouse':
-        path = FAIRY_STOCKFISH_PATH
-        board = chess.variant.CrazyhouseBoard(fen)
-    elif variant == 'antichess':
-        path = FAIRY_STOCKFISH_PATH
-        board = chess.variant.AntichessBoard(fen)
-    elif variant == 'atomic':
-        path = FAIRY_STOCKFISH_PATH
-        board = chess.variant.AtomicBoard(fen)
-    elif variant == 'horde':
-        path = FAIRY_STOCKFISH_PATH
-        board = chess.variant.HordeBoard(fen)
-    elif variant == 'kingOfTheHill':
-        path = FAIRY_STOCKFISH_PATH
-        board = chess.variant.KingOfTheHillBoard(fen)
-    elif variant == 'racingKings':
-        path = FAIRY_STOCKFISH_PATH
-        board = chess.variant.RacingKingsBoard(fen)
-    elif variant == 'threeCheck':
-        path = FAIRY_STOCKFISH_PATH
-        board = chess.variant.ThreeCheckBoard(fen)
-
-    with chess.engine.SimpleEngine.popen_uci(path) as engine:
-        info = engine.analyse(board, chess.engine.Limit(time=2.0))
-        cp = str(info['score'].relative)
-        if "#" in cp:
-            cp = cp[1:]
-            cp = int(cp) * 1000
-        else:
-            cp = int(cp)
-        return cp
+def adjust_for_cp(cp, deep_time, skill_level, hash_m, depth, threads_m):
+    """
+    Change Stockfish parameters based on how good or bad the position is (the worse, the stronger)
+    :param cp: CP evaluation of the position, from the bot side
+    :return: deep_time, skill_level, hash_m, depth, threads_m adjusted
+    """
+    if cp > 800:
+        skill_level = 20
+    elif 400 < cp <= 600:
+        deep_time *= 0.5
+        skill_level -= 4
+        hash_m *= 0.7
+        depth *= 0.6
+        threads_m *= 0.7
+    elif 100 < cp <= 400:
+        deep_time *= 0.7
+        skill_level -= 3
+        hash_m *= 0.8
+        depth *= 0.8
+        threads_m *= 0.8
+    elif 50 < cp <= 100:
+        deep_time *= 0.8
+        skill_level -= 2
+        hash_m *= 0.9
+        depth *= 0.9
+        threads_m *= 0.9
+    elif 0 < cp <= 50:
+        deep_time *= 0.9
+        skill_level -= 1
+    elif cp == 0:
+        pass
+    elif -50 < cp < 0:
+        deep_time *= 1.1
+        skill_level += 1
+    elif -100 < cp <= 50:
+        deep_time *= 1.4
+        skill_level += 2
+        hash_m = hash_m * 1.05 + 50
+    elif -200 < cp <= -100:
+        deep_time *= 2
+        skill_level += 3
+        hash_m = hash_m * 1.1 + 100
+        threads_m *= 1.1
+    elif -400 < cp <= -200:
+        deep_time *= 4
+        skill_level += 5
+        hash_m = hash_m * 1.3 + 200
+        threads_m *= 1.2
+    elif cp < -400:
+        deep_time *= 7
+        skill_level = 20
+        hash_m = hash_m * 1.5 + 300
+        threads_m *= 1.4
+    return deep_time, skill_level, hash_m, depth, threads_m
+
+
+def estimate_elo(skill_level, hash_m, depth, threads_m, deep_time):
+    """
+    Estimate Stockfish Elo strength from its params (measured by calibration.py if there is a strength table)
+    """
+    elo = strength_table.measured_elo(strength_table.Level(deep_time, skill_level, hash_m, depth, threads_m))
+    if elo is not None:
+        return elo
+    try:
+        return (skill_level/20 + hash_m/3000 + depth/30 + threads_m/12 + deep_time/20) / 5 * 3200
+    except:
+        return 2000
 
 
-def stockfish_best_move(fen, opponent_elo, opponent_name, game_id, variant):
+def stockfish_best_move(session):
     """
     Stockfish analyzes position and finds the best move with its parameters based on opponent_elo
-    :param fen: fen position
-    :param opponent_elo / opponent_name: elo and name of opponent
-    :param game_id: id of Lichess game
-    :param variant: type of chess variant (normal is "standard")
+    :param session: GameSession of the game (its board has the whole move history)
     :return: best move for that thinking time
     """
-    global STOCKFISH_PATH, FAIRY_STOCKFISH_PATH
+    game_id = session.game_id
+    variant = session.variant
+    opponent_elo = session.opponent_elo
+    opponent_name = session.opponent_name
 
     def get_level_time():
         """
         Set base level, thinking time, hash memory, move depth and threads_m based on Elo
+        (measured by calibration.py if there is a strength table)
         """
-        if opponent_elo <= 700:
-            deep_time = 0.2
-            skill_level = 2
-            hash_m = 16
-            depth = 4
-            threads_m = 4
-        elif opponent_elo <= 1000:
-            deep_time = 0.5
-            skill_level = 4
-            hash_m = 16
-            depth = 8
-            threads_m = 8
-        elif opponent_elo <= 1500:
-            deep_time = 1.0
-            skill_level = 9
-            hash_m = 32
-            depth = 10
-            threads_m = 11
-        elif opponent_elo <= 2000:
-            deep_time = 1.5
-            skill_level = 14
-            hash_m = 128
-            depth = 12
-            threads_m = 11
-        elif opponent_elo <= 2300:
-            deep_time = 2.3
-            skill_level = 16
-            hash_m = 512
-            depth = 15
-            threads_m = 13
-        elif opponent_elo <= 2500:
-            deep_time = 5.0
-            skill_level = 18
-            hash_m = 1028
-            depth = 20
-            threads_m = 15
-        else:
-            deep_time = 10.0
-            skill_level = 20
-            hash_m = 2056
-            depth = 25
-            threads_m = 18
-        return deep_time, skill_level, hash_m, depth, threads_m
-
-    # Use Stockfish for standard games and Fairy Stockfish for variants, set boards for each
-    if variant == 'standard' or variant == 'chess960' or variant == 'fromPosition':
-        path = STOCKFISH_PATH
-        board = chess.Board(fen)
-    elif variant == 'crazyhouse':
-        path = FAIRY_STOCKFISH_PATH
-        board = chess.variant.CrazyhouseBoard(fen)
-    elif variant == 'antichess':
-        path = FAIRY_STOCKFISH_PATH
-        board = chess.variant.AntichessBoard(fen)
-    elif variant == 'atomic':
-        path = FAIRY_STOCKFISH_PATH
-        board = chess.variant.AtomicBoard(fen)
-    elif variant == 'horde':
-        path = FAIRY_STOCKFISH_PATH
-        board = chess.variant.HordeBoard(fen)
-    elif variant == 'kingOfTheHill':
-        path = FAIRY_STOCKFISH_PATH
-        board = chess.variant.KingOfTheHillBoard(fen)
-    elif variant == 'racingKings':
-        path = FAIRY_STOCKFISH_PATH
-        board = chess.variant.RacingKingsBoard(fen)
-    elif variant == 'threeCheck':
-        path = FAIRY_STOCKFISH_PATH
-        board = chess.variant.ThreeCheckBoard(fen)
-
-    if game_id in hurry_list:
-        # Make Stockfish move faster, avoiding Telegram interaction, if the id has less than 2'
-        deep_time = 1
-        hash_m = 2000
+        return strength_table.level_for(opponent_elo)
+
+    # Level, hash and threads can't change during a search, so they follow the last CP evaluation of this
+    # game. Thinking time and depth follow the early score of the search itself
+    cp = session.last_eval
+    base_time, base_skill, hash_m, base_depth, threads_m = get_level_time()
+    deep_time, skill_level, hash_m, depth, threads_m = adjust_for_cp(cp, base_time, base_skill, hash_m,
+                                                                     base_depth, threads_m)
+    adjust_time = adjust_depth = True
+    if skill_level < 1:
+        skill_level = 1
+    elif skill_level > 20:
+        skill_level = 20
+    if threads_m >= 12:
         threads_m = 12
-        depth = 15
+    # Params setted from Telegram Bot, for this game or global
+    with metrics.timer('settings'):
+        settings = settings_store.get_settings(game_id)
+    session.ponder = ponder_enabled(settings)
+    # Check if a shared global var Level is setted (to modify level from Telegram Bot)
+    set_level = settings.level
+    if set_level <= 0 or set_level is None:
+        # Not setted
+        pass
+    elif set_level < 0:
+        skill_level = 1
+    elif set_level > 20:
         skill_level = 20
-        elo_strength = (skill_level/20 + hash_m/3000 + depth/30 + threads_m/12 + deep_time/20) / 5 * 3200
     else:
-        # Standard use. Evaluate position CP to determine Stockfish strength
-        cp = evaluate_position_cp(fen, variant)
-        deep_time, skill_level, hash_m, depth, threads_m = get_level_time()
-        if cp > 800:
-            skill_level = 20
-        elif 400 < cp <= 600:
-            deep_time *= 0.5
-            skill_level -= 4
-            hash_m *= 0.7
-            depth *= 0.6
-            threads_m *= 0.7
-        elif 100 < cp <= 400:
-            deep_time *= 0.7
-            skill_level -= 3
-            hash_m *= 0.8
-            depth *= 0.8
-            threads_m *= 0.8
-        elif 50 < cp <= 100:
-            deep_time *= 0.8
-            skill_level -= 2
-            hash_m *= 0.9
-            depth *= 0.9
-            threads_m *= 0.9
-        elif 0 < cp <= 50:
-            deep_time *= 0.9
-            skill_level -= 1
-        elif cp == 0:
-            pass
-        elif -50 < cp < 0:
-            deep_time *= 1.1
-            skill_level += 1
-        elif -100 < cp <= 50:
-            deep_time *= 1.4
-            skill_level += 2
-            hash_m = hash_m * 1.05 + 50
-        elif -200 < cp <= -100:
-            deep_time *= 2
-            skill_level += 3
-            hash_m = hash_m * 1.1 + 100
-            threads_m *= 1.1
-        elif -400 < cp <= -200:
-            deep_time *= 4
-            skill_level += 5
-            hash_m = hash_m * 1.3 + 200
-            threads_m *= 1.2
-        elif cp < -400:
-            deep_time *= 7
-            skill_level = 20
-            hash_m = hash_m * 1.5 + 300
-            threads_m *= 1.4
-        if skill_level < 1:
-            skill_level = 1
-        elif skill_level > 20:
-            skill_level = 20
-        if threads_m >= 12:
-            threads_m = 12
-        # Check if a shared global var Level is setted (to modify level from Telegram Bot)
-        set_level = load_global_db('level', 'global', 'get', 0)
-        if set_level <= 0 or set_level is None:
-            # Not setted
-            pass
-        elif set_level < 0:
-            skill_level = 1
-        elif set_level > 20:
-            skill_level = 20
-        else:
-            skill_level = set_level
-        # Check if shared global var Think is setted (to modify thinking time from Telegram Bot)
-        set_think = load_global_db('think', 'global', 'get', 0)
-        if set_think <= 0 or set_think is None:
-            # Not setted
-            pass
-        elif set_think >= 3600:
-            deep_time = 3600
-        else:
-            deep_time = set_think
-        # Check if shared global var Hash is setted (to modify hash memory from Telegram Bot)
-        set_hash = load_global_db('hash', 'global', 'get', 0)
-        if set_hash <= 0 or set_hash is None:
-            # Not setted
-            pass
-        elif set_hash >= 5100:
-            hash_m = 5100
+        skill_level = set_level
+    # UCI_Elo mode: Stockfish plays at the target Elo by itself, the node budget, threads and hash are the smallest
+    # that reach it (Fairy-Stockfish Elo isn't calibrated the same, variants keep Skill Level)
+    elo_mode = elo_mode_enabled(settings) and variant in engine_pool.STANDARD_VARIANTS
+    uci_elo = nodes = None
+    if elo_mode:
+        if set_level > 0:
+            # Level setted from Telegram: the same share of the UCI_Elo range
+            target_elo = strength_table.UCI_MIN_ELO + skill_level / 20 * (strength_table.UCI_MAX_ELO -
+                                                                           strength_table.UCI_MIN_ELO)
         else:
-            hash_m = set_hash
-        # Check if shared global var Depth is setted (to modify depth moves from Telegram Bot)
-        set_depth = load_global_db('depth', 'global', 'get', 0)
-        if set_depth <= 0 or set_depth is None:
-            # Not setted
-            pass
-        elif set_depth >= 50:
-            depth = 50
-        else:
-            depth = set_depth
-        # Check if shared global var Thread is setted (to modify threads from Telegram Bot)
-        set_thread = load_global_db('thread', 'global', 'get', 0)
-        if set_thread <= 0 or set_thread is None:
-            # Not setted
-            pass
-        elif set_thread >= 12:
-            threads_m = 12
+            # The level changes of the CP evaluation, in Elo
+            target_elo = opponent_elo + (skill_level - base_skill) * ELO_PER_SKILL_LEVEL
+        uci_elo = round(min(strength_table.UCI_MAX_ELO, max(strength_table.UCI_MIN_ELO, target_elo)))
+        elo_level = strength_table.elo_level_for(target_elo)
+        nodes, threads_m, hash_m = elo_level
+        # The node budget ends the search, not the depth
+        depth = MAX_DEPTH
+        adjust_depth = False
+        skill_level = 0
+    # Check if shared global var Think is setted (to modify thinking time from Telegram Bot)
+    set_think = settings.think
+    if set_think <= 0 or set_think is None:
+        # Not setted
+        pass
+    elif set_think >= 3600:
+        deep_time = 3600
+        adjust_time = False
+    else:
+        deep_time = set_think
+        adjust_time = False
+    # Check if shared global var Hash is setted (to modify hash memory from Telegram Bot)
+    set_hash = settings.hash
+    if set_hash <= 0 or set_hash is None:
+        # Not setted
+        pass
+    elif set_hash >= 5100:
+        hash_m = 5100
+    else:
+        hash_m = set_hash
+    # Check if shared global var Depth is setted (to modify depth moves from Telegram Bot)
+    set_depth = settings.depth
+    if set_depth <= 0 or set_depth is None:
+        # Not setted
+        pass
+    elif set_depth >= MAX_DEPTH:
+        depth = MAX_DEPTH
+        adjust_depth = False
+    else:
+        depth = set_depth
+        adjust_depth = False
+    # Check if shared global var Thread is setted (to modify threads from Telegram Bot)
+    set_thread = settings.thread
+    if set_thread <= 0 or set_thread is None:
+        # Not setted
+        pass
+    elif set_thread >= 12:
+        threads_m = 12
+    else:
+        threads_m = set_thread
+
+    # Stay within the clock: stop at the soft deadline if the best move is stable, always at the hard one
+    clock_soft, clock_hard = time_manager.move_deadlines(session.bot_clock(), session.bot_increment(),
+                                                         session.board.fullmove_number, session.lag)
+
+    def deadlines(wanted_time):
+        soft_time = min(wanted_time, clock_soft)
+        return soft_time, min(clock_hard, max(soft_time, wanted_time))
+
+    soft_time, hard_time = deadlines(deep_time)
+    # After it the engine is no longer awaited and a fallback move is played
+    wait_time = time_manager.wait_deadline(hard_time, session.bot_clock(), session.lag)
+    session.skill_level = skill_level
+
+    # Same position already searched deep enough (transposition, another game, before a restart): no search
+    # Results of full strength searches don't fit the UCI_Elo mode
+    with metrics.timer('cache'):
+        cached = None if elo_mode else eval_cache.cache.get(session.board, variant, skill_level, round(depth))
+    if cached is not None and chess.Move.from_uci(cached.move) in session.board.legal_moves:
+        print(f'Cache hit: {cached.move} at depth {cached.depth}')
+        metrics.inc('zoe_moves_total', 'cache')
+        session.last_eval = cached.cp
+        elo_strength = estimate_elo(skill_level, hash_m, depth, threads_m, deep_time)
+        session.telemetry.update(source='cache', cp=cached.cp, depth=cached.depth, skill_level=skill_level,
+                                 elo=round(elo_strength))
+        return chess.Move.from_uci(cached.move), round(elo_strength)
+
+    pool = engine_pool.get_pool(variant)
+    # Time waiting for a free engine (or spawning one)
+    checkout_start = time.perf_counter()
+    with pool.checkout(game_id) as pooled:
+        metrics.observe('engine_checkout', time.perf_counter() - checkout_start)
+        max_depth = round(max(depth, base_depth)) if adjust_depth else round(depth)
+        search = None
+        if pooled.ponder is not None:
+            if pooled.ponder_board == session.board and len(pooled.ponder_board.move_stack) == len(session.moves):
+                # Ponderhit: the opponent played the expected move, go on with the search started on his clock.
+                # Thinking time counts from the start of the ponder, so it can be already over
+                print('Ponderhit')
+                search = pooled.ponder
+                search.set_think_time(hard_time)
+                search.set_deadline(search.elapsed() + wait_time)
+                pooled.ponder = pooled.ponder_board = None
+            else:
+                pooled.stop_ponder()
+        if search is None:
+            # Threads and hash (in MB) are shared with the engines of the other games
+            with metrics.timer('configure'):
+                threads_m, hash_m = resource_scheduler.scheduler.allocate(game_id, pooled, round(threads_m),
+                                                                          round(hash_m))
+                # Set level and the lag of the moves (only the ones that changed since the last search)
+                if elo_mode:
+                    # Skill Level is ignored with UCI_LimitStrength, at full strength it must not weaken it
+                    options = {"Skill Level": 20, "UCI_LimitStrength": uci_elo < strength_table.UCI_MAX_ELO,
+                               "UCI_Elo": uci_elo}
+                else:
+                    options = {"Skill Level": skill_level}
+                    if "UCI_LimitStrength" in pooled.engine.options:
+                        options["UCI_LimitStrength"] = False
+                if "Move Overhead" in pooled.engine.options:
+                    options["Move Overhead"] = round(session.lag * 1000)
+                pooled.configure(options)
+            # A single search: its first scores set thinking time and depth, then it goes on to find the move.
+            # The engine gets the clocks too, so it can stop by itself when the best move is stable
+            search = engine_search.StreamingSearch(pooled.engine, session.board.copy(), depth=max_depth,
+                                                   think_time=hard_time, game=game_id,
+                                                   clock=session.engine_clock(), deadline=wait_time, nodes=nodes)
         else:
-            threads_m = set_thread
+            threads_m = pooled.options.get("Threads", threads_m)
+            hash_m = pooled.options.get("Hash", hash_m)
+        # The move scheduler can stop it for a more urgent game
+        session.search = search
 
-        # Estimate Stockfish Elo strength
-        try:
-            elo_strength = (skill_level/20 + hash_m/3000 + depth/30 + threads_m/12 + deep_time/20) / 5 * 3200
-        except:
-            elo_strength = 2000
+        elo_strength = uci_elo if elo_mode else estimate_elo(skill_level, hash_m, depth, threads_m, deep_time)
 
         # Send message to Telegram Bot
         send_message = (f"Playing against: {opponent_name} -- {opponent_elo}\n"
-                        f"CP evaluation: {cp // 100}\n"
-                        f"Playing at level: {skill_level}\n"
+                        f"Last CP evaluation: {cp // 100}\n"
+                        + (f"Playing at UCI_Elo: {uci_elo} ({nodes} nodes)\n" if elo_mode else
+                           f"Playing at level: {skill_level}\n") +
                         f"Thinking time: {round(deep_time, 1)}s\n"
                         f"Hash Memory: {round(hash_m)}Mb\n"
                         f"Moves Depth: {round(depth)}\n"
                         f"Threads Num: {round(threads_m)}\n"
                         f"Playing at: {round(elo_strength)} Elo\n"
                         f"Variant: {variant}")
-        run_telegram_bot.send_message_to_telegram(telegram_token, send_message)
-
-    with chess.engine.SimpleEngine.popen_uci(path) as engine:
-        # Set hash size (in MB)
-        engine.configure({"Hash": hash_m})
-        # Set the number of threads
-        engine.configure({"Threads": threads_m})
-        # Set level
-        engine.configure({"Skill Level": skill_level})
-        result = engine.play(board, chess.engine.Limit(time=deep_time, depth=depth))
+        with metrics.timer('telegram'):
+            telegram_notifier.notify(send_message)
+        early_depth = min(EARLY_SCORE_DEPTH, max_depth)
+        best_moves = []
+        for info in search:
+            if 'score' not in info:
+                continue
+            if (adjust_time or adjust_depth) and info.get('depth', 0) >= early_depth:
+                early_cp = engine_search.cp_from_score(info['score'])
+                early_time, _, _, early_search_depth, _ = adjust_for_cp(early_cp, base_time, skill_level, hash_m,
+                                                                        base_depth, threads_m)
+                if adjust_time:
+                    deep_time = early_time
+                    soft_time, hard_time = deadlines(deep_time)
+                    search.set_think_time(hard_time)
+                if adjust_depth:
+                    depth = early_search_depth
+                adjust_time = adjust_depth = False
+            if info.get('pv'):
+                best_moves.append(info['pv'][0])
+            if info.get('depth', 0) >= round(depth):
+                search.stop()
+            elif search.elapsed() >= soft_time and time_manager.is_stable(best_moves):
+                search.stop()
+        result = search.best_move()
+        session.search = None
+        # From the start of the search (of the ponder on a ponderhit)
+        metrics.observe('search', search.elapsed())
+        admission.controller.record_search(game_id, search.elapsed() * threads_m)
+        metrics.inc('zoe_moves_total', 'engine')
+
+        if session.ponder and result.move and result.ponder and pool.can_ponder():
+            # Keep this engine thinking on the expected reply while the opponent thinks
+            ponder_board = session.board.copy()
+            ponder_board.push(result.move)
+            ponder_board.push(result.ponder)
+            if not ponder_board.is_game_over():
+                # The opponent can't think longer than his clock, and a ponderhit has no more than about the time
+                # of this move: the engine isn't kept busy past them
+                ponder_time = min(hard_time, session.opponent_clock())
+                pooled.ponder = engine_search.StreamingSearch(pooled.engine, ponder_board.copy(), depth=max_depth,
+                                                              think_time=ponder_time, game=game_id, nodes=nodes)
+                pooled.ponder_board = ponder_board
+    session.telemetry.update(source='engine', depth=search.info.get('depth', 0),
+                             seldepth=search.info.get('seldepth', 0), skill_level=skill_level,
+                             threads=round(threads_m), hash_m=round(hash_m), elo=round(elo_strength),
+                             nodes=search.info.get('nodes', 0), nps=search.info.get('nps', 0),
+                             search_time=search.elapsed())
+    if 'score' in search.info:
+        # Save the last evaluation to set level, hash and threads of the next move
+        session.last_eval = engine_search.cp_from_score(search.info['score'])
+        session.telemetry['cp'] = session.last_eval
+        if not elo_mode:
+            eval_cache.cache.put(session.board, variant, skill_level, session.last_eval, result.move,
+                                 search.info.get('depth', 0), search.info.get('pv', []))
     return result.move, round(elo_strength)
 
 
-def handle_game_bot_turn(game_id, fen, elo_opponent, opponent_name, variant):
-    """
-    This function handles the moves on Lichess and saves moves.
-    :param game_id: the game id that the bot is currently playing
-    :param fen: the fen position, to pass to read_fen_database to extract move
-    :param elo_opponent: opponent Lichess elo
-    """
-    # Set boards for variants or normal ("standard")
-    # Use Stockfish for standard games and Fairy Stockfish for variants, set boards for each
-    if variant == 'standard' or variant == 'chess960' or variant == 'fromPosition':
-        chess_board = chess.Board(fen)
-    elif variant == 'crazyhouse':
-        chess_board = chess.variant.CrazyhouseBoard(fen)
-    elif variant == 'antichess':
-        chess_board = chess.variant.AntichessBoard(fen)
-    elif variant == 'atomic':
-        chess_board = chess.variant.AtomicBoard(fen)
-    elif variant == 'horde':
-        chess_board = chess.variant.HordeBoard(fen)
-    elif variant == 'kingOfTheHill':
-        chess_board = chess.variant.KingOfTheHillBoard(fen)
-    elif variant == 'racingKings':
-        chess_board = chess.variant.RacingKingsBoard(fen)
-    elif variant == 'threeCheck':
-        chess_board = chess.variant.ThreeCheckBoard(fen)
-
-    for event in client.bots.stream_game_state(game_id):
-        try:
-            print(f"Playing: {event['id']}")
-        except:
-            print('Impredictable error..')
-            return
+def play_move(session, move):
+    """
+    Send the move to Lichess and save the lag of the call
+    """
+    move_start = time.monotonic()
+    client.bots.make_move(session.game_id, move.uci())
+    lag = time.monotonic() - move_start
+    session.update_lag(lag)
+    session.telemetry['api_latency'] = lag
+    metrics.observe('make_move', lag)
 
-        try:
-            # Use Stockfish 17 to find best move
-            next_move, elo_strength = stockfish_best_move(fen, elo_opponent, opponent_name, game_id, variant)
-            client.bots.make_move(game_id, next_move.uci())
-            chess_board.push(next_move)
-            print(f'I moved from Stockfish at {elo_strength} Elo')
-            send_message = f'My move is from Stockfish 17 at {elo_strength} Elo'
-            client.bots.post_message(game_id, send_message, False)
-            return
 
+def post_chat(game_id, message):
+    """
+    Send a chat message, or drop it if the chat rate limit has no room now (the move never waits for the chat)
+    """
+    try:
+        with metrics.timer('post_message'):
+            client.bots.post_message(game_id, message, False)
+    except lichess_api.RateLimitDropped:
+        metrics.inc('zoe_chat_dropped_total')
+
+
+def fallback_move(session):
+    """
+    Find a move when the normal search failed, the best one that fits in the clock:
+    best move found so far by the search, cached search result, opening book, shallow search, random move
+    :param session: GameSession of the game
+    :return: move (chess.Move), source (str)
+    """
+    board = session.board
+    legal_moves = list(board.legal_moves)
+    # The search that failed streamed its main line until the error
+    search, session.search = session.search, None
+    if search is not None and search.best in legal_moves:
+        return search.best, 'best_so_far'
+
+    try:
+        cached = eval_cache.cache.get(board, session.variant, session.skill_level, 0)
+        if cached is not None and chess.Move.from_uci(cached.move) in legal_moves:
+            return chess.Move.from_uci(cached.move), 'cache'
+    except Exception as e:
+        print(f"No cache fallback: {e}")
+
+    try:
+        book_entry = opening_book.pick_move(board, session.variant)
+        if book_entry is not None:
+            return book_entry.move, 'book'
+    except Exception as e:
+        print(f"No book fallback: {e}")
+
+    # A few tenths of second of an engine already running, only if the clock allows it (starting one takes longer)
+    emergency_time = time_manager.emergency_time(session.bot_clock(), session.lag)
+    if emergency_time > 0:
+        search = move = None
+        try:
+            pool = engine_pool.get_pool(session.variant)
+            with pool.checkout(session.game_id, timeout=emergency_time, spawn=False) as pooled:
+                pooled.stop_ponder()
+                search = engine_search.StreamingSearch(pooled.engine, board.copy(), depth=EMERGENCY_DEPTH,
+                                                       think_time=emergency_time, game=session.game_id,
+                                                       deadline=2 * emergency_time)
+                for _ in search:
+                    pass
+                move = search.best_move().move
         except Exception as e:
-            print(f"Invalid move: {e}")
-            list_legal_moves = list(chess_board.legal_moves)
-            rand_move = list_legal_moves[random.randint(0, len(list_legal_moves) - 1)]
-            client.bots.make_move(game_id, rand_move.uci())
-            chess_board.push(rand_move)
-            print('Invalid move.. i moved random')
-            tg_message = f"Playing against: {opponent_name} -- {elo_opponent}\n"
-            run_telegram_bot.send_message_to_telegram(telegram_token, tg_message + f'I moved random as {e}')
-            return
+            print(f"Shallow search failed: {e}")
+            move = search.best if search is not None else None
+        if move in legal_moves:
+            return move, 'shallow_search'
+
+    return legal_moves[random.randint(0, len(legal_moves) - 1)], 'random'
+
+
+def archive_move(session, move, source, turn_start, clock, reason=None):
+    """
+    Queue the record of a bot move in the game archive (written in background)
+    :param turn_start: time.monotonic() at the start of the bot turn
+    :param clock: bot clock at the start of the turn (s)
+    :param reason: why the search failed, for a fallback move
+    """
+    if game_archive.archive is None:
+        return
+    telemetry = session.telemetry
+    game_archive.archive.record_move(game_archive.MoveRecord(
+        session.game_id, len(session.moves), move.uci(), telemetry.get('cp'), telemetry.get('depth', 0),
+        telemetry.get('seldepth', 0), telemetry.get('skill_level', 0), telemetry.get('threads', 0),
+        telemetry.get('hash_m', 0), telemetry.get('elo', 0), telemetry.get('nodes', 0), telemetry.get('nps', 0),
+        time.monotonic() - turn_start, telemetry.get('search_time', 0.0), telemetry.get('api_latency', 0.0), clock,
+        source, reason))
+
+
+def pgn_headers(session):
+    """
+    :return: dict of PGN headers of the game
+    """
+    bot_name = bot_id or 'Zoe'
+    if session.winner == 'white':
+        result = '1-0'
+    elif session.winner == 'black':
+        result = '0-1'
+    elif session.status in ('draw', 'stalemate'):
+        result = '1/2-1/2'
+    else:
+        result = '*'
+    white, black = (bot_name, session.opponent_name) if session.color == 'white' else (session.opponent_name,
+                                                                                       bot_name)
+    # The variant header is set by the board
+    return {'Event': 'Lichess game', 'Site': f'https://lichess.org/{session.game_id}',
+            'Date': time.strftime('%Y.%m.%d'), 'White': white, 'Black': black, 'Result': result,
+            'Termination': session.status}
 
 
-def handle_single_event(game_id, variant):
+def handle_game_bot_turn(session):
     """
-    Handle only one event, in another Thread, for game(s) with less than 2'
+    This function finds the bot move and plays it on Lichess.
+    The move is pushed on the board when the game stream sends it back
+    :param session: GameSession of the game that the bot is currently playing
     """
-    countdown = 0
+    game_id = session.game_id
+    print(f"Playing: {game_id}")
+    turn_start = time.monotonic()
+    clock = session.bot_clock()
+    session.telemetry = {}
     try:
-        while True:
-            # If countdown is >= 1000 then close this function and thread
-            countdown += 1
-            if countdown >= 1000:
-                # Remove the id from the list and return 10 (thread is over)
-                hurry_list.remove(game_id)
-                return 10
-            # Stream every game but focus only on the game with < 2 min (game_id)
-            events = client.games.get_ongoing()
-            for event in events:
-                is_bot_turn = event['isMyTurn']
-                all_game_id = event['gameId']
-                if all_game_id == game_id and is_bot_turn:
-                    # This means the thread is still active
-                    countdown -= 1
-                    # If first move send welcome message
-                    if event['hasMoved'] == False:
-                        ai_send_message = random_chat()
-                        client.bots.post_message(game_id, ai_send_message, False)
-                    fen = event['fen']
-                    elo_opponent = event['opponent']['rating']
-                    opponent_name = event['opponent']['username']
-                    print('My turn')
-                    handle_game_bot_turn(game_id, fen, elo_opponent, opponent_name, variant)
-    except berserk.exceptions.ResponseError as e:
-        print(f"Rate limit exceeded: {e}. Waiting before retrying...")
-        tg_message = f"Rate limit exceeded: {e}. Waiting before retrying..."
-        run_telegram_bot.send_message_to_telegram(telegram_token, tg_message + 'I moved random')
-        hurry_list.remove(game_id)
-        return 10
+        # Human move of the opening book: no engine and no thinking time
+        with metrics.timer('book'):
+            book_entry = opening_book.pick_move(session.board, session.variant)
+        if book_entry is not None:
+            play_move(session, book_entry.move)
+            # No engine searched this move: the ponder on the last reply is useless
+            engine_pool.get_pool(session.variant).stop_ponder(game_id)
+            archive_move(session, book_entry.move, 'book', turn_start, clock)
+            metrics.inc('zoe_moves_total', 'book')
+            print(f'I moved from opening book: {book_entry.name or ""}')
+            send_message = (f'My move is played by humans {book_entry.count} times, at {book_entry.elo} Elo'
+                            + (f' ({book_entry.name})' if book_entry.name else ''))
+            post_chat(game_id, send_message)
+            return
+
+        # Few pieces: the Syzygy tables know the result, no search
+        with metrics.timer('tablebase'):
+            tablebase_move = tablebase.best_move(session.board, session.variant)
+        if tablebase_move is not None:
+            next_move, wdl = tablebase_move
+            play_move(session, next_move)
+            engine_pool.get_pool(session.variant).stop_ponder(game_id)
+            archive_move(session, next_move, 'tablebase', turn_start, clock)
+            metrics.inc('zoe_moves_total', 'tablebase')
+            result = 'win' if wdl > 0 else 'loss' if wdl < 0 else 'draw'
+            print(f'I moved from Syzygy tables: {result}')
+            send_message = f'My move is from Syzygy tables, this endgame is a {result} for me'
+            post_chat(game_id, send_message)
+            return
+
+        # Use Stockfish 17 to find best move
+        next_move, elo_strength = stockfish_best_move(session)
+        play_move(session, next_move)
+        if session.telemetry.get('source') == 'cache':
+            engine_pool.get_pool(session.variant).stop_ponder(game_id)
+        archive_move(session, next_move, session.telemetry.get('source', 'engine'), turn_start, clock)
+        print(f'I moved from Stockfish at {elo_strength} Elo')
+        send_message = f'My move is from Stockfish 17 at {elo_strength} Elo'
+        post_chat(game_id, send_message)
+
     except Exception as e:
-        print(f"Unexpected error: {e}")
-        tg_message = f"Unexpected error: {e}"
-        run_telegram_bot.send_message_to_telegram(telegram_token, tg_message + 'I moved random')
-        hurry_list.remove(game_id)
-        return 10
+        reason = f"{type(e).__name__}: {e}"
+        print(f"Search failed: {reason}")
+        metrics.inc('zoe_search_failures_total', type(e).__name__)
+        next_move, source = fallback_move(session)
+        metrics.inc('zoe_fallback_moves_total', source)
+        if source == 'random':
+            metrics.inc('zoe_random_moves_total')
+        play_move(session, next_move)
+        engine_pool.get_pool(session.variant).stop_ponder(game_id)
+        archive_move(session, next_move, source, turn_start, clock, reason)
+        print(f'I moved from {source} as the search failed')
+        tg_message = f"Playing against: {session.opponent_name} -- {session.opponent_elo}\n"
+        telegram_notifier.notify(tg_message + f'I moved from {source} as {reason}')
 
 
-def handle_events():
+def play_game(game):
     """
-    Most important function. Loops each active game on Lichess and handle moves and threads
+    Follow one game through its Lichess stream (in its own Thread) and move every time it's Bot turn
+    :param game: game dict of the gameStart event
     """
-    counter_challenge = 0
+    session = GameSession(game)
+    session.ponder = ponder_enabled(settings_store.get_settings(game['gameId']))
+    game_id = session.game_id
+    admission.controller.game_started(game_id, game.get('speed', 'blitz'), session.variant)
+    if game_archive.archive is not None:
+        game_archive.archive.game_started(game_id, {
+            'color': session.color, 'opponent': session.opponent_name, 'opponent_elo': session.opponent_elo,
+            'variant': session.variant, 'speed': game.get('speed'), 'rated': game.get('rated'),
+            'started': time.time()})
+    print(f"Game started: {game_id} against {session.opponent_name}")
     try:
-        while True:
-            counter_challenge += 1
+        # If first move send welcome message
+        if not session.has_moved:
+            post_chat(game_id, random_chat())
 
-            set_challenge_loops = load_global_db('challenge_loops', 'global', 'get', 0)
-            if set_challenge_loops < 100:
-                challenge_loops = 2000
-            else:
-                challenge_loops = set_challenge_loops
-            print(f'While loop num: {counter_challenge} -- challenge is at: {challenge_loops}')
-            if counter_challenge > challenge_loops:
-                counter_challenge = 0
-                send_challenge()
-
-            # Check challenges
-            if challenge_loops % 5 == 0:
-                check_challenges()
-                pass
-
-            # Stream every games
-            events = client.games.get_ongoing()
-            for event in events:
-                is_bot_turn = event['isMyTurn']
-                game_id = event['gameId']
-                variant = event['variant']['key']
-
-                try:
-                    if event['secondsLeft'] <= 120 and is_bot_turn and game_id not in hurry_list:
-                        # If game has < 2' secondsLeft create a thread just for it
-                        thread = threading.Thread(target=handle_single_event, args=(game_id, variant))
-                        if thread == 10:
-                            # 10 means the function in the thread is finished, so it can close this session
-                            break
-                        thread.start()
-                        hurry_list.append(game_id)
+        # The stream can close or fail while the game goes on: connect again (it starts with gameFull)
+        reconnects = 0
+        while not session.is_over():
+            try:
+                for event in client.bots.stream_game_state(game_id):
+                    reconnects = 0
+                    if event['type'] not in ('gameFull', 'gameState'):
+                        # Chat lines and opponentGone
+                        continue
+                    session.update(event)
+                    if session.is_over():
+                        break
+                    resource_scheduler.scheduler.update_game(game_id, session.bot_clock(), session.is_bot_turn())
+                    if not session.is_new_turn():
                         continue
-                except:
-                    pass
 
-                print(game_id)
-
-                # Check if it's Bot Turn and if it's not in the other Thread
-                if game_id not in hurry_list:
-                    if is_bot_turn:
-                        # If first move send welcome message
-                        if event['hasMoved'] == False:
-                            ai_send_message = random_chat()
-                            client.bots.post_message(game_id, ai_send_message, False)
-                        fen = event['fen']
-                        elo_opponent = event['opponent']['rating']
-                        opponent_name = event['opponent']['username']
-                        print('My turn')
-                        handle_game_bot_turn(game_id, fen, elo_opponent, opponent_name, variant)
-
-    except berserk.exceptions.ResponseError as e:
-        print(f"Rate limit exceeded: {e}. Waiting before retrying...")
-        tg_message = f"Rate limit exceeded: {e}. Waiting before retrying..."
-        run_telegram_bot.send_message_to_telegram(telegram_token, tg_message + 'I moved random')
-        time.sleep(10)  # Wait for 90 seconds before retrying
-        handle_events()  # Restart the event handling after the wait
+                    print('My turn')
+                    session.handled_ply = len(session.moves)
+                    try:
+                        # Wait for a worker: games that flag first are served first
+                        move_scheduler.scheduler.submit(session, handle_game_bot_turn).result()
+                    except Exception as e:
+                        # The next event (or stream) tries this turn again
+                        session.handled_ply = None
+                        print(f"Error in the turn of game {game_id}: {e}")
+                        telegram_notifier.notify(f"Error in the turn of game {game_id}: {e}")
+            except Exception as e:
+                print(f"Stream of game {game_id} failed: {e}")
+            if session.is_over():
+                break
+            reconnects += 1
+            if reconnects > MAX_STREAM_RECONNECTS:
+                print(f"Game {game_id} left after {MAX_STREAM_RECONNECTS} reconnections")
+                telegram_notifier.notify(f"Game {game_id} left after {MAX_STREAM_RECONNECTS} reconnections")
+                break
+            wait = lichess_api.backoff(reconnects)
+            print(f"Reconnecting to game {game_id} in {wait:.1f}s")
+            time.sleep(wait)
+
     except Exception as e:
-        print(f"Unexpected error: {e}")
-        tg_message = f"Unexpected error: {e}"
-        run_telegram_bot.send_message_to_telegram(telegram_token, tg_message + 'I moved random')
-        time.sleep(10)  # Wait for 10 seconds before retrying
-        handle_events()  # Restart the event handling after the wait
+        print(f"Unexpected error in game {game_id}: {e}")
+        tg_message = f"Unexpected error in game {game_id}: {e}"
+        telegram_notifier.notify(tg_message)
+    finally:
+        print(f"Game over: {game_id}")
+        engine_pool.get_pool(session.variant).stop_ponder(game_id)
+        resource_scheduler.scheduler.game_over(game_id)
+        admission.controller.game_over(game_id)
+        if game_archive.archive is not None and session.board is not None:
+            game_archive.archive.game_over(game_id, session.status, session.board.copy(), pgn_headers(session))
+        settings_store.clear_game(game_id)
+        if game_id in list_playing_id:
+            list_playing_id.remove(game_id)
 
 
-def check_challenges():
+def start_game(game):
     """
-    Check challenges and accept them if the cadence times are met
+    Play a new game in its own Thread, or send it to a worker process in supervisor mode
+    :param game: game dict of the gameStart event
     """
-    challenges = client_challenges.challenges.get_mine()
-    for challenge in challenges['in']:
-        print(challenge)
-        challenger = challenge['challenger']['id']
+    game_id = game['gameId']
+    if game_supervisor is not None:
+        if game_id not in game_supervisor.playing():
+            admission.controller.game_started(game_id, game.get('speed', 'blitz'), game['variant']['key'])
+            worker_id = game_supervisor.dispatch(game)
+            print(f"Game {game_id} sent to worker {worker_id}")
+    elif game_id not in list_playing_id:
+        list_playing_id.append(game_id)
+        threading.Thread(target=play_game, args=(game,), daemon=True).start()
+
+
+def worker_main(worker_id, workers, conn):
+    """
+    Worker process of the supervisor mode: plays the games sent by the supervisor, with its own engines and caches,
+    and tells it when a game is over
+    :param worker_id: number of the worker (0 to workers - 1)
+    :param workers: number of workers
+    :param conn: pipe to the supervisor
+    """
+    channel = supervisor.WorkerChannel(conn)
+    if config.get('metrics_port') or config.get('metrics_file'):
+        metrics_port = config['metrics_port'] + 1 + worker_id if config.get('metrics_port') else None
+        metrics_file = f"{config['metrics_file']}.{worker_id}" if config.get('metrics_file') else None
+        metrics.start(metrics_port, metrics_file, config.get('metrics_dump_seconds', 60))
+        metrics.gauge('zoe_active_games', 'Games in progress', lambda: len(list_playing_id))
+    if config.get('eval_cache_db'):
+        eval_cache.configure(config.get('eval_cache_size', 100000), f"{config['eval_cache_db']}.{worker_id}")
+    channel.start_heartbeat(lambda: {'games': list(list_playing_id), 'api_calls': lichess_api.counter.per_minute(),
+                                     'usage': admission.controller.usage()})
+    warm_up()
+    startup.ready = True
+    channel.send('ready', startup.report())
+
+    def run_game(game):
         try:
-            challenge_cadence = challenge['speed']
-        except:
-            challenge_cadence = challenge['timeControl']['type']
-        challenge_id = challenge['id']
-        variant = challenge['variant']['key']
+            play_game(game)
+        finally:
+            channel.send('over', game['gameId'])
+
+    try:
+        for message in channel.messages():
+            if message[0] == 'game':
+                game = message[1]
+                if game['gameId'] not in list_playing_id:
+                    list_playing_id.append(game['gameId'])
+                    threading.Thread(target=run_game, args=(game,), daemon=True).start()
+    finally:
+        engine_pool.close_pools()
+        eval_cache.cache.close()
+        tablebase.close()
+        game_archive.close()
 
+
+def send_challenges_loop():
+    """
+    Send a challenge to another Bot every Challenge_Loops seconds (in its own Thread)
+    """
+    counter_challenge = 0
+    while True:
+        counter_challenge += 1
+        set_challenge_loops = settings_store.get_settings().challenge_loops
+        if set_challenge_loops < 100:
+            challenge_loops = 2000
+        else:
+            challenge_loops = set_challenge_loops
+        if counter_challenge > challenge_loops:
+            counter_challenge = 0
+            send_challenge()
+        time.sleep(1)
+
+
+def handle_events():
+    """
+    Most important function. Follows the Lichess stream of incoming events: accepts challenges and starts
+    a Thread with the game stream of every new game. When the stream breaks it connects again after a backoff
+    """
+    global bot_id
+    failures = 0
+    while True:
         try:
-            if variant == 'standard':
-                # Challenge standard
-                if challenge_cadence == 'correspondence' and challenge['timeControl']['type'] != 'unlimited':
-                    client.bots.accept_challenge(challenge_id)
-                    print(f"New Challenger: {challenger} on {challenge_cadence}")
-                elif (challenge['timeControl']['limit'] >= 60 and challenge['timeControl']['increment'] >= 0) or \
-                        challenge['speed'] == 'standard':
-                    client.bots.accept_challenge(challenge_id)
-                    print(f"New Challenger: {challenger} on {challenge_cadence}")
-                else:
-                    client.bots.decline_challenge(challenge_id=challenge_id, reason='tooFast')
+            if bot_id is None:
+                bot_id = client.account.get()['id']
+                threading.Thread(target=send_challenges_loop, daemon=True).start()
+
+            # Lichess sends again every ongoing game and open challenge when the stream (re)connects
+            for event in client.bots.stream_incoming_events():
+                failures = 0
+                if event['type'] == 'challenge':
+                    if event['challenge']['challenger']['id'] != bot_id:
+                        handle_challenge(event['challenge'])
+                elif event['type'] == 'gameStart':
+                    start_game(event['game'])
+                elif event['type'] in ('challengeCanceled', 'challengeDeclined'):
+                    admission.controller.release(event['challenge']['id'])
+            print("Event stream closed")
+
+        except berserk.exceptions.ResponseError as e:
+            print(f"Lichess error: {e}")
+            telegram_notifier.notify(f"Lichess error: {e}")
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+            telegram_notifier.notify(f"Unexpected error: {e}")
+
+        # Wait before connecting again: Wait_Api seconds (setted from Telegram, 10 if not setted) doubling
+        # at every failure in a row
+        failures += 1
+        wait_api = settings_store.get_settings().wait_api or 10
+        wait = wait_api + lichess_api.backoff(failures, wait_api)
+        print(f"Connecting again in {wait:.0f}s, API calls in the last minute: {lichess_api.counter.per_minute()}")
+        time.sleep(wait)
+
+
+def handle_challenge(challenge):
+    """
+    Accept the challenge if the cadence times are met, else decline it
+    :param challenge: challenge dict (from the event stream or the challenges list)
+    """
+    print(challenge)
+    challenger = challenge['challenger']['id']
+    try:
+        challenge_cadence = challenge['speed']
+    except:
+        challenge_cadence = challenge['timeControl']['type']
+    challenge_id = challenge['id']
+    variant = challenge['variant']['key']
+
+    # Decline while the engines have no capacity for one more game
+    accept, reason = admission.controller.can_accept(challenge_cadence, variant)
+    if not accept:
+        print(f"Challenge of {challenger} declined: {reason}")
+        client.bots.decline_challenge(challenge_id=challenge_id, reason='later')
+        return
+    # The capacity is held until the game starts (released below if the challenge is declined)
+    admission.controller.reserve(challenge_id, challenge_cadence, variant)
+
+    try:
+        if variant == 'standard':
+            # Challenge standard
+            if challenge_cadence == 'correspondence' and challenge['timeControl']['type'] != 'unlimited':
+                client.bots.accept_challenge(challenge_id)
+                print(f"New Challenger: {challenger} on {challenge_cadence}")
+            elif (challenge['timeControl']['limit'] >= 60 and challenge['timeControl']['increment'] >= 0) or \
+                    challenge['speed'] == 'standard':
+                client.bots.accept_challenge(challenge_id)
+                print(f"New Challenger: {challenger} on {challenge_cadence}")
             else:
-                # Challenge variants
-                if challenge['timeControl']['limit'] >= 120 and challenge['timeControl']['type'] != 'unlimited':
-                    client.bots.accept_challenge(challenge_id)
-                    print(f"New Challenger: {challenger} on {challenge_cadence}")
-                else:
-                    client.bots.decline_challenge(challenge_id=challenge_id, reason='generic')
+                admission.controller.release(challenge_id)
+                client.bots.decline_challenge(challenge_id=challenge_id, reason='tooFast')
+        else:
+            # Challenge variants
+            if challenge['timeControl']['limit'] >= 120 and challenge['timeControl']['type'] != 'unlimited':
+                client.bots.accept_challenge(challenge_id)
+                print(f"New Challenger: {challenger} on {challenge_cadence}")
+            else:
+                admission.controller.release(challenge_id)
+                client.bots.decline_challenge(challenge_id=challenge_id, reason='generic')
 
-        except:
-            client.bots.decline_challenge(challenge_id=challenge_id, reason='later')
+    except:
+        admission.controller.release(challenge_id)
+        client.bots.decline_challenge(challenge_id=challenge_id, reason='later')
 
 
 if __name__ == "__main__":
-    handle_events()
\ No newline at end of file
+    # Stopped by a deploy (SIGTERM): exit through the finally below, so engines are closed and archives written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # A ready file of a previous run is removed until this one is warm (only here: the workers of the supervisor
+    # import this module too, and a restarted worker must not remove it)
+    if READY_FILE and os.path.exists(READY_FILE):
+        os.remove(READY_FILE)
+    if IS_SUPERVISOR:
+        game_supervisor = supervisor.Supervisor(WORKER_PROCESSES, worker_main,
+                                                on_heartbeat=lambda stats: admission.controller.update_usage(
+                                                    stats.get('usage', {})),
+                                                on_game_over=admission.controller.game_over)
+        game_supervisor.start()
+        game_supervisor.wait_ready(config.get('worker_ready_timeout', 120))
+        startup.mark('workers')
+    else:
+        warm_up()
+    startup.notify_ready(READY_FILE)
+    try:
+        handle_events()
+    finally:
+        if game_supervisor is not None:
+            game_supervisor.stop()
+        engine_pool.close_pools()
+        eval_cache.cache.close()
+        tablebase.close()
+        game_archive.close()
\ No newline at end of file
@@ -0,0 +1,160 @@
+import mmap
+import random
+import struct
+from collections import namedtuple
+
+import chess
+import chess.polyglot
+
+
+# File layout: header, entries sorted by (zobrist key, move), names table.
+# Every entry is one move played from a position: key, move, games, average Elo of the players, index of the
+# opening name of the position after the move
+MAGIC = b'ZOEBOOK1'
+HEADER = struct.Struct('<8sIQ')
+ENTRY = struct.Struct('<QHIHH')
+NAME_LENGTH = struct.Struct('<H')
+NO_NAME = 0xFFFF
+# Moves played in less than this share of the games of the position are never picked
+MIN_MOVE_SHARE = 0.05
+
+BookEntry = namedtuple('BookEntry', ['move', 'count', 'elo', 'name'])
+
+
+def encode_move(move):
+    """
+    :param move: chess.Move
+    :return: move packed in 16 bits (from, to, promotion piece)
+    """
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def decode_move(value):
+    promotion = value >> 12
+    return chess.Move(value & 63, value >> 6 & 63, promotion or None)
+
+
+def write_book(path, positions, names=None):
+    """
+    Write a book file
+    :param path: file to write
+    :param positions: dict of zobrist key: {encoded move: (games, average Elo, name index)}
+    :param names: list of opening names (name index points here)
+    """
+    names = names or []
+    entries = sorted((key, move, count, elo, name) for key, moves in positions.items()
+                     for move, (count, elo, name) in moves.items())
+    with open(path, 'wb') as book_file:
+        names_offset = HEADER.size + len(entries) * ENTRY.size
+        book_file.write(HEADER.pack(MAGIC, len(entries), names_offset))
+        for key, move, count, elo, name in entries:
+            book_file.write(ENTRY.pack(key, move, min(count, 0xFFFFFFFF), min(elo, 0xFFFF), name))
+        book_file.write(struct.pack('<I', len(names)))
+        for name in names:
+            data = name.encode()[:0xFFFF]
+            book_file.write(NAME_LENGTH.pack(len(data)) + data)
+
+
+class OpeningBook:
+    """
+    Read only book memory mapped: every lookup is a binary search on the file,
+    the pages are shared by all the processes that open it
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as book_file:
+            self._mmap = mmap.mmap(book_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, names_offset = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} is not an opening book")
+        # Names are few, read them once
+        self.names = []
+        offset = names_offset + 4
+        for _ in range(struct.unpack_from('<I', self._mmap, names_offset)[0]):
+            length, = NAME_LENGTH.unpack_from(self._mmap, offset)
+            offset += NAME_LENGTH.size
+            self.names.append(self._mmap[offset:offset + length].decode())
+            offset += length
+
+    def _key_at(self, index):
+        return struct.unpack_from('<Q', self._mmap, HEADER.size + index * ENTRY.size)[0]
+
+    def entries(self, board):
+        """
+        :param board: chess.Board
+        :return: list of BookEntry of the position (empty if it's not in the book)
+        """
+        key = chess.polyglot.zobrist_hash(board)
+        # First entry with this key
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        entries = []
+        for index in range(low, self.count):
+            entry_key, move, count, elo, name = ENTRY.unpack_from(self._mmap, HEADER.size + index * ENTRY.size)
+            if entry_key != key:
+                break
+            move = decode_move(move)
+            if move in board.legal_moves:
+                entries.append(BookEntry(move, count, elo, self.names[name] if name != NO_NAME else None))
+        return entries
+
+    def pick_move(self, board):
+        """
+        Choose a human move, as often as humans play it
+        :param board: chess.Board
+        :return: BookEntry or None if the position is not in the book
+        """
+        entries = self.entries(board)
+        total = sum(entry.count for entry in entries)
+        entries = [entry for entry in entries if entry.count >= total * MIN_MOVE_SHARE]
+        if not entries:
+            return None
+        return random.choices(entries, weights=[entry.count for entry in entries])[0]
+
+    def prefetch(self):
+        """
+        Read the pages of the book into the page cache, so the first lookups don't wait for the disk
+        """
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            self._mmap.madvise(mmap.MADV_WILLNEED)
+        else:
+            for offset in range(0, len(self._mmap), mmap.PAGESIZE):
+                self._mmap[offset]
+
+    def close(self):
+        self._mmap.close()
+
+
+# Book opened at startup by configure()
+book = None
+
+
+def configure(path):
+    """
+    Open the book (nothing happens if the file doesn't exist)
+    """
+    global book
+    try:
+        book = OpeningBook(path)
+        print(f"Opening book: {book.count} moves")
+    except FileNotFoundError:
+        book = None
+
+
+def prefetch():
+    if book is not None:
+        book.prefetch()
+
+
+def pick_move(board, variant):
+    """
+    :return: BookEntry of a human move, None if there is no book or the position is not in it
+    """
+    if book is None or variant != 'standard':
+        return None
+    return book.pick_move(board)
@@ -0,0 +1,109 @@
+import os
+import threading
+
+import engine_pool
+
+
+# Weight of a game waiting for the opponent (its engine can only be pondering)
+PONDER_WEIGHT = 0.25
+# Games with less than this clock (s) get more threads/hash, the clock is never counted below MIN_CLOCK
+URGENT_CLOCK = 60
+MIN_CLOCK = 5
+# Min hash (MB) of an engine, hash is always a power of 2 so it doesn't change (and get cleared) for small rebalances
+MIN_HASH = 16
+
+
+def urgency(seconds_left, bot_turn):
+    """
+    :param seconds_left: seconds left on the bot clock
+    :param bot_turn: True if the bot is thinking in this game
+    :return: weight of the game in the share of threads and hash
+    """
+    if not bot_turn:
+        return PONDER_WEIGHT
+    return 1 + URGENT_CLOCK / max(MIN_CLOCK, seconds_left)
+
+
+def floor_power_of_2(value):
+    value = int(value)
+    if value < 1:
+        return 0
+    return 1 << (value.bit_length() - 1)
+
+
+class ResourceScheduler:
+    """
+    Share the CPU cores and the hash memory of the machine between the engines of all the games.
+    Each game has a weight by urgency (bot turn, little time on the clock), a search gets the share of its game,
+    never more than what the other busy engines (searching or pondering) left free.
+    Threads and hash can't change during a search, so the share is rebalanced at every move
+    """
+    def __init__(self, cores=None, hash_budget=1024):
+        """
+        :param cores: CPU cores for the engines (None for all the cores of the machine)
+        :param hash_budget: MB of hash for all the engines
+        """
+        self.cores = cores or os.cpu_count() or 1
+        self.hash_budget = hash_budget
+        # game id: weight
+        self._games = {}
+        self._lock = threading.Lock()
+
+    def update_game(self, game_id, seconds_left, bot_turn):
+        """
+        Save the state of a game (at every event of its stream)
+        """
+        with self._lock:
+            self._games[game_id] = urgency(seconds_left, bot_turn)
+
+    def game_over(self, game_id):
+        with self._lock:
+            self._games.pop(game_id, None)
+
+    def allocate(self, game_id, pooled, threads, hash_m):
+        """
+        Give threads and hash to the engine that is going to search for a game, and configure it
+        :param game_id: id of the game
+        :param pooled: PooledEngine checked out for the search
+        :param threads: threads wanted
+        :param hash_m: hash wanted (MB)
+        :return: threads, hash_m configured on the engine
+        """
+        # Only the shares are computed under the lock, the engines are configured (UCI round-trips) outside it
+        with self._lock:
+            weight = self._games.get(game_id, 1)
+            share = weight / max(weight, sum(self._games.values()))
+            active_games = set(self._games)
+
+        busy_threads = 0
+        used_hash = 0
+        for other, busy in engine_pool.engine_states():
+            if other is pooled:
+                continue
+            used_hash += other.options.get('Hash', MIN_HASH)
+            if busy:
+                busy_threads += other.options.get('Threads', 1)
+        free_hash = self.hash_budget - used_hash
+        if free_hash < self.hash_budget * share:
+            # Idle engines keep their hash allocated: give it back to the budget. Not the ones of the games in
+            # progress, a new Hash would clear the table their next search reuses
+            for pool in (engine_pool.stockfish_pool, engine_pool.fairy_pool):
+                if pool is not None:
+                    pool.shrink_idle({"Hash": MIN_HASH}, keep_games=active_games)
+            used_hash = sum(other.options.get('Hash', MIN_HASH) for other, busy in engine_pool.engine_states()
+                            if other is not pooled)
+            free_hash = self.hash_budget - used_hash
+
+        threads = max(1, min(threads, int(self.cores * share), self.cores - busy_threads))
+        hash_m = max(MIN_HASH, floor_power_of_2(min(hash_m, self.hash_budget * share, free_hash)))
+        pooled.configure({"Threads": threads, "Hash": hash_m})
+        return threads, hash_m
+
+
+# Scheduler configured at startup by configure()
+scheduler = ResourceScheduler()
+
+
+def configure(cores=None, hash_budget=1024):
+    global scheduler
+    scheduler = ResourceScheduler(cores, hash_budget)
@@ -0,0 +1,203 @@
+import csv
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, fields, replace
+from pathlib import Path
+
+
+THIS_FOLDER = Path(__file__).parent.resolve()
+# This csv file is shared between Lichess and Telegram Bots to set params
+SETTINGS_CSV = THIS_FOLDER / "../database/Settings.csv"
+# Lock file to serialize writes between the two processes, and seconds after which a lock is stale
+LOCK_FILE = THIS_FOLDER / "../database/Settings.csv.lock"
+LOCK_TIMEOUT = 10
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Params setted from Telegram (0 means not setted)
+    """
+    game: str = 'global'
+    level: int = 0
+    think: float = 0
+    hash: int = 0
+    depth: int = 0
+    thread: int = 0
+    wait_api: float = 0
+    challenge_loops: int = 0
+    challenge_time: int = 0
+    challenge_increment: int = 0
+    challenge_opp_elo: int = 0
+    challenge_variant: str = 'standard'
+    ponder: int = 0
+    elo_mode: int = 0
+
+
+# Csv column of each setting
+COLUMNS = {
+    'game': 'Game',
+    'level': 'Level',
+    'think': 'Think',
+    'hash': 'Hash',
+    'depth': 'Depth',
+    'thread': 'Thread',
+    'wait_api': 'Wait_Api',
+    'challenge_loops': 'Challenge_Loops',
+    'challenge_time': 'Challenge_Time',
+    'challenge_increment': 'Challenge_Increment',
+    'challenge_opp_elo': 'Challenge_Opponent_Elo',
+    'challenge_variant': 'Challenge_Variant',
+    'ponder': 'Ponder',
+    'elo_mode': 'Elo_Mode',
+}
+FIELD_TYPES = {field.name: field.type for field in fields(Settings)}
+
+# Rows of the csv (game: Settings) and the (mtime, size) of the file when they were read
+_cache = {}
+_cache_stamp = None
+_lock = threading.Lock()
+
+
+def _parse(name, value):
+    field_type = FIELD_TYPES[name]
+    if field_type in (int, 'int'):
+        return int(float(value or 0))
+    elif field_type in (float, 'float'):
+        return float(value or 0)
+    return value
+
+
+def _read_rows():
+    rows = {}
+    with open(SETTINGS_CSV, newline='') as csv_file:
+        for row in csv.DictReader(csv_file):
+            # Column names are matched case insensitive, unknown columns (as old index columns) are skipped
+            values = {key.lower(): value for key, value in row.items() if key}
+            settings = {}
+            for name, column in COLUMNS.items():
+                if column.lower() in values:
+                    settings[name] = _parse(name, values[column.lower()])
+            rows[settings.get('game', 'global')] = Settings(**settings)
+    return rows
+
+
+def _load():
+    """
+    Read the csv only when the file changed since the last read
+    :return: dict of game: Settings
+    """
+    global _cache, _cache_stamp
+    try:
+        stat = os.stat(SETTINGS_CSV)
+        # Writes replace the file: a new inode even when mtime and size are the same
+        stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return {}
+    with _lock:
+        if stamp != _cache_stamp:
+            _cache = _read_rows()
+            _cache_stamp = stamp
+        return _cache
+
+
+def configure(path):
+    """
+    Use another csv file (the Lichess and Telegram bots must use the same one), its lock file is next to it
+    """
+    global SETTINGS_CSV, LOCK_FILE, _cache, _cache_stamp
+    SETTINGS_CSV = Path(path)
+    LOCK_FILE = SETTINGS_CSV.with_name(SETTINGS_CSV.name + '.lock')
+    with _lock:
+        _cache = {}
+        _cache_stamp = None
+
+
+def get_settings(game_for='global'):
+    """
+    Load the params setted from Telegram
+    :param game_for: 'global' or id of a game, values setted for the game override the global ones
+    :return: Settings
+    """
+    rows = _load()
+    settings = rows.get('global', Settings())
+    if game_for != 'global' and game_for in rows:
+        overrides = {name: value for name, value in vars(rows[game_for]).items()
+                     if name != 'game' and value and value != '0'}
+        settings = replace(settings, game=game_for, **overrides)
+    return settings
+
+
+class _FileLock:
+    """
+    Lock shared by the Lichess and Telegram processes (a lock file created exclusively)
+    """
+    def __enter__(self):
+        start = time.monotonic()
+        while True:
+            try:
+                self.fd = os.open(LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(LOCK_FILE) > LOCK_TIMEOUT:
+                        # The process holding the lock died
+                        os.remove(LOCK_FILE)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.monotonic() - start > LOCK_TIMEOUT:
+                    raise TimeoutError(f"Settings are locked by {LOCK_FILE}")
+                time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        os.close(self.fd)
+        os.remove(LOCK_FILE)
+
+
+def _write_rows(rows):
+    """
+    Write the csv atomically: a temporary file replaces the old one
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=SETTINGS_CSV.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file, lineterminator='\n')
+            writer.writerow(COLUMNS.values())
+            for settings in rows.values():
+                writer.writerow(getattr(settings, name) for name in COLUMNS)
+        os.replace(tmp_path, SETTINGS_CSV)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def set_setting(search_for, add_value, game_for='global'):
+    """
+    Save a param
+    :param search_for: name of the param (level, think, hash, depth, thread, wait_api, challenge_*, ponder, elo_mode)
+    :param add_value: value to be set
+    :param game_for: 'global' or id of a game to set the param for that game only
+    """
+    with _FileLock():
+        rows = dict(_read_rows())
+        settings = rows.get(game_for, Settings(game=game_for))
+        if game_for != 'global' and game_for not in rows:
+            # A new game row has every param not setted
+            settings = Settings(game=game_for, challenge_variant='')
+        rows[game_for] = replace(settings, **{search_for: _parse(search_for, add_value)})
+        _write_rows(rows)
+
+
+def clear_game(game_for):
+    """
+    Remove the params of a game (when it's over)
+    """
+    if game_for not in _load():
+        return
+    with _FileLock():
+        rows = dict(_read_rows())
+        if rows.pop(game_for, None) is not None:
+            _write_rows(rows)
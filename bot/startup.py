@@ -0,0 +1,64 @@
+import os
+import socket
+import time
+
+
+# Process start (this module is imported first by the bot)
+start_time = time.monotonic()
+# (stage, seconds) of every stage of the startup, in order
+stages = []
+_last_mark = start_time
+ready = False
+
+
+def mark(name):
+    """
+    End a stage of the startup: the time since the end of the previous one (or the process start)
+    :param name: name of the stage shown in the timing breakdown
+    """
+    global _last_mark
+    now = time.monotonic()
+    stages.append((name, now - _last_mark))
+    _last_mark = now
+
+
+def report():
+    """
+    :return: timing breakdown of the startup
+    """
+    breakdown = ', '.join(f"{name} {seconds:.2f}s" for name, seconds in stages)
+    return f"Ready in {time.monotonic() - start_time:.2f}s ({breakdown})"
+
+
+def _notify_systemd(message):
+    """
+    Send a message to systemd (services with Type=notify), nothing happens if the bot is not run by systemd
+    """
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return
+    if address.startswith('@'):
+        # Abstract namespace socket
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+            notify_socket.connect(address)
+            notify_socket.sendall(message.encode())
+    except OSError as e:
+        print(f"Readiness not sent to systemd: {e}")
+
+
+def notify_ready(ready_file=None):
+    """
+    Tell that the bot is warm and plays at full speed: READY=1 to systemd, the timing breakdown to ready_file
+    (deploy scripts can wait for it) and to the log
+    :param ready_file: path of the file written when ready (None for no file)
+    """
+    global ready
+    ready = True
+    message = report()
+    print(message)
+    if ready_file:
+        with open(ready_file, 'w') as file:
+            file.write(message + '\n')
+    _notify_systemd(f"READY=1\nSTATUS={message}")
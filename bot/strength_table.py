@@ -0,0 +1,112 @@
+import json
+import math
+from collections import namedtuple
+
+
+# Engine settings of one strength level: think time (s), skill level, hash (MB), depth, threads
+Level = namedtuple('Level', 'deep_time skill_level hash_m depth threads_m')
+
+# Levels by opponent Elo (highest Elo of each level, None for the strongest), used until a measured table
+# is built by calibration.py
+DEFAULT_LEVELS = (
+    (700, Level(0.2, 2, 16, 4, 4)),
+    (1000, Level(0.5, 4, 16, 8, 8)),
+    (1500, Level(1.0, 9, 32, 10, 11)),
+    (2000, Level(1.5, 14, 128, 12, 11)),
+    (2300, Level(2.3, 16, 512, 15, 13)),
+    (2500, Level(5.0, 18, 1028, 20, 15)),
+    (None, Level(10.0, 20, 2056, 25, 18)),
+)
+
+# Settings of the UCI_Elo mode: Stockfish weakens itself to the Elo (UCI_LimitStrength), a small node budget
+# keeps it from searching at full strength to play a weak move
+EloLevel = namedtuple('EloLevel', 'nodes threads_m hash_m')
+# Elo range of UCI_Elo (Stockfish plays at full strength above it)
+UCI_MIN_ELO, UCI_MAX_ELO = 1320, 3190
+# Levels by target Elo (highest Elo of each level, None for the strongest)
+DEFAULT_ELO_LEVELS = (
+    (1500, EloLevel(20000, 1, 16)),
+    (2000, EloLevel(60000, 1, 16)),
+    (2300, EloLevel(150000, 1, 32)),
+    (2600, EloLevel(400000, 1, 64)),
+    (2900, EloLevel(1000000, 2, 128)),
+    (None, EloLevel(3000000, 4, 256)),
+)
+
+
+class StrengthTable:
+    """
+    Strength measured by self-play (calibration.py): the cheapest settings of every level (of both modes), and the
+    Elo of every tried setting to estimate the strength of the settings changed during a game
+    """
+    def __init__(self, path):
+        with open(path) as table_file:
+            data = json.load(table_file)
+        self.levels = tuple((row['max_elo'], Level(row['deep_time'], row['skill_level'], row['hash_m'],
+                                                   row['depth'], row['threads_m']))
+                            for row in data['levels'])
+        self.elo_levels = tuple((row['max_elo'], EloLevel(row['nodes'], row['threads_m'], row['hash_m']))
+                                for row in data.get('elo_levels', []))
+        self.results = [(Level(row['deep_time'], row['skill_level'], row['hash_m'], row['depth'], row['threads_m']),
+                         row['elo']) for row in data['results']
+                        if row.get('mode', 'skill') == 'skill' and row.get('elo') is not None]
+
+    def estimate_elo(self, level):
+        """
+        :param level: Level of a search
+        :return: Elo of the closest measured setting (skill level, depth and think time count), None if none
+        """
+        def distance(measured):
+            return (abs(measured.skill_level - level.skill_level) / 20 + abs(measured.depth - level.depth) / 30
+                    + abs(math.log((measured.deep_time + 0.01) / (level.deep_time + 0.01))) / 4)
+        if not self.results:
+            return None
+        return min(self.results, key=lambda result: distance(result[0]))[1]
+
+
+# Table loaded at startup by configure() (None: DEFAULT_LEVELS and the formula of the bot)
+table = None
+
+
+def configure(path):
+    """
+    Load the measured table (nothing happens if the file doesn't exist)
+    """
+    global table
+    try:
+        table = StrengthTable(path)
+        print(f"Strength table: {len(table.levels)} levels, {len(table.results)} measured settings")
+    except FileNotFoundError:
+        table = None
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Strength table {path} not loaded: {e}")
+        table = None
+
+
+def level_for(opponent_elo):
+    """
+    :return: Level to play against this Elo
+    """
+    levels = table.levels if table is not None and table.levels else DEFAULT_LEVELS
+    for max_elo, level in levels:
+        if max_elo is None or opponent_elo <= max_elo:
+            return level
+    return levels[-1][1]
+
+
+def elo_level_for(target_elo):
+    """
+    :return: EloLevel of the UCI_Elo mode to play at this Elo
+    """
+    levels = table.elo_levels if table is not None and table.elo_levels else DEFAULT_ELO_LEVELS
+    for max_elo, level in levels:
+        if max_elo is None or target_elo <= max_elo:
+            return level
+    return levels[-1][1]
+
+
+def measured_elo(level):
+    """
+    :return: measured Elo of these settings, None without a table
+    """
+    return table.estimate_elo(level) if table is not None else None
@@ -0,0 +1,205 @@
+import multiprocessing
+import threading
+import time
+
+
+# Seconds between the heartbeats of a worker, and without heartbeats to consider it wedged
+HEARTBEAT_SECONDS = 5
+HEARTBEAT_TIMEOUT = 60
+
+
+class WorkerHandle:
+    """
+    A worker process seen by the supervisor: its pipe, the games sent to it and its last heartbeat
+    """
+    def __init__(self, worker_id, process, conn):
+        self.worker_id = worker_id
+        self.process = process
+        self.conn = conn
+        # game id: game dict of the gameStart event
+        self.games = {}
+        self.last_heartbeat = time.monotonic()
+        self.stats = {}
+        # Set when the worker has warmed up its engines
+        self.ready = threading.Event()
+        self.send_lock = threading.Lock()
+
+    def send(self, *message):
+        with self.send_lock:
+            self.conn.send(message)
+
+
+class Supervisor:
+    """
+    Run the games in worker processes: every worker has its own engines, caches and threads, so one wedged or
+    crashed worker doesn't stop the games of the others. A dead or wedged worker is started again and its games
+    are sent to the workers alive (the game stream starts again with gameFull)
+    """
+    def __init__(self, workers, target, on_heartbeat=None, on_game_over=None):
+        """
+        :param workers: number of worker processes
+        :param target: function(worker_id, workers, conn) run by every worker process
+        :param on_heartbeat: function called with the stats of every heartbeat
+        :param on_game_over: function called with the id of every game over
+        """
+        self.workers = workers
+        self.target = target
+        self.on_heartbeat = on_heartbeat
+        self.on_game_over = on_game_over
+        # Spawned processes: no copy of the threads and engines of the supervisor
+        self.context = multiprocessing.get_context('spawn')
+        self.handles = {}
+        self.finished_games = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+        threading.Thread(target=self._watchdog, name='supervisor-watchdog', daemon=True).start()
+
+    def _spawn(self, worker_id):
+        conn, worker_conn = self.context.Pipe()
+        process = self.context.Process(target=self.target, args=(worker_id, self.workers, worker_conn),
+                                       name=f'zoe-worker-{worker_id}', daemon=True)
+        process.start()
+        worker_conn.close()
+        handle = WorkerHandle(worker_id, process, conn)
+        with self._lock:
+            self.handles[worker_id] = handle
+        threading.Thread(target=self._reader, args=(handle,), name=f'supervisor-reader-{worker_id}',
+                         daemon=True).start()
+        print(f"Worker {worker_id} started (pid {process.pid})")
+        return handle
+
+    def dispatch(self, game):
+        """
+        Send a game to the worker with less games
+        :param game: game dict of the gameStart event
+        :return: worker id
+        """
+        with self._lock:
+            handle = min(self.handles.values(), key=lambda worker: len(worker.games))
+            handle.games[game['gameId']] = game
+        handle.send('game', game)
+        return handle.worker_id
+
+    def wait_ready(self, timeout=None):
+        """
+        Wait until every worker has warmed up
+        :param timeout: max seconds to wait
+        :return: True if all the workers are ready
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            handles = list(self.handles.values())
+        for handle in handles:
+            if not handle.ready.wait(None if deadline is None else max(0.0, deadline - time.monotonic())):
+                print(f"Worker {handle.worker_id} not ready after {timeout}s")
+                return False
+        return True
+
+    def playing(self):
+        """
+        :return: ids of the games in progress in the workers
+        """
+        with self._lock:
+            return [game_id for handle in self.handles.values() for game_id in handle.games]
+
+    def _reader(self, handle):
+        """
+        Messages of a worker: ('heartbeat', stats), ('ready', startup report), ('over', game id)
+        """
+        while True:
+            try:
+                message = handle.conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == 'heartbeat':
+                handle.last_heartbeat = time.monotonic()
+                handle.stats = message[1]
+                if self.on_heartbeat is not None:
+                    self.on_heartbeat(message[1])
+            elif message[0] == 'ready':
+                print(f"Worker {handle.worker_id}: {message[1]}")
+                handle.ready.set()
+            elif message[0] == 'over':
+                with self._lock:
+                    handle.games.pop(message[1], None)
+                    self.finished_games += 1
+                if self.on_game_over is not None:
+                    self.on_game_over(message[1])
+
+    def _restart(self, handle, reason):
+        print(f"Worker {handle.worker_id} {reason}, starting it again with its {len(handle.games)} games")
+        if handle.process.is_alive():
+            handle.process.kill()
+        handle.process.join(5)
+        handle.conn.close()
+        games = list(handle.games.values())
+        self._spawn(handle.worker_id)
+        for game in games:
+            self.dispatch(game)
+
+    def _watchdog(self):
+        while True:
+            time.sleep(HEARTBEAT_SECONDS)
+            with self._lock:
+                handles = list(self.handles.values())
+            for handle in handles:
+                if not handle.process.is_alive():
+                    self._restart(handle, f"died (exit code {handle.process.exitcode})")
+                elif time.monotonic() - handle.last_heartbeat > HEARTBEAT_TIMEOUT:
+                    self._restart(handle, "is wedged")
+
+    def stop(self):
+        with self._lock:
+            handles = list(self.handles.values())
+        for handle in handles:
+            try:
+                handle.send('stop')
+            except (BrokenPipeError, OSError):
+                pass
+        for handle in handles:
+            handle.process.join(10)
+            if handle.process.is_alive():
+                handle.process.kill()
+
+
+class WorkerChannel:
+    """
+    Pipe of a worker process to the supervisor, shared by the threads of the worker
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self._lock = threading.Lock()
+
+    def send(self, *message):
+        with self._lock:
+            self.conn.send(message)
+
+    def start_heartbeat(self, read_stats):
+        """
+        Send a heartbeat with the stats of the worker every HEARTBEAT_SECONDS
+        :param read_stats: function returning a dict (picklable)
+        """
+        def beat():
+            while True:
+                try:
+                    self.send('heartbeat', read_stats())
+                except (BrokenPipeError, OSError):
+                    return
+                time.sleep(HEARTBEAT_SECONDS)
+        threading.Thread(target=beat, name='worker-heartbeat', daemon=True).start()
+
+    def messages(self):
+        """
+        Yield the messages of the supervisor until it says stop or goes away
+        """
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                return
+            if message[0] == 'stop':
+                return
+            yield message
@@ -0,0 +1,77 @@
+import os
+
+import chess
+
+
+# Variants that can use the standard Syzygy tables
+TABLEBASE_VARIANTS = ('standard', 'chess960', 'fromPosition')
+
+# Tablebase opened at startup by configure()
+tablebase = None
+max_pieces = 0
+
+
+def configure(path, pieces=6):
+    """
+    Open the Syzygy tables (WDL and DTZ files), nothing happens if the path is not setted or missing
+    :param path: folder of the tables, more folders separated by os.pathsep
+    :param pieces: max number of pieces on the board to probe the tables
+    :return: True if some tables are opened
+    """
+    global tablebase, max_pieces
+    tablebase = None
+    max_pieces = pieces
+    if not path:
+        return False
+    folders = [folder for folder in str(path).split(os.pathsep) if os.path.isdir(folder)]
+    if not folders:
+        print(f"Syzygy tables not found in {path}")
+        return False
+    # Imported only when there are tables to open
+    import chess.syzygy
+    tablebase = chess.syzygy.open_tablebase(folders[0])
+    for folder in folders[1:]:
+        tablebase.add_directory(folder)
+    print(f"Syzygy tables: {len(tablebase.wdl)} WDL, {len(tablebase.dtz)} DTZ")
+    return True
+
+
+def best_move(board, variant):
+    """
+    Find the move of the tables: the fastest win, the longest loss, else a drawing move
+    :param board: board of the position
+    :param variant: type of chess variant
+    :return: (move, wdl from the bot side) or None if the position is not in the tables
+    """
+    if tablebase is None or variant not in TABLEBASE_VARIANTS or chess.popcount(board.occupied) > max_pieces:
+        return None
+    if board.castling_rights:
+        # Tables have no castling rights
+        return None
+    best = None
+    try:
+        for move in board.legal_moves:
+            board.push(move)
+            try:
+                # Both from the opponent side after the move
+                wdl = tablebase.probe_wdl(board)
+                dtz = tablebase.probe_dtz(board) if wdl != 0 else 0
+                if board.is_checkmate():
+                    wdl, dtz = -2, 0
+            finally:
+                board.pop()
+            # Best result first, then: a win with the shortest dtz, a loss with the longest one
+            key = (-wdl, dtz)
+            if best is None or key > best[0]:
+                best = (key, move, -wdl)
+    except (KeyError, chess.syzygy.MissingTableError):
+        # Missing table: the engine searches as usual
+        return None
+    if best is None:
+        return None
+    return best[1], best[2]
+
+
+def close():
+    if tablebase is not None:
+        tablebase.close()
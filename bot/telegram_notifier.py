@@ -0,0 +1,115 @@
+import asyncio
+import queue
+import threading
+
+
+# Max length of a Telegram message
+MAX_MESSAGE_LENGTH = 4096
+
+
+class TelegramNotifier:
+    """
+    Send messages to Telegram without blocking the caller.
+    Messages go in a bounded queue, a single background worker (with its own asyncio loop and HTTP session)
+    sends them as one digest every digest_seconds. When the queue is full the oldest messages are dropped
+    and the digest tells how many
+    """
+    def __init__(self, token, chat_id, digest_seconds=5, max_queue=100):
+        """
+        :param token: Telegram bot token (empty to disable the notifications)
+        :param chat_id: Telegram id that receives the messages
+        :param digest_seconds: seconds to collect messages before sending them together
+        :param max_queue: max number of messages waiting
+        """
+        self.token = token
+        self.chat_id = chat_id
+        self.digest_seconds = digest_seconds
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def notify(self, message):
+        """
+        Queue a message, never blocks
+        """
+        if not self.token:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='telegram-notifier', daemon=True)
+                self._thread.start()
+            while True:
+                try:
+                    self.queue.put_nowait(message)
+                    return
+                except queue.Full:
+                    # Backpressure: drop the oldest message
+                    try:
+                        self.queue.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+
+    def _run(self):
+        asyncio.run(self._worker())
+
+    def _digest(self, messages):
+        """
+        Join the queued messages in one or more Telegram messages
+        """
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            messages.append(f"({dropped} messages dropped)")
+        chunks = []
+        chunk = ''
+        for message in messages:
+            message = message[:MAX_MESSAGE_LENGTH]
+            if chunk and len(chunk) + 2 + len(message) > MAX_MESSAGE_LENGTH:
+                chunks.append(chunk)
+                chunk = ''
+            chunk = f"{chunk}\n\n{message}" if chunk else message
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    async def _worker(self):
+        # Heavy import only in the worker thread
+        from telegram import Bot
+
+        # The same bot (and HTTP session) is used for every message
+        async with Bot(token=self.token) as bot:
+            while True:
+                # Nothing else runs on this loop while waiting, so the blocking get is fine
+                first = self.queue.get()
+                # Wait for the burst of messages of the other games, then send them together
+                await asyncio.sleep(self.digest_seconds)
+                messages = [first]
+                while True:
+                    try:
+                        messages.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                for text in self._digest(messages):
+                    try:
+                        await bot.send_message(chat_id=self.chat_id, text=text)
+                    except Exception as e:
+                        print(f"Telegram message not sent: {e}")
+
+
+# Notifier configured at startup by configure()
+notifier = None
+
+
+def configure(token, chat_id, digest_seconds=5, max_queue=100):
+    global notifier
+    notifier = TelegramNotifier(token, chat_id, digest_seconds, max_queue)
+
+
+def notify(message):
+    """
+    Send a message to Telegram in background (nothing happens if the notifier is not configured)
+    """
+    if notifier is not None:
+        notifier.notify(message)
@@ -0,0 +1,79 @@
+# Seconds always kept on the clock, plus two times the measured lag of each move
+MIN_RESERVE = 0.5
+# Number of moves a game is expected to last and min number of moves still to play
+EXPECTED_GAME_MOVES = 50
+MIN_MOVES_TO_GO = 15
+# Share of the increment spent on each move
+INCREMENT_USE = 0.75
+# Max share of the clock used by one move (soft and hard deadline)
+MAX_SOFT_SHARE = 0.2
+MAX_HARD_SHARE = 0.4
+# Hard deadline compared to the soft one
+HARD_FACTOR = 3
+# Never plan less than this thinking time (s)
+MIN_THINK_TIME = 0.05
+# Max share of the clock spent waiting for the engine to answer (after it the bot plays a fallback move)
+MAX_WAIT_SHARE = 0.6
+# Seconds for the engine to answer a stop
+STOP_GRACE = 1.0
+# Share of the clock and max seconds of the shallow search of a fallback move
+EMERGENCY_SHARE = 0.1
+MAX_EMERGENCY_TIME = 0.3
+# Depths with the same best move to consider it stable
+STABLE_DEPTHS = 3
+
+
+def moves_to_go(move_number):
+    """
+    :param move_number: full move number of the game
+    :return: number of moves the bot still expects to play
+    """
+    return max(MIN_MOVES_TO_GO, EXPECTED_GAME_MOVES - move_number)
+
+
+def move_deadlines(remaining, increment, move_number, lag=0.0):
+    """
+    Compute how long the bot can think on this move
+    :param remaining: seconds left on the bot clock
+    :param increment: increment in seconds
+    :param move_number: full move number of the game
+    :param lag: measured network/API lag of a move (s)
+    :return: soft, hard (s): the search stops at soft if the best move is stable, always at hard
+    """
+    available = max(0.0, remaining - MIN_RESERVE - 2 * lag)
+    base = available / moves_to_go(move_number) + increment * INCREMENT_USE
+    soft = max(MIN_THINK_TIME, min(base, available * MAX_SOFT_SHARE))
+    hard = max(soft, min(base * HARD_FACTOR, available * MAX_HARD_SHARE))
+    return soft, hard
+
+
+def wait_deadline(hard, remaining, lag=0.0):
+    """
+    Hard limit of a move: after the hard deadline of the search the engine has STOP_GRACE to answer the stop,
+    within MAX_WAIT_SHARE of the clock, leaving time for a fallback move
+    :param hard: hard deadline of the search (s)
+    :param remaining: seconds left on the bot clock
+    :param lag: measured network/API lag of a move (s)
+    :return: seconds
+    """
+    available = max(0.0, remaining - MIN_RESERVE - 2 * lag)
+    return max(hard, min(hard + STOP_GRACE, available * MAX_WAIT_SHARE))
+
+
+def emergency_time(remaining, lag=0.0):
+    """
+    :param remaining: seconds left on the bot clock
+    :param lag: measured network/API lag of a move (s)
+    :return: seconds of the shallow search of a fallback move (0 if there's no time for it)
+    """
+    available = max(0.0, remaining - MIN_RESERVE - 2 * lag)
+    seconds = min(MAX_EMERGENCY_TIME, available * EMERGENCY_SHARE)
+    return seconds if seconds >= MIN_THINK_TIME else 0.0
+
+
+def is_stable(best_moves):
+    """
+    :param best_moves: best move of each depth of the search
+    :return: True if the last STABLE_DEPTHS depths agree on the best move
+    """
+    return len(best_moves) >= STABLE_DEPTHS and len(set(best_moves[-STABLE_DEPTHS:])) == 1